@@ -17,6 +17,9 @@ const EvaluatorEngine = {
             privacyLabel: "Data Protection & Privacy",
             connError: "Connection Error: ",
             serverError: "Server Error: ",
+            gradeLabel: "Grade:",
+            retrying: "⏳ Many submissions are being graded right now, retrying in {s} s...",
+            queued: "⏳ Your text is in the grading queue (position {n})...",
 			emptySubmissionError: "ERROR: No response provided. Please write your task before submitting.\n\nGrade: 0 / 10"
         },
         es: {
@@ -31,6 +34,9 @@ const EvaluatorEngine = {
             privacyLabel: "Información de Protección de Datos",
             connError: "Error de conexión: ",
             serverError: "Error del servidor: ",
+            gradeLabel: "Nota:",
+            retrying: "⏳ Se están corrigiendo muchas respuestas ahora mismo, reintentando en {s} s...",
+            queued: "⏳ Tu texto está en la cola de corrección (posición {n})...",
 			emptySubmissionError: "ERROR: No has escrito ninguna respuesta. Por favor, realiza la tarea antes de enviar.\n\nNota: 0 / 10"
         },
         va: {
@@ -45,6 +51,9 @@ const EvaluatorEngine = {
             privacyLabel: "Informació de Protecció de Dades",
             connError: "Error de connexió: ",
             serverError: "Error del servidor: ",
+            gradeLabel: "Nota:",
+            retrying: "⏳ S'estan corregint moltes respostes ara mateix, reintentant en {s} s...",
+            queued: "⏳ El teu text està en la cua de correcció (posició {n})...",
 			emptySubmissionError: "ERROR: No has escrit cap resposta. Per favor, realitza la tasca abans d'enviar.\n\nNota: 0 / 10"
         }
     },
@@ -95,16 +104,18 @@ const EvaluatorEngine = {
     },
 
     init() {
-        // 1. Inject HTML inmediately
         const root = document.getElementById('app-root');
         if (!root) return;
-        root.innerHTML = this.getTemplate();
 
-        // 2. Language detection
+        // 1. Language detection
         const browserLang = navigator.language.split('-')[0];
         this.lang = CONFIG.lang || (this.i18n[browserLang] ? browserLang : 'en');
         this.txt = this.i18n[this.lang];
 
+        // 2. Inject HTML inmediately, unless build-pages.py already rendered it in this language
+        this.prerendered = root.dataset.prerendered === this.lang;
+        if (!this.prerendered) root.innerHTML = this.getTemplate();
+
         // 3. Token capture (URL > SessionStorage > LocalStorage)
         const urlParams = new URLSearchParams(window.location.search);
         this.token = urlParams.get('token') || sessionStorage.getItem('lti_session_token') || localStorage.getItem('lti_session_token');
@@ -112,29 +123,34 @@ const EvaluatorEngine = {
         const mode = urlParams.get('mode') || localStorage.getItem('lti_mode') || 'standalone';
         this.isLTI = (mode === 'lti' && !!this.token);
 
-        // Persistence storing
+        // Persistence storing (the launch redirects here with the token and mode in the URL)
         if (this.token) {
             sessionStorage.setItem('lti_session_token', this.token);
             localStorage.setItem('lti_session_token', this.token);
         }
+        if (urlParams.get('mode')) localStorage.setItem('lti_mode', mode);
 
         this.renderUI();
         this.bindEvents();
         this.setupPostMessage();
+        this.resumeJob();
     },
 
     renderUI() {
-        document.getElementById('ui-title').innerText = CONFIG.title;
-        document.getElementById('task-html').innerHTML = CONFIG.taskHTML;
-        document.getElementById('ui-label-input').innerText = this.txt.labelInput;
-        document.getElementById('evaluate-btn').innerText = this.txt.evaluateBtn;
-        document.getElementById('new-eval-btn').innerText = this.txt.newBtn;
-        document.getElementById('loading').innerText = this.txt.loading;
-        document.getElementById('student-input').value = CONFIG.initialValue;
-
-        if (CONFIG.privacyUrl) {
-            const footer = document.getElementById('privacy-footer');
-            footer.innerHTML = `<a href="${CONFIG.privacyUrl}" target="_blank">${this.txt.privacyLabel}</a>`;
+        // A pre-rendered page already has its texts (and maybe what the student started typing)
+        if (!this.prerendered) {
+            document.getElementById('ui-title').innerText = CONFIG.title;
+            document.getElementById('task-html').innerHTML = CONFIG.taskHTML;
+            document.getElementById('ui-label-input').innerText = this.txt.labelInput;
+            document.getElementById('evaluate-btn').innerText = this.txt.evaluateBtn;
+            document.getElementById('new-eval-btn').innerText = this.txt.newBtn;
+            document.getElementById('loading').innerText = this.txt.loading;
+            document.getElementById('student-input').value = CONFIG.initialValue;
+
+            if (CONFIG.privacyUrl) {
+                const footer = document.getElementById('privacy-footer');
+                footer.innerHTML = `<a href="${CONFIG.privacyUrl}" target="_blank">${this.txt.privacyLabel}</a>`;
+            }
         }
         if (CONFIG.debug) {
             if (this.isLTI) {
@@ -161,26 +177,23 @@ const EvaluatorEngine = {
             
 			
 			this.setLoading(true);
+            const body = JSON.stringify({
+                studentInput: text,
+                session_token: this.token,
+                defaultValue: templateToCompare.replace(/\s+/g, ''),
+                emptyErrorMsg: this.txt.emptySubmissionError
+            });
             try {
-                const resp = await fetch(CONFIG.evaluatorUrl, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({
-                        studentInput: text,
-                        session_token: this.token,
-                        defaultValue: templateToCompare.replace(/\s+/g, ''),
-                        emptyErrorMsg: this.txt.emptySubmissionError
-                    })
-                });
-
-                const rawText = await resp.text();
-                const start = rawText.indexOf('{');
-                const end = rawText.lastIndexOf('}') + 1;
-
-                if (start === -1) throw new Error("Invalid response format");
-
-                const res = JSON.parse(rawText.substring(start, end));
-                this.showFeedback(res.success ? res.feedback : this.txt.serverError + res.error, res.success);
+                // Busy server: it answers with 'retry_after' (HTTP 429), wait and send again
+                const maxRetries = CONFIG.maxRetries ?? 3;
+                let res = await this.submitEvaluation(body);
+                for (let attempt = 0; res.retry_after && attempt < maxRetries; attempt++) {
+                    await this.waitRetry(res.retry_after);
+                    res = await this.submitEvaluation(body);
+                }
+                // Job mode: the server queued the text, wait for the grading workers
+                if (res.job_id && this.isPending(res)) res = await this.waitJob(res.job_id);
+                this.showResult(res);
             } catch (err) {
                 this.showFeedback(this.txt.connError + err.message, false);
             } finally {
@@ -207,11 +220,139 @@ const EvaluatorEngine = {
         });
     },
 
+    async submitEvaluation(body) {
+        const headers = { 'Content-Type': 'application/json' };
+        // Streaming (opt-in): the server answers with server-sent events
+        if (CONFIG.stream) headers['Accept'] = 'text/event-stream';
+        const resp = await fetch(CONFIG.evaluatorUrl, { method: 'POST', headers: headers, body: body });
+
+        const contentType = resp.headers.get('Content-Type') || '';
+        if (CONFIG.stream && resp.body && contentType.includes('text/event-stream')) {
+            return this.readStream(resp);
+        }
+
+        const rawText = await resp.text();
+        const start = rawText.indexOf('{');
+        const end = rawText.lastIndexOf('}') + 1;
+
+        if (start === -1) {
+            // A 429 page from the web server itself (e.g. nginx limit_req) has no JSON body
+            const retryAfter = parseInt(resp.headers.get('Retry-After'), 10);
+            if (resp.status === 429) return { success: false, error: 'rate_limited', retry_after: retryAfter > 0 ? retryAfter : 5 };
+            throw new Error("Invalid response format");
+        }
+        return JSON.parse(rawText.substring(start, end));
+    },
+
+    // ⏳ JOB MODE: long-polls the queued job until it is graded
+    isPending(res) {
+        return res.status === 'queued' || res.status === 'running';
+    },
+
+    async waitJob(jobId) {
+        // Kept until the result arrives, so a reload keeps waiting for the same job
+        sessionStorage.setItem('aigrader_job', jobId);
+        const loading = document.getElementById('loading');
+        const body = JSON.stringify({ job_id: jobId, session_token: this.token, wait: CONFIG.jobWait ?? 25 });
+        let res = { status: 'queued' };
+        let errors = 0;
+        while (this.isPending(res)) {
+            try {
+                res = await this.submitEvaluation(body);
+                errors = 0;
+            } catch (err) {
+                // The job is stored on the server: a dropped poll is retried
+                if (++errors > 5) throw err;
+                await new Promise(resolve => setTimeout(resolve, 3000));
+                continue;
+            }
+            loading.innerText = res.status === 'queued' && res.position ? this.txt.queued.replace('{n}', res.position) : this.txt.loading;
+        }
+        sessionStorage.removeItem('aigrader_job');
+        return res;
+    },
+
+    async resumeJob() {
+        const jobId = sessionStorage.getItem('aigrader_job');
+        if (!jobId) return;
+        this.setLoading(true);
+        try {
+            const res = await this.waitJob(jobId);
+            if (res.error === 'Unknown job') return;
+            this.showResult(res);
+        } catch (err) {
+            this.showFeedback(this.txt.connError + err.message, false);
+        } finally {
+            sessionStorage.removeItem('aigrader_job');
+            this.setLoading(false);
+        }
+    },
+
+    async waitRetry(seconds) {
+        const loading = document.getElementById('loading');
+        for (let left = Math.ceil(seconds); left > 0; left--) {
+            loading.innerText = this.txt.retrying.replace('{s}', left);
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+        loading.innerText = this.txt.loading;
+    },
+
+    // 📡 STREAMING: renders 'delta' events as they arrive, returns the final 'done' / 'error' payload
+    async readStream(resp) {
+        const reader = resp.body.getReader();
+        const decoder = new TextDecoder();
+        const fb = document.getElementById('feedback');
+        const content = document.getElementById('feedback-content');
+        let buffer = '';
+        let text = '';
+        let result = null;
+
+        fb.className = 'feedback success';
+        fb.style.display = 'block';
+        content.innerHTML = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let sep;
+            while ((sep = buffer.indexOf('\n\n')) !== -1) {
+                const block = buffer.slice(0, sep);
+                buffer = buffer.slice(sep + 2);
+                const eventMatch = block.match(/^event: (.*)$/m);
+                const dataMatch = block.match(/^data: (.*)$/m);
+                if (!dataMatch) continue;
+                const event = eventMatch ? eventMatch[1] : 'message';
+                const payload = JSON.parse(dataMatch[1]);
+
+                if (event === 'delta') {
+                    text += payload.text;
+                    content.innerHTML = text;
+                } else if (event === 'grade') {
+                    document.getElementById('loading').innerText = `${this.txt.gradeLabel} ${payload.score} / ${payload.max}`;
+                } else if (event === 'done' || event === 'error') {
+                    result = payload;
+                }
+            }
+        }
+        if (CONFIG.debug) console.log("Stream finished", result);
+        return result || { success: false, error: 'Incomplete response' };
+    },
+
     setLoading(isLoading) {
         const btn = document.getElementById('evaluate-btn');
         btn.disabled = isLoading;
         btn.innerText = isLoading ? this.txt.evaluatingBtn : this.txt.evaluateBtn;
-        document.getElementById('loading').style.display = isLoading ? 'block' : 'none';
+        const loading = document.getElementById('loading');
+        loading.innerText = this.txt.loading;
+        loading.style.display = isLoading ? 'block' : 'none';
+    },
+
+    showResult(res) {
+        // A 'notice' (e.g. the text was too long and only its first part was graded) goes above the feedback
+        if (res.success) this.showFeedback((res.notice ? res.notice + '\n\n' : '') + res.feedback, true);
+        else this.showFeedback(this.txt.serverError + (res.message || res.error), false);
     },
 
     showFeedback(content, isSuccess) {
@@ -1,27 +1,46 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import asyncio
 import json
 import sys
 import os
 import time
-import cgitb
-import urllib.request
+import functools
 import urllib.parse
-import urllib.error
 import re
 import hashlib
 import hmac
 import base64
 import uuid
-import io
+import importlib.util
 from urllib.parse import urlparse
+from xml.sax.saxutils import escape as xml_escape
 
-# Enforce UTF-8 to prevent formatting errors with long rubrics.
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+import aigrader_budget
+import aigrader_cache
+import aigrader_consistency
+import aigrader_duplicates
+import aigrader_http
+import aigrader_jobs
+import aigrader_metrics
+import aigrader_outbox
+import aigrader_prompt_cache
+import aigrader_ratelimit
+import aigrader_replay
+import aigrader_router
+import aigrader_singleflight
+import aigrader_structured
+import aigrader_store
+import aigrader_tiers
+import lti_sessions
+
+# Enforce UTF-8 to prevent formatting errors with long rubrics (in place: importers keep their stdout).
+sys.stdout.reconfigure(encoding='utf-8')
 
 def setup_environment(debug_mode):
     if debug_mode:
+        import cgitb  # Only needed for debugging, and slow to import
         cgitb.enable()
     else:
         sys.tracebacklimit = 0
@@ -30,177 +49,757 @@ def log_debug(message, config):
     if config.get("DEBUG"):
         sys.stderr.write(f"[DEBUG] {message}\n")
 
-def is_safe_url(url, allowed_domains_str):
+def is_safe_url(url, allowed_domains_str, base_url="https://yourserver.com", allow_http=False):
     try:
         if not url: return False, "URL vacía"
-        base_url = config.get("BASE_URL", "https://yourserver.com").rstrip('/')
+        base_url = (base_url or "https://yourserver.com").rstrip('/')
         if url.startswith('/'):
             url = base_url + url
         parsed_url = urlparse(url)
-        if parsed_url.scheme != 'https':
+        if parsed_url.scheme != 'https' and not (allow_http and parsed_url.scheme == 'http'):
             return False, "Only HTTPS connections"
-        allowed_list = [d.strip().lower() for d in allowed_domains_str.split(",")]
-        domain = parsed_url.netloc.lower()
-        if any(domain == d or domain.endswith('.' + d) for d in allowed_list):
+        domain = (parsed_url.hostname or '').lower()
+        if any(domain == d or domain.endswith('.' + d) for d in allowed_domains(allowed_domains_str)):
             return True, url
         return False, f"Non authorised domain: {domain}"
     except Exception:
         return False, "Error in URL processing"
 
+@functools.lru_cache(maxsize=64)
+def allowed_domains(allowed_domains_str):
+    return tuple(d.strip().lower() for d in allowed_domains_str.split(","))
+
+@functools.lru_cache(maxsize=64)
+def cors_origins(allowed_origins_str):
+    return frozenset(d.strip() for d in allowed_origins_str.split(","))
+
+@functools.lru_cache(maxsize=64)
+def grade_pattern(grade_identifier):
+    return re.compile(rf"{re.escape(grade_identifier)}[:\s]*([\d.]+)\s*/\s*([\d.]+)", re.IGNORECASE)
+
+def grade_feedback(feedback, config):
+    """(display_feedback, score, max, details) from an LLM answer.
+
+    In structured_output mode the JSON object is parsed (details holds the criteria)
+    and rendered for the student; the FINAL_GRADE regex is the fallback.
+    """
+    mode = 'structured' if config.get("structured_output") else 'regex'
+    if mode == 'structured':
+        details = aigrader_structured.parse(feedback, config)
+        if details is not None:
+            aigrader_metrics.count(config, "grade_parse:structured|ok")
+            return aigrader_structured.render(details, config), details['overall_band'], details['max'], details
+    score, maximum = extract_flexible_grade(feedback, config['grade_identifier'])
+    if score is None:
+        outcome = 'failed'
+    else:
+        outcome = 'fallback' if mode == 'structured' else 'ok'
+    aigrader_metrics.count(config, f"grade_parse:{mode}|{outcome}")
+    return feedback, score, maximum, None
+
 def extract_flexible_grade(text, grade_identifier):
     try:
-        pattern = rf"{re.escape(grade_identifier)}[:\s]*([\d.]+)\s*/\s*([\d.]+)"
-        match = re.search(pattern, text, re.IGNORECASE)
+        match = grade_pattern(grade_identifier).search(text)
         if match:
             return float(match.group(1)), float(match.group(2))
     except Exception:
         pass
     return None, None
 
-def send_grade_to_lti(outcome_url, result_sourcedid, consumer_key, score_normalized, config):
-    try:
-        is_safe, final_url = is_safe_url(outcome_url, config.get("LTI_ALLOWED_DOMAINS", ""))
-        if not is_safe: return False
-        secret = config.get("lti_consumer_secrets", {}).get(consumer_key)
-        if not secret: return False
-
-        xml_body = f"""<?xml version="1.0" encoding="UTF-8"?>
+# 📨 LTI 1.1 OUTCOMES
+LTI_ENVELOPE = """<?xml version="1.0" encoding="UTF-8"?>
 <imsx_POXEnvelopeRequest xmlns="http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0">
   <imsx_POXHeader><imsx_POXRequestHeaderInfo><imsx_version>V1.0</imsx_version>
-  <imsx_messageIdentifier>{uuid.uuid4()}</imsx_messageIdentifier></imsx_POXRequestHeaderInfo></imsx_POXHeader>
-  <imsx_POXBody><replaceResultRequest><resultRecord>
-  <sourcedGUID><sourcedId>{result_sourcedid}</sourcedId></sourcedGUID>
-  <result><resultScore><language>en</language><textString>{float(score_normalized):.4f}</textString></resultScore></result>
-  </resultRecord></replaceResultRequest></imsx_POXBody></imsx_POXEnvelopeRequest>"""
-
-        body_hash = base64.b64encode(hashlib.sha1(xml_body.encode('utf-8')).digest()).decode('utf-8')
-        oauth_params = {
-            'oauth_body_hash': body_hash,
-            'oauth_consumer_key': consumer_key,
-            'oauth_nonce': uuid.uuid4().hex,
-            'oauth_signature_method': 'HMAC-SHA1',
-            'oauth_timestamp': str(int(time.time())),
-            'oauth_version': '1.0',
-        }
-        encoded_url = urllib.parse.quote(final_url, safe='')
-        sorted_params = '&'.join([f"{urllib.parse.quote(k)}={urllib.parse.quote(v)}" for k, v in sorted(oauth_params.items())])
-        base_string = f"POST&{encoded_url}&{urllib.parse.quote(sorted_params)}"
-        signing_key = f"{urllib.parse.quote(secret)}&".encode('utf-8')
-        signature = base64.b64encode(hmac.new(signing_key, base_string.encode('utf-8'), hashlib.sha1).digest()).decode('utf-8')
-        oauth_params['oauth_signature'] = signature
-        auth_header = 'OAuth ' + ', '.join([f'{k}="{urllib.parse.quote(v)}"' for k, v in oauth_params.items()])
-
-        req = urllib.request.Request(final_url, data=xml_body.encode('utf-8'), headers={'Content-Type': 'application/xml', 'Authorization': auth_header})
-        with urllib.request.urlopen(req, timeout=15) as response:
-            return response.getcode() == 200
-    except Exception:
+  <imsx_messageIdentifier>{message_id}</imsx_messageIdentifier></imsx_POXRequestHeaderInfo></imsx_POXHeader>
+  <imsx_POXBody>{request}</imsx_POXBody></imsx_POXEnvelopeRequest>"""
+LTI_OPERATIONS = {
+    'replaceResult': """<replaceResultRequest><resultRecord>
+  <sourcedGUID><sourcedId>{sourcedid}</sourcedId></sourcedGUID>
+  <result><resultScore><language>en</language><textString>{score:.4f}</textString></resultScore></result>
+  </resultRecord></replaceResultRequest>""",
+    'readResult': """<readResultRequest><resultRecord>
+  <sourcedGUID><sourcedId>{sourcedid}</sourcedId></sourcedGUID>
+  </resultRecord></readResultRequest>""",
+}
+PASSBACK_TIMEOUT = 15      # seconds per outcome request (also sizes the outbox lease)
+OAUTH_SAFE_RE = re.compile(r'[A-Za-z0-9._~-]*')
+BASE64_RE = re.compile(r'[A-Za-z0-9+/=]*')
+BASE64_QUOTE = str.maketrans({'+': '%2B', '/': '%2F', '=': '%3D'})
+OUTCOME_CODE_RE = re.compile(r'<(?:\w+:)?imsx_codeMajor>\s*([^<\s]+)')
+OUTCOME_DESCRIPTION_RE = re.compile(r'<(?:\w+:)?imsx_description>([^<]*)')
+OUTCOME_SCORE_RE = re.compile(r'<(?:\w+:)?textString>\s*([^<\s]*)')
+
+def build_lti_request(outcome_url, result_sourcedid, consumer_key, score_normalized, config, operation='replaceResult'):
+    """Returns (url, xml_body, headers) for a signed LTI 1.1 replaceResult (or readResult), or None if not allowed."""
+    is_safe, final_url = is_safe_url(outcome_url, config.get("LTI_ALLOWED_DOMAINS", ""), config.get("BASE_URL"),
+                                     config.get("LTI_ALLOW_HTTP", False))
+    if not is_safe: return None
+    secret = config.get("lti_consumer_secrets", {}).get(consumer_key)
+    if not secret: return None
+
+    request = LTI_OPERATIONS[operation].format(sourcedid=xml_escape(str(result_sourcedid)),
+                                               score=float(score_normalized or 0))
+    xml_body = LTI_ENVELOPE.format(message_id=uuid.uuid4(), request=request)
+
+    body_hash = base64.b64encode(hashlib.sha1(xml_body.encode('utf-8')).digest()).decode('ascii')
+    oauth_params = {
+        'oauth_body_hash': body_hash,
+        'oauth_consumer_key': consumer_key,
+        'oauth_nonce': uuid.uuid4().hex,
+        'oauth_signature_method': 'HMAC-SHA1',
+        'oauth_timestamp': str(int(time.time())),
+        'oauth_version': '1.0',
+    }
+    oauth_params['oauth_signature'] = oauth_signature('POST', final_url, oauth_params, secret)
+    auth_header = 'OAuth ' + ', '.join([f'{k}="{oauth_quote(v)}"' for k, v in oauth_params.items()])
+    return final_url, xml_body, {'Content-Type': 'application/xml', 'Authorization': auth_header}
+
+def oauth_quote(value):
+    """RFC 5849 percent-encoding (only unreserved characters are kept, '/' included in the escaping)."""
+    value = str(value)
+    # Nonces, timestamps and most keys need no escaping, body hashes and signatures only three
+    # characters: urllib (slow, character by character) is left for the rest.
+    if OAUTH_SAFE_RE.fullmatch(value):
+        return value
+    if BASE64_RE.fullmatch(value):
+        return value.translate(BASE64_QUOTE)
+    return urllib.parse.quote(value, safe='~')
+
+@functools.lru_cache(maxsize=256)
+def signature_base(method, url):
+    """Cached per outcome URL: the 'METHOD&base-uri&' prefix of the base string and the encoded query parameters."""
+    parsed = urlparse(url)
+    query = [(oauth_quote(k), oauth_quote(v)) for k, v in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)]
+    base_url = f"{parsed.scheme.lower()}://{parsed.netloc.lower()}{parsed.path or '/'}"
+    return f"{method.upper()}&{oauth_quote(base_url)}&", tuple(query)
+
+@functools.lru_cache(maxsize=64)
+def signing_hmac(secret):
+    """HMAC-SHA1 state keyed with the consumer secret; copied for each signature instead of rekeyed."""
+    return hmac.new(f"{oauth_quote(secret)}&".encode('utf-8'), digestmod=hashlib.sha1)
+
+def oauth_signature(method, url, oauth_params, secret):
+    """HMAC-SHA1 OAuth 1.0 signature: query parameters are signed with the oauth_* ones, not as part of the URL."""
+    prefix, query = signature_base(method, url)
+    pairs = sorted([(oauth_quote(k), oauth_quote(v)) for k, v in oauth_params.items()] + list(query))
+    normalized = '&'.join(f"{k}={v}" for k, v in pairs)
+    # Made of encoded pairs, so only '%', '&' and '=' need escaping again.
+    normalized = normalized.replace('%', '%25').replace('&', '%26').replace('=', '%3D')
+    mac = signing_hmac(secret).copy()
+    mac.update((prefix + normalized).encode('utf-8'))
+    return base64.b64encode(mac.digest()).decode('ascii')
+
+def parse_outcome_response(body):
+    """(codeMajor, description, textString) of an imsx_POXEnvelopeResponse; None for missing parts."""
+    text = body.decode('utf-8', 'replace') if isinstance(body, bytes) else body or ''
+    found = [regex.search(text) for regex in (OUTCOME_CODE_RE, OUTCOME_DESCRIPTION_RE, OUTCOME_SCORE_RE)]
+    return tuple(match.group(1).strip() if match else None for match in found)
+
+class PassbackRejected(Exception):
+    """The grade can never be sent (URL not allowed or unknown consumer key), retrying is pointless."""
+
+class OutcomeFailure(Exception):
+    """The LMS answered the outcome request with an imsx_codeMajor other than success."""
+
+async def outcome_request_async(outcome_url, result_sourcedid, consumer_key, score_normalized, config, operation='replaceResult'):
+    """Sends one signed outcome request and returns its parsed response; raises on any failure."""
+    lti_request = build_lti_request(outcome_url, result_sourcedid, consumer_key, score_normalized, config, operation)
+    if not lti_request:
+        raise PassbackRejected("Outcome URL not allowed or unknown consumer key")
+    final_url, xml_body, headers = lti_request
+    response = await aigrader_http.get_client().request('POST', final_url, xml_body, headers, timeout=PASSBACK_TIMEOUT)
+    if response.status != 200:
+        raise aigrader_http.HTTPError(response.status, response.reason, response.body)
+    code_major, description, score = parse_outcome_response(response.body)
+    # An LMS may answer 200 with a failure code (e.g. unknown sourcedId). No code at all is accepted.
+    if code_major and code_major.lower() != 'success':
+        raise OutcomeFailure(f"{code_major}: {description or ''}".strip())
+    return code_major, description, score
+
+async def post_grade_async(outcome_url, result_sourcedid, consumer_key, score_normalized, config):
+    """Sends the grade and raises on any failure, for callers that retry (see aigrader_outbox.py)."""
+    await outcome_request_async(outcome_url, result_sourcedid, consumer_key, score_normalized, config)
+
+async def read_grade_async(outcome_url, result_sourcedid, consumer_key, config):
+    """The score the LMS holds for this sourcedid (readResult), or None if it has none."""
+    _, _, score = await outcome_request_async(outcome_url, result_sourcedid, consumer_key, 0, config, 'readResult')
+    try:
+        return float(score)
+    except (TypeError, ValueError):
+        return None
+
+async def send_grade_to_lti_async(outcome_url, result_sourcedid, consumer_key, score_normalized, config):
+    try:
+        await post_grade_async(outcome_url, result_sourcedid, consumer_key, score_normalized, config)
+    except Exception as e:
+        aigrader_metrics.count(config, "lti_passback:failed")
+        aigrader_metrics.log_event(config, "lti_passback_failed", outcome_url=outcome_url,
+                                   error=str(e) or e.__class__.__name__)
         return False
+    aigrader_metrics.count(config, "lti_passback:ok")
+    return True
 
-def call_ai_api(student_input, config):
+def send_grade_to_lti(outcome_url, result_sourcedid, consumer_key, score_normalized, config):
+    return aigrader_http.run_sync(send_grade_to_lti_async(outcome_url, result_sourcedid, consumer_key, score_normalized, config))
+
+def build_ai_request(student_input, config, stream=False, cached_content=None):
+    """Returns (provider, url, headers, body) for the configured LLM provider."""
     provider = config.get("provider", "openai").lower()
-    try:
-        if provider == "openai":
-            url = config.get("api_url", "https://api.openai.com").rstrip('/')
-            if "/chat/completions" not in url:
-                url += "/v1/chat/completions"
-
-            headers = {"Content-Type": "application/json", "Authorization": f"Bearer {config['api_key']}"}
-            body = {
-                "model": config["model_name"],
-                "messages": [
-                    {"role": "system", "content": config["system_instructions"]},
-                    {"role": "user", "content": f"Student Text:\n{student_input}"}
-                ],
-                "temperature": 0.2
-            }
-        else: # Google
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/{config['model_name']}:generateContent?key={config['api_key']}"
-            headers = {'Content-Type': 'application/json'}
+    if provider == "openai":
+        url = (config.get("api_url") or "https://api.openai.com").rstrip('/')
+        if "/chat/completions" not in url:
+            url += "/v1/chat/completions"
+
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {config['api_key']}"}
+        # The rubric always goes first so the provider's automatic prefix caching applies.
+        body = {
+            "model": config["model_name"],
+            "messages": [
+                {"role": "system", "content": config["system_instructions"]},
+                {"role": "user", "content": f"Student Text:\n{student_input}"}
+            ],
+            "temperature": 0.2
+        }
+        if stream:
+            body["stream"] = True
+        if config.get("prompt_caching") and not config.get("api_url"):
+            body["prompt_cache_key"] = aigrader_prompt_cache.openai_cache_key(config)
+            if stream:
+                body["stream_options"] = {"include_usage": True}
+    else: # Google
+        method = "streamGenerateContent?alt=sse&" if stream else "generateContent?"
+        url = f"{aigrader_prompt_cache.google_base_url(config)}/models/{config['model_name']}:{method}key={config['api_key']}"
+        headers = {'Content-Type': 'application/json'}
+        student_content = {"role": "user", "parts": [{"text": f"Student Text:\n{student_input}"}]}
+        if cached_content:
+            body = {"cachedContent": cached_content, "contents": [student_content]}
+        elif config.get("prompt_caching"):
+            body = {"systemInstruction": {"parts": [{"text": config["system_instructions"]}]}, "contents": [student_content]}
+        else:
             body = {"contents": [{"parts": [{"text": f"{config['system_instructions']}\n\nStudent Text:\n{student_input}"}]}]}
+    if config.get("structured_output"):
+        aigrader_structured.apply_to_request(body, provider, config)
+    aigrader_budget.apply_to_request(body, provider, config)
+    return provider, url, headers, body
 
-        req = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'), headers=headers, method='POST')
-        with urllib.request.urlopen(req, timeout=120) as response:
-            res = json.loads(response.read().decode('utf-8'))
-            if provider == "openai":
-                feedback = res['choices'][0]['message']['content']
-            else:
-                feedback = res['candidates'][0]['content']['parts'][0]['text']
-            return {'success': True, 'feedback': feedback}
+def parse_ai_response(res, provider):
+    if provider == "openai":
+        return res['choices'][0]['message']['content']
+    return res['candidates'][0]['content']['parts'][0]['text']
+
+def response_usage(res, provider):
+    """{'prompt_tokens', 'completion_tokens'} reported by the provider, or None."""
+    if provider == "openai":
+        usage = res.get('usage')
+        if not usage:
+            return None
+        return {'prompt_tokens': usage.get('prompt_tokens', 0), 'completion_tokens': usage.get('completion_tokens', 0)}
+    usage = res.get('usageMetadata')
+    if not usage:
+        return None
+    return {'prompt_tokens': usage.get('promptTokenCount', 0), 'completion_tokens': usage.get('candidatesTokenCount', 0)}
+
+def parse_stream_delta(event, provider):
+    """Text carried by one streamed event (OpenAI chat.completion.chunk or Gemini SSE chunk)."""
+    if provider == "openai":
+        choices = event.get('choices') or [{}]
+        return (choices[0].get('delta') or {}).get('content') or ''
+    candidates = event.get('candidates') or [{}]
+    parts = (candidates[0].get('content') or {}).get('parts') or []
+    return ''.join(part.get('text', '') for part in parts)
+
+async def call_provider_async(student_input, config):
+    """One call to the provider set in config["provider"]; never raises."""
+    name = aigrader_router.provider_name(config)
+    try:
+        await aigrader_ratelimit.admit_call(student_input, config)
+    except aigrader_ratelimit.RateLimited as e:
+        # Not a provider failure: the call was never sent.
+        return dict(rate_limited_response(e.retry_after), provider=name)
+    try:
+        cached_content = await aigrader_prompt_cache.get_cached_content(config)
+        provider, url, headers, body = build_ai_request(student_input, config, cached_content=cached_content)
+        response = await aigrader_replay.post(url, body, headers, config)
+        if cached_content and response.status in (400, 403, 404):
+            # The cached rubric expired or was deleted on the provider side: send it inline.
+            await asyncio.to_thread(aigrader_prompt_cache.invalidate, config)
+            provider, url, headers, body = build_ai_request(student_input, config)
+            response = await aigrader_replay.post(url, body, headers, config)
+        res = json.loads(response.raise_for_status().text())
+        await asyncio.to_thread(aigrader_prompt_cache.record_usage, res, provider, config)
+        usage = response_usage(res, provider)
+        feedback = parse_ai_response(res, provider)
+    except asyncio.TimeoutError:
+        await asyncio.to_thread(aigrader_metrics.record_llm_call, config, name, False)
+        return {'success': False, 'error': 'The AI provider did not answer in time', 'provider': name}
     except Exception as e:
-        return {'success': False, 'error': str(e)}
+        await asyncio.to_thread(aigrader_metrics.record_llm_call, config, name, False)
+        return {'success': False, 'error': str(e), 'provider': name}
+    # Counters and histograms are SQLite writes: off the shared event loop.
+    await asyncio.to_thread(aigrader_metrics.record_llm_call, config, name, True, usage)
+    return {'success': True, 'feedback': feedback, 'provider': name, 'usage': usage}
 
-def run(config):
-    setup_environment(config.get("DEBUG", False))
+async def call_ai_api_async(student_input, config):
+    if (config.get("samples") or 1) > 1:
+        return await aigrader_consistency.call_consistent_async(student_input, config)
+    if config.get("tiers"):
+        return await aigrader_tiers.call_tiered_async(student_input, config)
+    if config.get("providers"):
+        return await aigrader_router.route_ai_api_async(student_input, config)
+    return await call_provider_async(student_input, config)
 
-    origin = os.environ.get('HTTP_ORIGIN', '')
-    allowed_config = config.get("CORS_ALLOWED_ORIGINS", "*")
-    header_origin = origin if allowed_config == "*" or origin in [d.strip() for d in allowed_config.split(",")] else "null"
+def call_ai_api(student_input, config):
+    return aigrader_http.run_sync(call_ai_api_async(student_input, config))
 
-    # Encabezados CGI
-    sys.stdout.write("Content-Type: application/json; charset=utf-8\n")
-    sys.stdout.write(f"Access-Control-Allow-Origin: {header_origin}\n")
-    sys.stdout.write("Access-Control-Allow-Methods: POST, OPTIONS\n")
-    sys.stdout.write("Access-Control-Allow-Headers: Content-Type\n\n")
-    sys.stdout.flush()
+async def stream_ai_api_async(student_input, config):
+    """Async generator yielding the feedback text as the provider streams it. Raises on errors.
 
-    if os.environ.get('REQUEST_METHOD') == 'OPTIONS':
+    With a "providers" list, the next healthy provider is tried if one fails before its first token.
+    """
+    if not config.get("providers"):
+        async for text in stream_provider_async(student_input, config):
+            yield text
+        return
+    candidates = await asyncio.to_thread(aigrader_router.healthy_candidates, config)
+    for index, candidate in enumerate(candidates):
+        name = aigrader_router.provider_name(candidate)
+        started = time.monotonic()
+        produced = False
+        try:
+            async for text in stream_provider_async(student_input, candidate):
+                produced = True
+                yield text
+        except aigrader_ratelimit.RateLimited:
+            # This provider is over its budget: the next one, if any.
+            if index == len(candidates) - 1:
+                raise
+            continue
+        except Exception:
+            await asyncio.to_thread(aigrader_router.record_failure, config, name)
+            if produced or index == len(candidates) - 1:
+                raise
+            continue
+        await asyncio.to_thread(aigrader_router.record_outcome, config, name, time.monotonic() - started)
         return
 
+async def stream_provider_async(student_input, config):
+    await aigrader_ratelimit.admit_call(student_input, config)
+    cached_content = await aigrader_prompt_cache.get_cached_content(config)
     try:
-        content_length = int(os.environ.get('CONTENT_LENGTH', 0))
-        raw_data = sys.stdin.read(content_length)
-        data = json.loads(raw_data)
-
-        student_input = data.get('studentInput', '').strip()
-        default_value = data.get('defaultValue', '').strip()
-        session_token = data.get('session_token') or data.get('token', '')
-
-        # Verificación previa
-        clean_input = re.sub(r'\s+', '', student_input)
-        clean_default = re.sub(r'\s+', '', default_value)
-
-        if not student_input or clean_input == clean_default:
-            sys.stdout.write(json.dumps({
-                'success': True,
-                'feedback': data.get('emptyErrorMsg', 'Error: Empty submission'),
-                'score_info': {'score': 0, 'max': 5},
-                'lti_notified': False
-            }, ensure_ascii=False))
-            return
+        try:
+            async for text in _stream_ai_api(student_input, config, cached_content):
+                yield text
+        except aigrader_http.HTTPError as e:
+            # Raised before any text was produced: retry once with the rubric inline.
+            if not cached_content or e.status not in (400, 403, 404):
+                raise
+            await asyncio.to_thread(aigrader_prompt_cache.invalidate, config)
+            async for text in _stream_ai_api(student_input, config, None):
+                yield text
+    except Exception:
+        await asyncio.to_thread(aigrader_metrics.record_llm_call, config, aigrader_router.provider_name(config), False)
+        raise
+
+async def _stream_ai_api(student_input, config, cached_content):
+    provider, url, headers, body = build_ai_request(student_input, config, stream=True, cached_content=cached_content)
+    buffer = b''
+    usage_event = None
+    async for chunk in aigrader_http.get_client().stream('POST', url, json.dumps(body), headers, timeout=120):
+        buffer += chunk
+        while b'\n' in buffer:
+            line, buffer = buffer.split(b'\n', 1)
+            line = line.strip()
+            if not line.startswith(b'data:'):
+                continue
+            payload = line[5:].strip()
+            if payload == b'[DONE]':
+                buffer = b''
+                break
+            event = json.loads(payload)
+            if event.get('usage') or event.get('usageMetadata'):
+                usage_event = event
+            text = parse_stream_delta(event, provider)
+            if text:
+                yield text
+    usage = None
+    if usage_event:
+        await asyncio.to_thread(aigrader_prompt_cache.record_usage, usage_event, provider, config)
+        usage = response_usage(usage_event, provider)
+    name = aigrader_router.provider_name(config)
+    await asyncio.to_thread(aigrader_metrics.record_llm_call, config, name, True, usage)
+    aigrader_metrics.annotate(provider=name, usage=usage)
+
+def load_config(path):
+    """Imports a grader config script (like evaluate-certacles-writing-c1-LTI-conf.py) and returns its CONFIG."""
+    path = os.path.abspath(path)
+    config_dir = os.path.dirname(path)
+    if config_dir not in sys.path:
+        sys.path.insert(0, config_dir)
+    module_name = "aigrader_conf_" + re.sub(r'\W', '_', os.path.splitext(os.path.basename(path))[0])
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if not isinstance(getattr(module, 'CONFIG', None), dict):
+        raise ValueError(f"{path} does not define a CONFIG dict")
+    return module.CONFIG
+
+def response_headers(config, origin, stream=False):
+    allowed_config = config.get("CORS_ALLOWED_ORIGINS", "*")
+    header_origin = origin if allowed_config == "*" or origin in cors_origins(allowed_config) else "null"
+    headers = [
+        ("Content-Type", "text/event-stream; charset=utf-8" if stream else "application/json; charset=utf-8"),
+        ("Access-Control-Allow-Origin", header_origin),
+        ("Access-Control-Allow-Methods", "POST, OPTIONS"),
+        ("Access-Control-Allow-Headers", "Content-Type"),
+        ("Access-Control-Expose-Headers", "Retry-After, X-Request-ID"),
+    ]
+    if stream:
+        headers += [("Cache-Control", "no-cache"), ("X-Accel-Buffering", "no")]
+    return headers
+
+def wants_stream(config, accept_header):
+    """Streaming is opt-in on both sides: "streaming" in CONFIG and an SSE Accept header from aigrader.js.
 
+    Structured output is not streamed: the JSON object is only useful once complete.
+    Neither are tiers, which may discard the first answer, nor several samples.
+    """
+    return (bool(config.get("streaming")) and not config.get("structured_output") and not config.get("jobs")
+            and not config.get("tiers") and (config.get("samples") or 1) <= 1 and 'text/event-stream' in (accept_header or ''))
+
+def load_session(session_token, config):
+    return lti_sessions.load_session(session_token, config["session_dir"], config.get("session_backend", "auto"),
+                                     config.get("session_keys"))
+
+def empty_submission_response(data):
+    student_input = data.get('studentInput', '').strip()
+    default_value = data.get('defaultValue', '').strip()
+
+    # Verificación previa
+    clean_input = re.sub(r'\s+', '', student_input)
+    clean_default = re.sub(r'\s+', '', default_value)
+
+    if not student_input or clean_input == clean_default:
+        return {
+            'success': True,
+            'feedback': data.get('emptyErrorMsg', 'Error: Empty submission'),
+            'score_info': {'score': 0, 'max': 5},
+            'lti_notified': False
+        }
+    return None
+
+def admission_response(student_input, session_token, config):
+    """Applies the rate limits (may queue for a while). None when admitted, else a 'retry_after' response."""
+    if not config.get("rate_limits"):
+        return None
+    consumer_key = None
+    if session_token and config["rate_limits"].get("consumer"):
+        with aigrader_metrics.stage('session'):
+            consumer_key = ((load_session(session_token, config) or {}).get('lti_params') or {}).get('oauth_consumer_key')
+    try:
+        with aigrader_metrics.stage('admission'):
+            aigrader_ratelimit.admit(session_token, consumer_key, config)
+    except aigrader_ratelimit.RateLimited as e:
+        return rate_limited_response(e.retry_after)
+    return None
+
+def rate_limited_response(retry_after):
+    return {
+        'success': False, 'error': 'rate_limited', 'retry_after': retry_after,
+        'message': f"Too many requests, please try again in {retry_after} seconds"
+    }
+
+def response_status(result):
+    """HTTP status line and extra headers for a JSON response."""
+    if isinstance(result, dict) and result.get('retry_after'):
+        return '429 Too Many Requests', [('Retry-After', str(result['retry_after']))]
+    return '200 OK', []
+
+def finish_grading(feedback, session_token, config, cache_key=None, cached=False):
+    """Grade extraction, caching and LTI passback for a complete LLM answer."""
+    with aigrader_metrics.stage('grade'):
+        display_feedback, score, maximum, details = grade_feedback(feedback, config)
+    grade_sent = False
+
+    # Only well-formed answers are cached, a misformatted grade gets a fresh call next time.
+    if not cached and score is not None:
+        with aigrader_metrics.stage('cache'):
+            aigrader_cache.store(cache_key, feedback, config)
+
+    grade_queued = False
+
+    if session_token and score is not None:
+        grade_sent, grade_queued = send_grade(session_token, score, maximum, config)
+
+    aigrader_metrics.annotate(score=score, cached=cached, lti_notified=grade_sent, lti_queued=grade_queued)
+    response = {
+        'success': True, 'feedback': display_feedback,
+        'score_info': {'score': score, 'max': maximum},
+        'lti_notified': grade_sent,
+        'lti_queued': grade_queued,
+        'cached': cached
+    }
+    if details:
+        response['criteria'] = details['criteria']
+    return response
+
+def send_grade(session_token, score, maximum, config):
+    """LTI passback of a grade for the session (through the outbox when enabled): (grade_sent, grade_queued)."""
+    grade_sent = grade_queued = False
+    with aigrader_metrics.stage('session'):
+        session_data = load_session(session_token, config)
+    lti_params = (session_data or {}).get('lti_params', {})
+    if config.get("send_grade_to_lms") and lti_params:
+        passback = (
+            lti_params.get('lis_outcome_service_url'),
+            lti_params.get('lis_result_sourcedid'),
+            lti_params.get('oauth_consumer_key'),
+            score/maximum if maximum > 0 else 0,
+            config
+        )
+        with aigrader_metrics.stage('passback'):
+            if config.get("lti_outbox"):
+                grade_queued = aigrader_outbox.enqueue(*passback)
+            if not grade_queued:
+                grade_sent = send_grade_to_lti(*passback)
+    return grade_sent, grade_queued
+
+def grade_submission(data, config):
+    """Grades one decoded submission and returns the JSON-ready response dict."""
+    empty_response = empty_submission_response(data)
+    if empty_response:
+        return empty_response
+
+    student_input = data.get('studentInput', '').strip()
+    session_token = data.get('session_token') or data.get('token', '')
+    with aigrader_metrics.stage('budget'):
+        student_input, rejected, notice = aigrader_budget.preflight(student_input, config)
+    if rejected:
+        return rejected
+
+    # Identical concurrent submissions (double click, two tabs) share one grading.
+    with aigrader_singleflight.flight(student_input, session_token, config) as flight:
+        if flight.result is not None:
+            return flight.result
+        result = grade_text(student_input, session_token, config)
+        if notice:
+            result['notice'] = notice
+        flight.publish(result)
+        return result
+
+def grade_text(student_input, session_token, config):
+    """Cache, admission control, LLM call and passback for a non-empty submission."""
+    with aigrader_metrics.stage('cache'):
+        cache_key, cached_feedback = aigrader_cache.lookup(student_input, config)
+    if cached_feedback is not None:
+        return finish_grading(cached_feedback, session_token, config, cache_key, cached=True)
+    match = near_duplicate(student_input, config)
+    if match and match.feedback:
+        response = dict(finish_grading(match.feedback, session_token, config, cached=True),
+                        near_duplicate=round(match.similarity, 3))
+        index_graded(match, match.feedback, response, session_token, config)
+        return response
+
+    rejected = admission_response(student_input, session_token, config)
+    if rejected:
+        return rejected
+
+    with aigrader_metrics.stage('llm'):
         result = call_ai_api(student_input, config)
+    aigrader_metrics.annotate(provider=result.get('provider'), usage=result.get('usage'))
+    if not result.get('success'):
+        aigrader_metrics.annotate(error=result.get('error'))
+        if result.get('retry_after'):
+            return rate_limited_response(result['retry_after'])
+        return {'success': False, 'error': result.get('error')}
+    response = finish_grading(result['feedback'], session_token, config, cache_key)
+    index_graded(match, result['feedback'], response, session_token, config)
+    return response
 
-        if result.get('success'):
-            feedback = result['feedback']
-            score, maximum = extract_flexible_grade(feedback, config['grade_identifier'])
-            grade_sent = False
-
-            if session_token and score is not None:
-                token_file = f"{session_token}.json"
-                session_path = os.path.normpath(os.path.join(config["session_dir"], token_file))
-                if session_path.startswith(os.path.abspath(config["session_dir"])) and os.path.exists(session_path):
-                    with open(session_path, 'r') as f:
-                        session_data = json.load(f)
-                    lti_params = session_data.get('lti_params', {})
-                    if config.get("send_grade_to_lms") and lti_params:
-                        grade_sent = send_grade_to_lti(
-                            lti_params.get('lis_outcome_service_url'),
-                            lti_params.get('lis_result_sourcedid'),
-                            lti_params.get('oauth_consumer_key'),
-                            score/maximum if maximum > 0 else 0,
-                            config
-                        )
-
-            sys.stdout.write(json.dumps({
-                'success': True, 'feedback': feedback,
-                'score_info': {'score': score, 'max': maximum},
-                'lti_notified': grade_sent
-            }, ensure_ascii=False))
-        else:
-            sys.stdout.write(json.dumps({'success': False, 'error': result.get('error')}))
+def near_duplicate(student_input, config):
+    """Closest graded submission in the near-duplicate index (logged when it is one), or None."""
+    if not config.get("near_duplicates"):
+        return None
+    with aigrader_metrics.stage('near_duplicates'):
+        match = aigrader_duplicates.lookup(student_input, config)
+    if match and match.doc_id:
+        aigrader_metrics.annotate(near_duplicate=round(match.similarity, 3), duplicate_of=match.doc_id)
+    return match
+
+def student_ref(session_token, config):
+    """Who submitted, for the copy-detection report: the LTI user_id, else the result sourcedid.
+    Never the session token, which is a credential and stops meaning anything once the session expires."""
+    if not session_token:
+        return None
+    lti_params = (load_session(session_token, config) or {}).get('lti_params') or {}
+    return lti_params.get('user_id') or lti_params.get('lis_result_sourcedid')
+
+def index_graded(match, feedback, response, session_token, config):
+    # Only well-formed answers, as for the feedback cache. Reused ones too: the index also serves copy detection.
+    if match and response['score_info']['score'] is not None:
+        with aigrader_metrics.stage('near_duplicates'):
+            aigrader_duplicates.add(match, feedback, config, student_ref(session_token, config))
+
+def grade_submission_stream(data, config):
+    """Streaming variant of grade_submission: yields (event, payload) pairs.
 
+    'delta' events carry feedback text, 'grade' is sent as soon as the grade line is
+    complete and 'done' carries the same dict grade_submission would return.
+    """
+    empty_response = empty_submission_response(data)
+    if empty_response:
+        yield 'done', empty_response
+        return
+
+    student_input = data.get('studentInput', '').strip()
+    session_token = data.get('session_token') or data.get('token', '')
+    with aigrader_metrics.stage('budget'):
+        student_input, rejected, notice = aigrader_budget.preflight(student_input, config)
+    if rejected:
+        yield 'error', rejected
+        return
+
+    with aigrader_singleflight.flight(student_input, session_token, config) as flight:
+        if flight.result is not None:
+            if flight.result.get('feedback'):
+                yield 'delta', {'text': flight.result['feedback']}
+            yield ('done' if flight.result.get('success') else 'error'), flight.result
+            return
+        for event, payload in grade_text_stream(student_input, session_token, config):
+            if event == 'done' and notice:
+                payload['notice'] = notice
+            if event in ('done', 'error'):
+                flight.publish(payload)
+            yield event, payload
+
+def grade_text_stream(student_input, session_token, config):
+    """Streaming variant of grade_text."""
+    with aigrader_metrics.stage('cache'):
+        cache_key, cached_feedback = aigrader_cache.lookup(student_input, config)
+    if cached_feedback is not None:
+        yield 'delta', {'text': cached_feedback}
+        yield 'done', finish_grading(cached_feedback, session_token, config, cache_key, cached=True)
+        return
+    match = near_duplicate(student_input, config)
+    if match and match.feedback:
+        response = dict(finish_grading(match.feedback, session_token, config, cached=True),
+                        near_duplicate=round(match.similarity, 3))
+        index_graded(match, match.feedback, response, session_token, config)
+        yield 'delta', {'text': match.feedback}
+        yield 'done', response
+        return
+
+    rejected = admission_response(student_input, session_token, config)
+    if rejected:
+        yield 'error', rejected
+        return
+
+    parts = []
+    grade_found = False
+    started = time.monotonic()
+    try:
+        # The llm stage includes the time spent sending each delta to the browser.
+        with aigrader_metrics.stage('llm'):
+            for text in aigrader_http.iterate_sync(stream_ai_api_async(student_input, config)):
+                if not parts:
+                    aigrader_metrics.annotate(first_token_ms=round((time.monotonic() - started) * 1000, 1))
+                parts.append(text)
+                yield 'delta', {'text': text}
+                if not grade_found and '\n' in text:
+                    # The prompt puts the grade on the first line: parse it once a line is complete.
+                    so_far = ''.join(parts)
+                    score, maximum = extract_flexible_grade(so_far[:so_far.rfind('\n')], config['grade_identifier'])
+                    if score is not None:
+                        grade_found = True
+                        yield 'grade', {'score': score, 'max': maximum}
+    except aigrader_ratelimit.RateLimited as e:
+        aigrader_metrics.annotate(error='rate_limited')
+        yield 'error', rate_limited_response(e.retry_after)
+        return
     except Exception as e:
-        sys.stdout.write(json.dumps({'success': False, 'error': str(e)}))
+        aigrader_metrics.annotate(error=str(e) or e.__class__.__name__)
+        yield 'error', {'success': False, 'error': str(e) or e.__class__.__name__}
+        return
+    feedback = ''.join(parts)
+    response = finish_grading(feedback, session_token, config, cache_key)
+    index_graded(match, feedback, response, session_token, config)
+    yield 'done', response
 
-    sys.stdout.flush()
+def format_sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def process_submission(raw_data, config, request_id=None):
+    """Entry point shared by the CGI script and the persistent server (aigrader_server.py)."""
+    with aigrader_metrics.request(config, 'grade', request_id) as trace:
+        try:
+            with trace.stage('parse'):
+                data = json.loads(raw_data)
+            if config.get("jobs"):
+                # Queued for the grading workers (see aigrader_jobs.py), or a poll for a job result.
+                result = aigrader_jobs.handle(data, config)
+            else:
+                result = grade_submission(data, config)
+        except Exception as e:
+            aigrader_metrics.annotate(error=str(e))
+            result = {'success': False, 'error': str(e)}
+        trace.outcome = aigrader_metrics.outcome(result)
+        return result
 
+def process_submission_stream(raw_data, config, request_id=None):
+    """Like process_submission but yields server-sent events as text."""
+    with aigrader_metrics.request(config, 'grade_stream', request_id) as trace:
+        try:
+            with trace.stage('parse'):
+                data = json.loads(raw_data)
+        except Exception as e:
+            trace.outcome = 'error'
+            yield format_sse('error', {'success': False, 'error': str(e)})
+            return
+        for event, payload in grade_submission_stream(data, config):
+            if event in ('done', 'error'):
+                trace.outcome = aigrader_metrics.outcome(payload)
+            yield format_sse(event, payload)
+
+def run(config):
+    setup_environment(config.get("DEBUG", False))
+
+    stream = wants_stream(config, os.environ.get('HTTP_ACCEPT', ''))
+    request_id = aigrader_metrics.new_request_id(os.environ.get('HTTP_X_REQUEST_ID'))
+    headers = response_headers(config, os.environ.get('HTTP_ORIGIN', ''), stream) + [("X-Request-ID", request_id)]
+    headers_sent = []
+
+    def write_headers(extra=()):
+        # Encabezados CGI
+        headers_sent.append(True)
+        for name, value in list(extra) + list(headers):
+            sys.stdout.write(f"{name}: {value}\n")
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+
+    if os.environ.get('REQUEST_METHOD') == 'OPTIONS':
+        write_headers()
+        return
+
+    with aigrader_metrics.request(config, 'grade_stream' if stream else 'grade', request_id) as trace:
+        try:
+            with trace.stage('read'):
+                content_length = int(os.environ.get('CONTENT_LENGTH', 0))
+                raw_data = sys.stdin.read(content_length)
+            if stream:
+                write_headers()
+                for event in process_submission_stream(raw_data, config):
+                    sys.stdout.write(event)
+                    sys.stdout.flush()
+            else:
+                # Headers go out with the body so that a rejected request gets its 429 status.
+                result = process_submission(raw_data, config)
+                status, extra = response_status(result)
+                write_headers([('Status', status)] + extra)
+                sys.stdout.write(json.dumps(result, ensure_ascii=False))
+        except Exception as e:
+            trace.outcome = 'error'
+            aigrader_metrics.annotate(error=str(e))
+            if not headers_sent:
+                write_headers()
+            sys.stdout.write(json.dumps({'success': False, 'error': str(e)}))
+
+    sys.stdout.flush()
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_budget.py
+
+# Token budget of a grading. Before the LLM call (the "budget" stage) the student
+# text is compacted (runs of spaces and blank lines), its tokens are estimated
+# locally and a text over max_input_tokens is rejected with a message for the
+# student or, with "oversize_input": "trim", cut at a word boundary (only the
+# part after ####ANSWER when present) with a note telling the grader how much was
+# removed (rejected all the same when the part before ####ANSWER alone is over
+# the limit). max_output_tokens is sent to the provider (OpenAI max_tokens, Gemini
+# generationConfig.maxOutputTokens).
+#
+# The estimate needs no tokenizer download: words of up to eight characters and
+# punctuation marks count as one token, longer words as one per five characters.
+# It stays slightly above the BPE tokenizers of both providers for English and
+# Spanish text, so a budget is never exceeded by underestimating.
+#
+# CONFIG options:
+#   "max_input_tokens": 1200,              # student text (task + answer)
+#   "max_output_tokens": 1500,
+#   "oversize_input": "reject",            # or "trim"
+#
+# Histograms (metrics.db, with "metrics": True): input_tokens:<action> (estimated
+# student text, action ok, trimmed or rejected) and llm_request_tokens:<provider>|<kind>
+# (prompt and completion tokens reported by the provider for each call).
+
+import functools
+import re
+
+import aigrader_metrics
+import aigrader_store
+
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+WORD_RE = re.compile(r"\S+")
+SPACES_RE = re.compile(r"[ \t\u00a0]+")
+BLANK_LINES_RE = re.compile(r"\n\s*\n\s*\n+")
+ANSWER_MARKER = "####ANSWER"
+NOTE_TOKENS = 20   # room for the "[... N words removed ...]" note
+
+def piece_tokens(piece):
+    return 1 if len(piece) <= 8 else (len(piece) + 4) // 5
+
+def count_tokens(text):
+    """Estimated number of tokens of text."""
+    return sum(piece_tokens(piece) for piece in TOKEN_RE.findall(text or ''))
+
+@functools.lru_cache(maxsize=32)
+def count_rubric_tokens(system_instructions):
+    """count_tokens for the (static) rubric of a config, computed once."""
+    return count_tokens(system_instructions)
+
+def compact(text):
+    """Collapses runs of spaces and of blank lines, which cost tokens and say nothing."""
+    text = SPACES_RE.sub(' ', text.replace('\r\n', '\n'))
+    return BLANK_LINES_RE.sub('\n\n', text).strip()
+
+def trim(text, max_tokens):
+    """text cut at a word boundary to about max_tokens. Returns (text, words_removed), or
+    (None, 0) when the part before the answer alone does not fit."""
+    head, marker, answer = text.partition(ANSWER_MARKER)
+    if not marker:
+        head, answer = '', text
+    budget = max_tokens - count_tokens(head + marker) - NOTE_TOKENS
+    if budget <= 0:
+        return None, 0
+    words = list(WORD_RE.finditer(answer))
+    used = 0
+    end = 0
+    for kept, word in enumerate(words):
+        used += count_tokens(word.group())
+        if used > budget:
+            note = f"\n\n[... {len(words) - kept} words removed: the text exceeded the length limit]"
+            return head + marker + answer[:end] + note, len(words) - kept
+        end = word.end()
+    return text, 0
+
+def record_input(config, tokens, action):
+    aigrader_metrics.annotate(input_tokens=tokens)
+    if config.get("metrics"):
+        aigrader_store.observe(config, "input_tokens", tokens, action, aigrader_store.TOKEN_BUCKETS)
+
+def preflight(student_input, config):
+    """Applies the input budget. Returns (student_input, rejection response or None, notice or None)."""
+    if not config.get("max_input_tokens"):
+        return student_input, None, None
+    student_input = compact(student_input)
+    tokens = count_tokens(student_input)
+    limit = config["max_input_tokens"]
+    if tokens <= limit:
+        record_input(config, tokens, 'ok')
+        return student_input, None, None
+    words = len(WORD_RE.findall(student_input))
+    limit_words = int(words * limit / tokens)
+    if config.get("oversize_input") == "trim":
+        trimmed, removed = trim(student_input, limit)
+        if trimmed is not None:
+            record_input(config, tokens, 'trimmed')
+            return trimmed, None, (f"Your text is too long (about {words} words): only the first part was graded, "
+                                   f"{removed} words were left out.")
+    record_input(config, tokens, 'rejected')
+    return student_input, {
+        'success': False, 'error': 'input_too_long', 'input_tokens': tokens,
+        'message': f"Your text is too long (about {words} words). Please shorten it to at most about {limit_words} words."
+    }, None
+
+def apply_to_request(body, provider, config):
+    """Sets the output token limit on a request body built by aigrader.build_ai_request."""
+    max_output = config.get("max_output_tokens")
+    if max_output:
+        if provider == "openai":
+            body["max_tokens"] = max_output
+        else:
+            body.setdefault("generationConfig", {})["maxOutputTokens"] = max_output
+    return body
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_cache.py
+
+# Content-addressed feedback cache. The key is a hash of the normalized submission,
+# the system instructions, the model and the provider, so an identical (or
+# whitespace-only different) resubmission to the same grader reuses the feedback
+# instead of paying for another LLM call. Entries expire after a TTL and the least
+# recently used ones are evicted above max_entries.
+#
+# CONFIG options:
+#   "feedback_cache": True,
+#   "feedback_cache_ttl": 604800,          # seconds
+#   "feedback_cache_max_entries": 50000,
+
+import hashlib
+import sqlite3
+import time
+
+import aigrader_store
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 50000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS feedback_cache (
+    key TEXT PRIMARY KEY,
+    feedback TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS feedback_cache_expires ON feedback_cache (expires_at);
+CREATE INDEX IF NOT EXISTS feedback_cache_access ON feedback_cache (last_access);
+"""
+
+def normalize_submission(text):
+    """Collapses every run of whitespace, so layout-only edits map to the same key."""
+    return ' '.join((text or '').split())
+
+def cache_key(student_input, config):
+    digest = hashlib.sha256()
+    parts = [normalize_submission(student_input), config.get("system_instructions", ""),
+             config.get("model_name", ""), config.get("provider", "openai").lower()]
+    if config.get("structured_output"):
+        # JSON answers; the keys of free-text answers stay unchanged.
+        parts.append("structured:" + ",".join(config.get("structured_criteria") or ()))
+    if config.get("tiers"):
+        parts.append("tiers:" + ",".join(tier.get("model_name", "") for tier in config["tiers"]))
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+class FeedbackCache:
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    @property
+    def db(self):
+        return aigrader_store.open_db(self.path, SCHEMA)
+
+    def get(self, key):
+        now = time.time()
+        row = self.db.execute("SELECT feedback, expires_at FROM feedback_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            self.db.execute("DELETE FROM feedback_cache WHERE key = ?", (key,))
+            return None
+        self.db.execute("UPDATE feedback_cache SET last_access = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, key, feedback):
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO feedback_cache (key, feedback, created_at, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, feedback, now, now + self.ttl, now))
+        self.evict(now)
+
+    def evict(self, now=None):
+        db = self.db
+        db.execute("DELETE FROM feedback_cache WHERE expires_at < ?", (now or time.time(),))
+        excess = db.execute("SELECT COUNT(*) FROM feedback_cache").fetchone()[0] - self.max_entries
+        if excess > 0:
+            db.execute("DELETE FROM feedback_cache WHERE key IN "
+                       "(SELECT key FROM feedback_cache ORDER BY last_access LIMIT ?)", (excess,))
+
+def get_cache(config):
+    """The FeedbackCache for this config, or None when the cache is disabled."""
+    if not config.get("feedback_cache"):
+        return None
+    return FeedbackCache(aigrader_store.state_file(config, "feedback_cache.db"),
+                         config.get("feedback_cache_ttl", DEFAULT_TTL),
+                         config.get("feedback_cache_max_entries", DEFAULT_MAX_ENTRIES))
+
+def lookup(student_input, config):
+    """Returns (key, cached_feedback) and updates the hit/miss counters; (None, None) when disabled."""
+    cache = get_cache(config)
+    if cache is None:
+        return None, None
+    key = cache_key(student_input, config)
+    try:
+        feedback = cache.get(key)
+    except sqlite3.Error:
+        feedback = None
+    aigrader_store.incr_counter(config, "feedback_cache_hits" if feedback is not None else "feedback_cache_misses")
+    return key, feedback
+
+def store(key, feedback, config):
+    cache = get_cache(config)
+    if cache is None or key is None:
+        return
+    try:
+        cache.put(key, feedback)
+    except sqlite3.Error:
+        pass
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_config.py
+
+# Registry of grader configs for long-lived processes (aigrader_server.py). Each
+# config script is imported, validated and prepared (grade regex, allowed LTI
+# domains and CORS origins precompiled) once. Later lookups only stat() the script
+# and its "watch_files" (e.g. the .env file it loads), at most every
+# check_interval seconds, and re-import it when a modification time changed.
+# A config that fails to reload is reported on stderr and the previous one is kept.
+# Callers look the config up per request, and aigrader_server.py hands each new
+# CONFIG dict to the job and outbox workers; job_workers and state_dir only apply
+# after a restart.
+#
+# CONFIG options:
+#   "watch_files": ["/var/secure/aigrader.env"],   # reload the config when these change too
+
+import os
+import sys
+import threading
+import time
+
+import aigrader
+import aigrader_consistency
+import aigrader_duplicates
+import lti_sessions
+
+REQUIRED_KEYS = ("provider", "model_name", "api_key", "system_instructions", "grade_identifier", "session_dir")
+PROVIDERS = ("openai", "google")
+DEFAULT_CHECK_INTERVAL = 2.0
+
+class ConfigError(ValueError):
+    pass
+
+def validate_config(config, path=''):
+    """Raises ConfigError listing every problem found in a CONFIG dict."""
+    problems = []
+    for entry in [config] + list(config.get("providers") or []) + list(config.get("tiers") or []):
+        merged = dict(config, **entry)
+        # A local OpenAI-compatible server (api_url) may not need a key.
+        missing = [key for key in REQUIRED_KEYS if merged.get(key) in (None, '')
+                   and not (key == "api_key" and merged.get("api_url"))]
+        if missing:
+            problems.append(f"missing {', '.join(missing)}")
+        if str(merged.get("provider", "openai")).lower() not in PROVIDERS:
+            problems.append(f"unknown provider {merged.get('provider')!r}")
+    if not isinstance(config.get("grade_identifier", ''), str):
+        problems.append("grade_identifier must be a string")
+    for key in ("LTI_ALLOWED_DOMAINS", "CORS_ALLOWED_ORIGINS"):
+        if not isinstance(config.get(key, ''), str):
+            problems.append(f"{key} must be a comma separated string")
+    if config.get("send_grade_to_lms") and not config.get("lti_consumer_secrets"):
+        problems.append("send_grade_to_lms needs lti_consumer_secrets")
+    samples = config.get("samples") or 1
+    if not isinstance(samples, int) or samples < 1:
+        problems.append("samples must be a positive integer")
+    elif samples > 1 and not 1 <= config.get("sample_quorum", aigrader_consistency.DEFAULT_QUORUM) <= samples:
+        problems.append("sample_quorum must be between 1 and samples")
+    if config.get("near_duplicates"):
+        perm = config.get("near_duplicate_perm", aigrader_duplicates.DEFAULT_PERM)
+        bands = config.get("near_duplicate_bands", aigrader_duplicates.DEFAULT_BANDS)
+        if not (isinstance(perm, int) and isinstance(bands, int) and 0 < bands <= perm and perm % bands == 0):
+            problems.append("near_duplicate_perm must be a multiple of near_duplicate_bands")
+    if config.get("session_keys") or config.get("session_backend") == "signed":
+        try:
+            lti_sessions.signed_store(config.get("session_keys"))
+        except ValueError as e:
+            problems.append(f"session_keys: {e}")
+    if problems:
+        raise ConfigError(f"{path or 'CONFIG'}: " + "; ".join(dict.fromkeys(problems)))
+
+def prepare_config(config):
+    """Fills the per-config caches so the first request does not pay for them."""
+    aigrader.grade_pattern(config["grade_identifier"])
+    aigrader.allowed_domains(config.get("LTI_ALLOWED_DOMAINS", ""))
+    aigrader.cors_origins(config.get("CORS_ALLOWED_ORIGINS", "*"))
+    return config
+
+def load_validated(path):
+    config = aigrader.load_config(path)
+    validate_config(config, path)
+    return prepare_config(config)
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class _Entry:
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.files = [path] + list(config.get("watch_files") or [])
+        self.mtimes = [_mtime(f) for f in self.files]
+        self.checked = time.monotonic()
+
+class ConfigRegistry:
+    """Loaded grader configs by script path, reloaded when their files change."""
+
+    def __init__(self, check_interval=DEFAULT_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        entry = self.entries.get(path)
+        if entry is None:
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry is None:
+                    entry = self.entries[path] = _Entry(path, load_validated(path))
+            return entry.config
+        if time.monotonic() - entry.checked >= self.check_interval:
+            self._maybe_reload(entry)
+        return self.entries[path].config
+
+    def _maybe_reload(self, entry):
+        with self.lock:
+            if time.monotonic() - entry.checked < self.check_interval:
+                return
+            entry.checked = time.monotonic()
+            if [_mtime(f) for f in entry.files] == entry.mtimes:
+                return
+            try:
+                self.entries[entry.path] = _Entry(entry.path, load_validated(entry.path))
+            except Exception as e:
+                # Keep serving the previous config; retry once the files change again.
+                entry.mtimes = [_mtime(f) for f in entry.files]
+                sys.stderr.write(f"[aigrader] Could not reload {entry.path}: {e}\n")
+                sys.stderr.flush()
+
+_registry = ConfigRegistry()
+
+def get_config(path):
+    """Process-wide registry lookup."""
+    return _registry.get(path)
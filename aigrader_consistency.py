@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_consistency.py
+
+# Self-consistency grading: the same submission is graded by "samples" concurrent
+# LLM calls and the student gets the median grade, so an identical resubmission
+# no longer lands on another band by chance (and there is less reason to
+# resubmit until the grade changes).
+#  - The calls are fired together. As soon as sample_quorum answers agree on the
+#    grade (within sample_tolerance), the outstanding calls are cancelled.
+#  - After sample_max_wait seconds the grading goes ahead with the answers that
+#    arrived (it keeps waiting only while none has).
+#  - The result is the median of the grades read from the answers (the lower
+#    middle one for an even count), with the feedback of the first answer that
+#    gave that grade, so the text and the grade sent to the LMS match.
+# Answers without a readable grade do not vote; if no answer has one, the first
+# successful answer is returned as it is. Each sample goes through the usual
+# path (providers failover, tiers), so this combines with them. A config with
+# samples does not stream.
+#
+# CONFIG options:
+#   "samples": 5,                 # calls per submission (1 or None: single call)
+#   "sample_quorum": 3,           # agreeing grades that end the grading early
+#   "sample_tolerance": 0,        # grades within this many points count as agreeing
+#   "sample_max_wait": 30,        # seconds before grading with the answers received
+#
+# Counters and histograms (metrics.db, with "metrics": True): grading_samples:<outcome>,
+# the answers used per grading (outcome quorum, deadline or all) and
+# grading_samples_cancelled, the calls cancelled once the grade was decided.
+
+import asyncio
+import time
+
+import aigrader
+import aigrader_metrics
+import aigrader_store
+import aigrader_structured
+
+DEFAULT_QUORUM = 3
+DEFAULT_TOLERANCE = 0
+DEFAULT_MAX_WAIT = 30
+
+def sample_score(feedback, config):
+    """The grade of one answer, or None."""
+    if config.get("structured_output"):
+        details = aigrader_structured.parse(feedback, config)
+        if details is not None:
+            return details['overall_band']
+    return aigrader.extract_flexible_grade(feedback, config['grade_identifier'])[0]
+
+def agreeing(scores, tolerance):
+    """Largest number of grades within tolerance of one of them."""
+    return max((sum(1 for other in scores if abs(other - score) <= tolerance) for score in scores), default=0)
+
+def median_answer(answers):
+    """(score, result) of the median grade, the lower middle one for an even count."""
+    ordered = sorted(answers, key=lambda answer: answer[0])
+    score = ordered[(len(ordered) - 1) // 2][0]
+    return next(answer for answer in answers if answer[0] == score)
+
+def total_usage(results):
+    usages = [result['usage'] for result in results if result.get('usage')]
+    if not usages:
+        return None
+    return {key: sum(usage.get(key) or 0 for usage in usages) for key in ('prompt_tokens', 'completion_tokens')}
+
+async def call_consistent_async(student_input, config):
+    """call_ai_api with "samples" concurrent calls: the median grade, stopping at the first quorum."""
+    sample_config = dict(config, samples=None)
+    quorum = config.get("sample_quorum", DEFAULT_QUORUM)
+    tolerance = config.get("sample_tolerance", DEFAULT_TOLERANCE)
+    deadline = time.monotonic() + config.get("sample_max_wait", DEFAULT_MAX_WAIT)
+    pending = {asyncio.ensure_future(aigrader.call_ai_api_async(student_input, sample_config))
+               for _ in range(config["samples"])}
+    answers = []       # (score, result) of the answers with a grade, in arrival order
+    results = []       # every successful answer
+    last_error = None
+    outcome = 'all'
+    try:
+        while pending:
+            timeout = max(deadline - time.monotonic(), 0) if results else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                outcome = 'deadline'
+                break
+            for task in done:
+                result = task.result()
+                if not result.get('success'):
+                    last_error = result
+                    continue
+                results.append(result)
+                score = sample_score(result['feedback'], config)
+                if score is not None:
+                    answers.append((score, result))
+            if agreeing([score for score, _ in answers], tolerance) >= quorum:
+                outcome = 'quorum'
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+    if not results:
+        return last_error or {'success': False, 'error': 'No AI answer'}
+    score, chosen = median_answer(answers) if answers else (None, results[0])
+    if config.get("metrics"):
+        aigrader_store.observe(config, "grading_samples", len(results), outcome, aigrader_store.SAMPLE_BUCKETS)
+        if pending:
+            aigrader_store.incr_counter(config, "grading_samples_cancelled", len(pending))
+    aigrader_metrics.annotate(samples=len(results), sample_scores=[s for s, _ in answers], sample_outcome=outcome)
+    return dict(chosen, usage=total_usage(results), samples=len(results), sample_scores=[s for s, _ in answers])
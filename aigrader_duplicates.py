@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_duplicates.py
+
+# Near-duplicate index of graded submissions (MinHash + LSH). The exact feedback
+# cache only helps with identical texts; shared templates, lightly edited copies
+# of a classmate's essay and resubmissions with a few words changed are near
+# copies that would each pay for a full LLM call.
+#  - Each answer is reduced to its word shingles (near_duplicate_shingle words) and
+#    a MinHash signature of near_duplicate_perm values (one-permutation hashing:
+#    one hash per shingle, empty bins filled from their neighbours).
+#  - The signature is split into near_duplicate_bands bands; the hash of each band
+#    is a bucket of an indexed SQLite table (near_duplicates.db), so a lookup is one
+#    indexed query whatever the size of the index, followed by a comparison of the
+#    signatures of the few candidates. Graded submissions are added one by one.
+#  - Texts are compared within a scope: the same grader (system instructions,
+#    model...) and the same task, the text before the near_duplicate_marker line,
+#    which is left out of the comparison (every student's submission repeats it).
+# A submission whose estimated Jaccard similarity to an indexed one reaches
+# near_duplicate_threshold is logged (near_duplicate, duplicate_of) and counted;
+# with near_duplicate_reuse (a higher similarity) the earlier feedback and grade are
+# returned instead of calling the LLM, with "near_duplicate" in the response.
+# Answers without words (blank after the marker) are neither looked up nor indexed.
+#
+# CONFIG options:
+#   "near_duplicates": True,
+#   "near_duplicate_threshold": 0.8,        # estimated Jaccard similarity to flag a submission
+#   "near_duplicate_reuse": None,           # e.g. 0.95: reuse the earlier feedback from this similarity
+#   "near_duplicate_marker": "####ANSWER",  # only the text after this line is compared
+#   "near_duplicate_shingle": 3,            # words per shingle
+#   "near_duplicate_perm": 128,             # signature size (4 bytes each)
+#   "near_duplicate_bands": 32,             # LSH bands (near_duplicate_perm must be a multiple)
+#   "near_duplicate_max_entries": 200000,
+#
+# Counters (metrics.db): near_duplicates:<outcome> (flagged, reused or unique)
+# and the near_duplicate_lookup_seconds histogram. The index size and the
+# flagged pairs (copy detection), with the student of each submission (LTI
+# user_id, else lis_result_sourcedid):
+#   python3 aigrader_duplicates.py evaluate-certacles-writing-c1-LTI-conf.py [--pairs 50]
+
+import argparse
+import array
+import hashlib
+import re
+import sqlite3
+import sys
+import time
+
+import aigrader
+import aigrader_cache
+import aigrader_store
+
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_MARKER = "####ANSWER"
+DEFAULT_SHINGLE = 3
+DEFAULT_PERM = 128
+DEFAULT_BANDS = 32
+DEFAULT_MAX_ENTRIES = 200000
+EMPTY = 0xFFFFFFFF
+WORD_RE = re.compile(r'\w+')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    signature BLOB NOT NULL,
+    feedback TEXT,
+    duplicate_of INTEGER,
+    similarity REAL,
+    ref TEXT,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS buckets (
+    bucket INTEGER NOT NULL,
+    doc_id INTEGER NOT NULL,
+    PRIMARY KEY (bucket, doc_id)
+) WITHOUT ROWID;
+"""
+
+# 🧮 SIGNATURES
+def split_submission(text, marker=DEFAULT_MARKER):
+    """(task, answer): the text before and after the marker line, or ('', text) without it."""
+    if marker and marker in text:
+        task, _, answer = text.partition(marker)
+        return task, answer
+    return '', text
+
+def shingles(text, size=DEFAULT_SHINGLE):
+    words = WORD_RE.findall(text.lower())
+    if len(words) <= size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def signature(text, size=DEFAULT_SHINGLE, perm=DEFAULT_PERM):
+    """One-permutation MinHash: bin = hash % perm, value = hash // perm, minimum per bin."""
+    bins = [EMPTY] * perm
+    for shingle in shingles(text, size):
+        h = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+        b, value = h % perm, (h // perm) & 0xFFFFFFFE
+        if value < bins[b]:
+            bins[b] = value
+    if min(bins) == EMPTY:
+        return array.array('I', bins)
+    # Densification: an empty bin takes the value of the next filled one (circular),
+    # tagged with the distance so two texts only agree there when they agree on that bin.
+    filled = [i for i, value in enumerate(bins) if value != EMPTY]
+    if len(filled) < perm:
+        for i in range(perm):
+            if bins[i] == EMPTY:
+                j = next((k for k in filled if k > i), filled[0])
+                distance = (j - i) % perm
+                bins[i] = (bins[j] ^ (distance * 0x9E3779B1)) & 0xFFFFFFFF | 1
+    return array.array('I', bins)
+
+def similarity(a, b):
+    """Estimated Jaccard similarity of two signatures."""
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+def band_buckets(sig, scope, bands):
+    rows = len(sig) // bands
+    raw = sig.tobytes()
+    width = rows * sig.itemsize
+    buckets = []
+    for band in range(bands):
+        digest = hashlib.blake2b(raw[band * width:(band + 1) * width], digest_size=8,
+                                 key=scope[:32].encode('ascii'), salt=band.to_bytes(16, 'little'))
+        buckets.append(int.from_bytes(digest.digest(), 'little', signed=True))
+    return buckets
+
+# 🗂️ INDEX
+class DuplicateIndex:
+    def __init__(self, path, bands=DEFAULT_BANDS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.bands = bands
+        self.max_entries = max_entries
+
+    @property
+    def db(self):
+        return aigrader_store.open_db(self.path, SCHEMA)
+
+    def query(self, sig, scope):
+        """(doc_id, similarity, feedback) of the most similar indexed signature, or None."""
+        buckets = band_buckets(sig, scope, self.bands)
+        rows = self.db.execute(
+            f"SELECT DISTINCT d.id, d.signature, d.feedback FROM buckets b JOIN documents d ON d.id = b.doc_id "
+            f"WHERE b.bucket IN ({','.join('?' * len(buckets))})", buckets).fetchall()
+        best = None
+        for doc_id, blob, feedback in rows:
+            score = similarity(sig, array.array('I', blob))
+            if best is None or score > best[1]:
+                best = (doc_id, score, feedback)
+        return best
+
+    def add(self, sig, scope, feedback=None, duplicate_of=None, score=None, ref=None):
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            doc_id = db.execute("INSERT INTO documents (signature, feedback, duplicate_of, similarity, ref, created_at) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                (sig.tobytes(), feedback, duplicate_of, score, ref, time.time())).lastrowid
+            db.executemany("INSERT OR IGNORE INTO buckets (bucket, doc_id) VALUES (?, ?)",
+                           [(bucket, doc_id) for bucket in band_buckets(sig, scope, self.bands)])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        # Oldest entries go in batches, once the index is 10% over its size
+        if doc_id % 1000 == 0:
+            self.evict()
+        return doc_id
+
+    def evict(self):
+        db = self.db
+        count = db.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        if count <= self.max_entries * 1.1:
+            return 0
+        cutoff = db.execute("SELECT id FROM documents ORDER BY id LIMIT 1 OFFSET ?", (count - self.max_entries,)).fetchone()[0]
+        db.execute("DELETE FROM buckets WHERE doc_id < ?", (cutoff,))
+        return db.execute("DELETE FROM documents WHERE id < ?", (cutoff,)).rowcount
+
+def get_index(config):
+    """The DuplicateIndex for this config, or None when near_duplicates is disabled."""
+    if not config.get("near_duplicates"):
+        return None
+    return DuplicateIndex(aigrader_store.state_file(config, "near_duplicates.db"),
+                          config.get("near_duplicate_bands", DEFAULT_BANDS),
+                          config.get("near_duplicate_max_entries", DEFAULT_MAX_ENTRIES))
+
+class Match:
+    """Result of a lookup: the submission's signature, its best similarity and, above the threshold, that submission."""
+
+    def __init__(self, sig, scope, doc_id=None, score=0.0, feedback=None):
+        self.signature = sig
+        self.scope = scope
+        self.doc_id = doc_id
+        self.similarity = score
+        self.feedback = feedback
+
+def scope_for(task, config):
+    """Same grader and same task: the feedback cache key of the task text."""
+    return aigrader_cache.cache_key(task, config)
+
+def lookup(student_input, config):
+    """Match for a submission (flagged or not), or None when disabled, for an answer without
+    words (all of them would have the same empty signature) or on a database error."""
+    index = get_index(config)
+    if index is None:
+        return None
+    started = time.monotonic()
+    task, answer = split_submission(student_input, config.get("near_duplicate_marker", DEFAULT_MARKER))
+    if not WORD_RE.search(answer):
+        return None
+    sig = signature(answer, config.get("near_duplicate_shingle", DEFAULT_SHINGLE), config.get("near_duplicate_perm", DEFAULT_PERM))
+    match = Match(sig, scope_for(task, config))
+    try:
+        best = index.query(sig, match.scope)
+    except sqlite3.Error:
+        return None
+    threshold = config.get("near_duplicate_threshold", DEFAULT_THRESHOLD)
+    reuse = config.get("near_duplicate_reuse")
+    if best:
+        match.similarity = best[1]
+    if best and best[1] >= threshold:
+        match.doc_id = best[0]
+        if reuse and match.similarity >= reuse:
+            match.feedback = best[2]
+    outcome = 'reused' if match.feedback else 'flagged' if match.doc_id else 'unique'
+    if config.get("metrics"):
+        aigrader_store.incr_counter(config, f"near_duplicates:{outcome}")
+        aigrader_store.observe(config, "near_duplicate_lookup_seconds", time.monotonic() - started)
+    return match
+
+def add(match, feedback, config, ref=None):
+    """Indexes a graded submission (its feedback is kept only when reuse is enabled)."""
+    index = get_index(config)
+    if index is None or match is None:
+        return
+    try:
+        index.add(match.signature, match.scope, feedback if config.get("near_duplicate_reuse") else None,
+                  match.doc_id, match.similarity if match.doc_id else None, ref)
+    except sqlite3.Error:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Size of the near-duplicate index of a grader config and its flagged pairs.")
+    parser.add_argument('config', help="Grader config script with \"near_duplicates\": True")
+    parser.add_argument('--pairs', type=int, default=20, help="Most recent flagged pairs to list")
+    args = parser.parse_args()
+
+    config = aigrader.load_config(args.config)
+    index = get_index(dict(config, near_duplicates=True))
+    db = index.db
+    documents, flagged = db.execute("SELECT COUNT(*), COUNT(duplicate_of) FROM documents").fetchone()
+    buckets = db.execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+    sys.stdout.write(f"{index.path}: {documents} submissions, {buckets} buckets, {flagged} near duplicates\n")
+    rows = db.execute("SELECT id, duplicate_of, similarity, ref, created_at FROM documents WHERE duplicate_of IS NOT NULL "
+                      "ORDER BY id DESC LIMIT ?", (args.pairs,))
+    for doc_id, duplicate_of, score, ref, created_at in rows:
+        when = time.strftime('%Y-%m-%d %H:%M', time.localtime(created_at))
+        sys.stdout.write(f"  {when}  #{doc_id} ~ #{duplicate_of}  {score:.2f}  {ref or ''}\n")
+
+if __name__ == "__main__":
+    main()
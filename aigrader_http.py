@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_http.py
+
+# Minimal asyncio HTTP/1.1 client with per-host keep-alive connection pools.
+# All coroutines run on one shared event loop (started in a daemon thread on first
+# use), so every caller in the process multiplexes its requests to the LLM
+# providers and LMS outcome services over the same pooled TCP+TLS connections.
+# Synchronous code (the CGI entry point, WSGI worker threads) uses run_sync().
+
+import asyncio
+import contextvars
+import queue
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+DEFAULT_MAX_PER_HOST = 100
+DEFAULT_IDLE_TIMEOUT = 60
+
+class HTTPError(Exception):
+    def __init__(self, status, reason, body=b''):
+        super().__init__(f"HTTP Error {status}: {reason}")
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+class Response:
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def text(self):
+        return self.body.decode('utf-8')
+
+    def raise_for_status(self):
+        if not 200 <= self.status < 300:
+            raise HTTPError(self.status, self.reason, self.body)
+        return self
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+class ConnectionPool:
+    """Idle keep-alive connections for one (scheme, host, port), bounded by a semaphore."""
+
+    def __init__(self, scheme, host, port, ssl_context, max_size, idle_timeout):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.idle = []
+        self.idle_timeout = idle_timeout
+        self.slots = asyncio.Semaphore(max_size)
+
+    async def acquire(self):
+        while self.idle:
+            conn = self.idle.pop()
+            if time.monotonic() - conn.last_used < self.idle_timeout and not conn.reader.at_eof():
+                conn.reused = True
+                return conn
+            conn.close()
+        tls = self.ssl_context if self.scheme == 'https' else None
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=tls, server_hostname=self.host if tls else None)
+        return _Connection(reader, writer)
+
+    def release(self, conn, reusable):
+        if reusable:
+            conn.last_used = time.monotonic()
+            self.idle.append(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+class AsyncHTTPClient:
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl.create_default_context()
+        self.pools = {}
+
+    def pool_for(self, scheme, host, port):
+        key = (scheme, host, port)
+        if key not in self.pools:
+            self.pools[key] = ConnectionPool(scheme, host, port, self.ssl_context, self.max_per_host, self.idle_timeout)
+        return self.pools[key]
+
+    async def request(self, method, url, body=None, headers=None, timeout=120):
+        """Sends one request and returns a Response with the whole body read."""
+        return await asyncio.wait_for(self._request(method, url, body, headers or {}), timeout)
+
+    async def _request(self, method, url, body, headers):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported URL scheme: {parts.scheme}")
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        target = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        pool = self.pool_for(parts.scheme, parts.hostname, port)
+
+        async with pool.slots:
+            for attempt in (1, 2):
+                conn = await pool.acquire()
+                try:
+                    self._write_request(conn, method, target, parts.netloc, headers, body)
+                    await conn.writer.drain()
+                    status, reason, resp_headers = await self._read_head(conn.reader)
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    conn.close()
+                    # A reused keep-alive socket may have been closed by the server meanwhile.
+                    if conn.reused and attempt == 1:
+                        continue
+                    raise ConnectionError(f"Connection to {parts.hostname} failed: {e}") from e
+                except BaseException:
+                    conn.close()
+                    raise
+                try:
+                    resp_body, reusable = await self._read_body(conn.reader, status, resp_headers, method)
+                except BaseException:
+                    conn.close()
+                    raise
+                pool.release(conn, reusable and resp_headers.get('connection', '').lower() != 'close')
+                return Response(status, reason, resp_headers, resp_body)
+
+    async def stream(self, method, url, body=None, headers=None, timeout=120):
+        """Async generator yielding the response body as it arrives (for SSE / streaming APIs).
+
+        timeout bounds the wait for the response headers and then for each chunk.
+        """
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        target = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        pool = self.pool_for(parts.scheme, parts.hostname, port)
+
+        async with pool.slots:
+            conn = await pool.acquire()
+            reusable = False
+            try:
+                self._write_request(conn, method, target, parts.netloc, headers or {}, body)
+                await conn.writer.drain()
+                status, reason, resp_headers = await asyncio.wait_for(self._read_head(conn.reader), timeout)
+                if not 200 <= status < 300:
+                    error_body, _ = await asyncio.wait_for(self._read_body(conn.reader, status, resp_headers, method), timeout)
+                    raise HTTPError(status, reason, error_body)
+                if 'chunked' in resp_headers.get('transfer-encoding', '').lower():
+                    chunks = self._iter_chunked(conn.reader)
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+                        except StopAsyncIteration:
+                            break
+                        yield chunk
+                    reusable = resp_headers.get('connection', '').lower() != 'close'
+                else:
+                    remaining = int(resp_headers['content-length']) if 'content-length' in resp_headers else None
+                    while remaining is None or remaining > 0:
+                        chunk = await asyncio.wait_for(conn.reader.read(65536 if remaining is None else min(65536, remaining)), timeout)
+                        if not chunk:
+                            break
+                        if remaining is not None:
+                            remaining -= len(chunk)
+                        yield chunk
+                    reusable = remaining == 0 and resp_headers.get('connection', '').lower() != 'close'
+            finally:
+                pool.release(conn, reusable)
+
+    def _write_request(self, conn, method, target, host, headers, body):
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {host}", "Connection: keep-alive", "Accept-Encoding: identity"]
+        for name, value in headers.items():
+            lines.append(f"{name}: {value}")
+        if body is not None or method in ('POST', 'PUT', 'PATCH'):
+            lines.append(f"Content-Length: {len(body or b'')}")
+        conn.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+
+    async def _read_head(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by server")
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if version == 'HTTP/1.0' and headers.get('connection', '').lower() != 'keep-alive':
+            headers['connection'] = 'close'
+        return int(status), reason, headers
+
+    async def _read_body(self, reader, status, headers, method):
+        """Returns (body, connection_reusable)."""
+        if method == 'HEAD' or 100 <= status < 200 or status in (204, 304):
+            return b'', True
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            chunks = []
+            async for chunk in self._iter_chunked(reader):
+                chunks.append(chunk)
+            return b''.join(chunks), True
+        if 'content-length' in headers:
+            return await reader.readexactly(int(headers['content-length'])), True
+        # No length: the body ends when the server closes the connection (RFC 9112 6.3),
+        # even without Connection: close. request() bounds the wait with its timeout.
+        return await reader.read(), False
+
+    async def _iter_chunked(self, reader):
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                # Trailers (if any) end with an empty line.
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            chunk = await reader.readexactly(size)
+            await reader.readexactly(2)
+            yield chunk
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+        self.pools.clear()
+
+# 🔁 SHARED EVENT LOOP
+_loop = None
+_client = None
+_lock = threading.Lock()
+
+def get_loop():
+    global _loop, _client
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='aigrader-http', daemon=True).start()
+            _client = AsyncHTTPClient()
+            _loop = loop
+    return _loop
+
+def get_client():
+    """The process-wide client; only use it from coroutines running on get_loop()."""
+    get_loop()
+    return _client
+
+async def _in_context(coro, context):
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+def submit(coro):
+    """Schedules a coroutine on the shared loop and returns a concurrent.futures.Future.
+
+    The caller's context variables (e.g. the request being traced) follow the coroutine.
+    """
+    return asyncio.run_coroutine_threadsafe(_in_context(coro, contextvars.copy_context()), get_loop())
+
+def iterate_sync(agen, timeout=None):
+    """Consumes an async generator on the shared loop from synchronous code, item by item."""
+    items = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in agen:
+                items.put(item)
+        except BaseException as e:
+            items.put(e)
+        finally:
+            items.put(done)
+
+    future = submit(pump())
+    try:
+        while True:
+            item = items.get(timeout=timeout)
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        future.cancel()
+
+def run_sync(coro, timeout=None):
+    """Runs a coroutine on the shared loop and blocks the calling thread until it finishes."""
+    return submit(coro).result(timeout)
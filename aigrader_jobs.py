@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_jobs.py
+
+# Asynchronous grading jobs. With "jobs": True a submission is stored in a queue
+# (jobs.db in state_dir) and answered at once with a job ID; grading workers take
+# the jobs in priority order and aigrader.js polls for the result with
+# {"job_id": ..., "session_token": ..., "wait": 25} on the same URL (long poll: the
+# request returns as soon as the job finishes, or after "wait" seconds).
+#
+#  - Jobs survive restarts: a job whose worker died is taken again once its lease
+#    expires (up to job_max_attempts times). A worker that finishes after losing its
+#    lease (the job was taken again) drops its result and does not send the grade.
+#  - The job keeps the LTI session token, so the grade is sent to the LMS even if
+#    the student closed the tab.
+#  - Lanes: submissions of an LTI session with an outcome service (graded attempts)
+#    go to the "lti" lane, the others to "practice"; lower priority numbers are
+#    served first, FIFO inside a lane.
+#  - A job held back by the rate limits goes back to the queue until Retry-After
+#    instead of answering 429.
+#
+# aigrader_server.py starts the workers itself. CGI deployments run them as a
+# service:
+#   python3 /usr/lib/cgi-bin/aigrader_jobs.py /usr/lib/cgi-bin/evaluate-certacles-writing-c1-LTI-conf.py
+#
+# CONFIG options:
+#   "jobs": True,
+#   "job_workers": 4,                      # grading threads per worker process
+#   "job_lanes": {"lti": 0, "practice": 1},   # lane priorities
+#   "job_lease": 300,                      # seconds before a running job is considered lost
+#   "job_max_attempts": 3,
+#   "job_poll_wait": 25,                   # longest long poll, in seconds
+#   "job_ttl": 3600,                       # seconds a finished result can be fetched
+#   "job_interval": 1,                     # idle worker poll interval, in seconds
+#
+# Counters (metrics.db): jobs_enqueued:<lane>, jobs_finished:<lane>|<outcome>,
+# jobs_requeued, jobs_lost, jobs_stale (results dropped after a lost lease); histogram job_wait_seconds:<lane> (time in the queue).
+
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+import aigrader
+import aigrader_budget
+import aigrader_metrics
+import aigrader_store
+
+DEFAULT_LANES = {"lti": 0, "practice": 1}
+DEFAULT_LEASE = 300
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_WAIT = 25
+DEFAULT_TTL = 3600
+POLL_INTERVAL = 0.25
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    lane TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    session_token TEXT NOT NULL DEFAULT '',
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    leased_until REAL NOT NULL DEFAULT 0,
+    result TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created_at);
+"""
+
+# Wakes up the workers and long polls of this process; other processes poll jobs.db.
+_changed = threading.Condition()
+
+def jobs_db(config):
+    return aigrader_store.open_db(aigrader_store.state_file(config, "jobs.db"), SCHEMA)
+
+def _notify():
+    with _changed:
+        _changed.notify_all()
+
+def _wait_change(timeout):
+    with _changed:
+        _changed.wait(timeout)
+
+def lane_for(session_token, config):
+    """'lti' when the grade of this session goes back to the LMS, else 'practice'."""
+    if session_token and config.get("send_grade_to_lms"):
+        lti_params = (aigrader.load_session(session_token, config) or {}).get('lti_params') or {}
+        if lti_params.get('lis_outcome_service_url') and lti_params.get('lis_result_sourcedid'):
+            return 'lti'
+    return 'practice'
+
+# 📥 QUEUE
+def enqueue(data, config):
+    """Stores a submission and returns the queued-job response."""
+    session_token = data.get('session_token') or data.get('token') or ''
+    lane = lane_for(session_token, config)
+    priority = (config.get("job_lanes") or DEFAULT_LANES).get(lane, 0)
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    db = jobs_db(config)
+    db.execute("INSERT INTO jobs (id, lane, priority, session_token, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+               (job_id, lane, priority, session_token, json.dumps(data, ensure_ascii=False), now))
+    db.execute("DELETE FROM jobs WHERE finished_at < ?", (now - config.get("job_ttl", DEFAULT_TTL),))
+    aigrader_store.incr_counter(config, f"jobs_enqueued:{lane}")
+    aigrader_metrics.annotate(job_id=job_id, lane=lane)
+    _notify()
+    return status_response(config, job_id)
+
+def claim(config):
+    """Leases the next due job: (id, lane, session_token, payload, attempts, created_at) or None."""
+    db = jobs_db(config)
+    now = time.time()
+    lease = config.get("job_lease", DEFAULT_LEASE)
+    max_attempts = config.get("job_max_attempts", DEFAULT_MAX_ATTEMPTS)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        # Running jobs past their lease lost their worker: queue them again or give up.
+        lost = db.execute("SELECT id, lane, attempts FROM jobs WHERE status = 'running' AND leased_until < ?", (now,)).fetchall()
+        for job_id, lane, attempts in lost:
+            if attempts >= max_attempts:
+                db.execute("UPDATE jobs SET status = 'failed', result = ?, finished_at = ? WHERE id = ?",
+                           (json.dumps({'success': False, 'error': 'Grading worker lost'}), now, job_id))
+                aigrader_store.incr_counter(config, f"jobs_finished:{lane}|lost")
+            else:
+                db.execute("UPDATE jobs SET status = 'queued' WHERE id = ?", (job_id,))
+            aigrader_store.incr_counter(config, "jobs_lost")
+        row = db.execute(
+            """SELECT id, lane, session_token, payload, attempts, created_at FROM jobs
+               WHERE status = 'queued' AND not_before <= ? ORDER BY priority, created_at LIMIT 1""", (now,)).fetchone()
+        if row:
+            db.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, leased_until = ?, started_at = ? WHERE id = ?",
+                       (now + lease, now, row[0]))
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    return row
+
+# A worker only writes to a job while it holds the lease of its attempt: the job may
+# have been declared lost and claimed again by another worker in the meantime.
+def renew(config, job_id, attempt):
+    """Extends the lease of this attempt (before the passback). False when it was lost."""
+    return jobs_db(config).execute(
+        "UPDATE jobs SET leased_until = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+        (time.time() + config.get("job_lease", DEFAULT_LEASE), job_id, attempt)).rowcount == 1
+
+def complete(config, job_id, attempt, result):
+    """Stores the result of this attempt. False when its lease was lost (the result is dropped)."""
+    done = jobs_db(config).execute(
+        "UPDATE jobs SET status = ?, result = ?, finished_at = ?, leased_until = 0 "
+        "WHERE id = ? AND status = 'running' AND attempts = ?",
+        ('done' if result.get('success') else 'failed', json.dumps(result, ensure_ascii=False),
+         time.time(), job_id, attempt)).rowcount == 1
+    _notify()
+    return done
+
+def requeue(config, job_id, attempt, delay):
+    """Puts a job held back by the rate limits back in the queue, without counting the attempt."""
+    jobs_db(config).execute(
+        "UPDATE jobs SET status = 'queued', attempts = attempts - 1, not_before = ?, leased_until = 0 "
+        "WHERE id = ? AND status = 'running' AND attempts = ?",
+        (time.time() + delay, job_id, attempt))
+    aigrader_store.incr_counter(config, "jobs_requeued")
+
+def position(config, job_id):
+    """1-based place of a queued job in the order the workers take them."""
+    row = jobs_db(config).execute(
+        """SELECT COUNT(*) FROM jobs AS ahead, jobs AS job WHERE job.id = ? AND ahead.status = 'queued'
+           AND (ahead.priority < job.priority OR (ahead.priority = job.priority AND ahead.created_at <= job.created_at))""",
+        (job_id,)).fetchone()
+    return row[0]
+
+# 🔎 POLLING
+def status_response(config, job_id, session_token=None):
+    row = jobs_db(config).execute("SELECT status, session_token, result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    # Only the session that submitted the job can read it.
+    if row is None or (session_token is not None and row[1] != session_token):
+        return {'success': False, 'error': 'Unknown job', 'job_id': job_id}
+    status, _, result = row
+    if status in ('done', 'failed'):
+        return dict(json.loads(result), job_id=job_id, status=status)
+    response = {'success': True, 'job_id': job_id, 'status': status}
+    if status == 'queued':
+        response['position'] = position(config, job_id)
+    return response
+
+def poll(data, config):
+    """Status of a job; with "wait" it is held until the job finishes (at most job_poll_wait seconds)."""
+    job_id = str(data.get('job_id'))
+    session_token = data.get('session_token') or data.get('token') or ''
+    try:
+        wait = min(float(data.get('wait') or 0), config.get("job_poll_wait", DEFAULT_POLL_WAIT))
+    except (TypeError, ValueError):
+        wait = 0
+    deadline = time.monotonic() + wait
+    with aigrader_metrics.stage('poll'):
+        while True:
+            response = status_response(config, job_id, session_token)
+            if response.get('status') not in ('queued', 'running') or time.monotonic() >= deadline:
+                aigrader_metrics.annotate(job_id=job_id, job_status=response.get('status'))
+                return response
+            _wait_change(min(POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+
+def handle(data, config):
+    """Job-mode entry point: a poll when the body has a job_id, else a new job."""
+    if data.get('job_id'):
+        return poll(data, config)
+    rejected = aigrader_budget.preflight(data.get('studentInput', '').strip(), config)[1]
+    return aigrader.empty_submission_response(data) or rejected or enqueue(data, config)
+
+# 🏭 WORKERS
+def pass_back(config, job_id, attempt, session_token, result):
+    """Sends the grade once the attempt is known to still hold its lease; updates the result."""
+    score_info = result.get('score_info') or {}
+    if not (config.get("send_grade_to_lms") and session_token and score_info.get('score') is not None):
+        return True
+    if not renew(config, job_id, attempt):
+        return False
+    grade_sent, grade_queued = aigrader.send_grade(session_token, score_info['score'], score_info['max'], config)
+    result.update(lti_notified=grade_sent, lti_queued=grade_queued)
+    return True
+
+def run_job(config, row):
+    job_id, lane, session_token, payload, attempts, created_at = row
+    attempt = attempts + 1       # claim() counted this attempt
+    waited = time.time() - created_at
+    if config.get("metrics"):
+        aigrader_store.observe(config, "job_wait_seconds", waited, lane)
+    with aigrader_metrics.request(config, 'job', job_id) as trace:
+        aigrader_metrics.annotate(job_id=job_id, lane=lane, queued_ms=round(waited * 1000, 1))
+        try:
+            # The grade is sent afterwards, by pass_back, only if this worker still holds the job.
+            result = aigrader.grade_submission(json.loads(payload), dict(config, send_grade_to_lms=False))
+            if result.get('success') and not pass_back(config, job_id, attempt, session_token, result):
+                result = None
+        except Exception as e:
+            aigrader_metrics.annotate(error=str(e))
+            result = {'success': False, 'error': str(e)}
+        if result is not None:
+            trace.outcome = aigrader_metrics.outcome(result)
+    if result is not None and result.get('retry_after'):
+        requeue(config, job_id, attempt, result['retry_after'])
+        return
+    if result is None or not complete(config, job_id, attempt, result):
+        aigrader_store.incr_counter(config, "jobs_stale")
+        return
+    aigrader_store.incr_counter(config, f"jobs_finished:{lane}|{'ok' if result.get('success') else 'error'}")
+
+def run_worker(config, stop_event=None):
+    path = aigrader_store.state_file(config, "jobs.db")
+    while not (stop_event and stop_event.is_set()):
+        # The CONFIG of the last start_background_workers() call: a reloaded script applies to the next job.
+        config = _configs.get(path, config)
+        interval = config.get("job_interval", 1)
+        try:
+            row = claim(config)
+        except sqlite3.Error as e:
+            aigrader.log_debug(f"Job queue error: {e}", config)
+            row = None
+        if row:
+            run_job(config, row)
+        else:
+            _wait_change(interval)
+
+_workers = {}
+_configs = {}
+_workers_lock = threading.Lock()
+
+def start_background_workers(config):
+    """Starts job_workers daemon threads per jobs.db file (used by aigrader_server.py). Called
+    again with a reloaded CONFIG, the running workers switch to it (job_workers needs a restart)."""
+    path = aigrader_store.state_file(config, "jobs.db")
+    with _workers_lock:
+        _configs[path] = config
+        if path not in _workers:
+            _workers[path] = []
+            for number in range(config.get("job_workers", 4)):
+                thread = threading.Thread(target=run_worker, args=(config,), name=f'aigrader-job-{number}', daemon=True)
+                thread.start()
+                _workers[path].append(thread)
+    return _workers[path]
+
+def queue_counts(config):
+    return dict(jobs_db(config).execute("SELECT lane || ':' || status, COUNT(*) FROM jobs GROUP BY lane, status").fetchall())
+
+def main():
+    parser = argparse.ArgumentParser(description="Grading workers for the asynchronous job queue of one or more grader configs.")
+    parser.add_argument('configs', nargs='+', help="Grader config scripts")
+    parser.add_argument('--status', action='store_true', help="Print the jobs per lane and status and exit")
+    args = parser.parse_args()
+
+    configs = [aigrader.load_config(path) for path in args.configs]
+    if args.status:
+        for config in configs:
+            sys.stdout.write(json.dumps(queue_counts(config)) + "\n")
+        return
+    threads = [thread for config in configs for thread in start_background_workers(config)]
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_metrics.py
+
+# Observability: per-stage timings, Prometheus metrics and structured request logs.
+#
+#  - Every request (aigrader.run, aigrader_server.py, lti-receiver.py) gets a request
+#    ID (the proxy's X-Request-ID when it sends a valid one), returned in the
+#    X-Request-ID response header.
+#  - The time spent in each stage (read, parse, cache, admission, llm, grade,
+#    session, passback...) goes to the stage_seconds histogram and the whole request
+#    to request_seconds, in metrics.db next to the other counters and histograms.
+#  - One JSON log line per request with its ID, outcome, stage timings, provider
+#    and tokens. LTI passback errors are logged with the same ID.
+#  - Activities served as tenants (aigrader_tenants.py) have their own metrics.db
+#    and their samples carry a tenant label; their log lines a "tenant" field.
+#  - Everything in metrics.db is exported in Prometheus text format: GET /metrics
+#    on aigrader_server.py, or a textfile-collector file for CGI installs (cron):
+#      python3 aigrader_metrics.py --config evaluate-certacles-writing-c1-LTI-conf.py \
+#          --textfile /var/lib/node_exporter/textfile_collector/aigrader.prom
+#
+# CONFIG options:
+#   "metrics": True,                       # stage histograms, LLM token and passback counters
+#   "request_log": "stderr",               # or a file path: one JSON line per request
+
+import argparse
+import contextlib
+import contextvars
+import datetime
+import json
+import math
+import os
+import re
+import sqlite3
+import sys
+import time
+import uuid
+
+import aigrader_store
+
+PREFIX = "aigrader_"
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+# Label names of labelled counters ("name:value1|value2") and histograms (labels "value1|value2").
+LABELS = {
+    'grade_parse': ('mode', 'outcome'),
+    'grading_samples': ('outcome',),
+    'input_tokens': ('action',),
+    'job_wait_seconds': ('lane',),
+    'jobs_enqueued': ('lane',),
+    'jobs_finished': ('lane', 'outcome'),
+    'llm_request_tokens': ('provider', 'kind'),
+    'llm_requests': ('provider', 'outcome'),
+    'llm_prompt_tokens': ('provider',),
+    'llm_completion_tokens': ('provider',),
+    'lti_passback': ('outcome',),
+    'lti_passback_verify': ('outcome',),
+    'near_duplicates': ('outcome',),
+    'provider_errors': ('provider',),
+    'provider_latency_seconds': ('provider',),
+    'rate_limit_rejected': ('scope',),
+    'request_seconds': ('kind', 'outcome'),
+    'stage_seconds': ('kind', 'stage'),
+    'tier_calls': ('tier', 'outcome'),
+    'tier_escalations': ('tier', 'reason'),
+    'tier_latency_seconds': ('tier',),
+}
+
+# Histograms that are not latencies in seconds.
+BUCKETS = {
+    'grading_samples': aigrader_store.SAMPLE_BUCKETS,
+    'input_tokens': aigrader_store.TOKEN_BUCKETS,
+    'llm_request_tokens': aigrader_store.TOKEN_BUCKETS,
+}
+
+_current = contextvars.ContextVar('aigrader_request', default=None)
+
+# 🧭 REQUEST TRACING
+def new_request_id(candidate=None):
+    if candidate and REQUEST_ID_RE.match(candidate):
+        return candidate
+    return uuid.uuid4().hex[:16]
+
+class RequestTrace:
+    """Stage timings and log fields of one request."""
+
+    def __init__(self, config, kind, request_id=None):
+        self.config = config
+        self.kind = kind
+        self.request_id = new_request_id(request_id)
+        self.started = time.monotonic()
+        self.stages = {}
+        self.fields = {'tenant': config["tenant"]} if config.get("tenant") else {}
+        self.outcome = 'ok'
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.monotonic() - started
+
+    def finish(self):
+        elapsed = time.monotonic() - self.started
+        if self.config.get("metrics"):
+            observations = [("stage_seconds", seconds, f"{self.kind}|{name}") for name, seconds in self.stages.items()]
+            observations.append(("request_seconds", elapsed, f"{self.kind}|{self.outcome}"))
+            aigrader_store.observe_many(self.config, observations)
+        log_event(self.config, self.kind, request_id=self.request_id, outcome=self.outcome,
+                  duration_ms=round(elapsed * 1000, 1),
+                  stages_ms={name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+                  **self.fields)
+
+@contextlib.contextmanager
+def request(config, kind, request_id=None):
+    """Traces the enclosed block as one request; stage() and annotate() apply to it.
+
+    Nested calls join the request already being traced.
+    """
+    if _current.get() is not None:
+        yield _current.get()
+        return
+    trace = RequestTrace(config, kind, request_id)
+    token = _current.set(trace)
+    try:
+        yield trace
+    except GeneratorExit:
+        trace.outcome = 'disconnected'
+        raise
+    except BaseException:
+        trace.outcome = 'exception'
+        raise
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            pass
+        trace.finish()
+
+def current():
+    return _current.get()
+
+@contextlib.contextmanager
+def stage(name):
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    with trace.stage(name):
+        yield
+
+def annotate(**fields):
+    """Adds fields to the log line of the current request."""
+    trace = _current.get()
+    if trace is not None:
+        trace.fields.update(fields)
+
+def outcome(result):
+    if not isinstance(result, dict):
+        return 'error'
+    if result.get('retry_after'):
+        return 'rate_limited'
+    return 'ok' if result.get('success') else 'error'
+
+# 📝 STRUCTURED LOGS
+def log_event(config, event, **fields):
+    """Writes one JSON line to config["request_log"] ("stderr" or a file path)."""
+    destination = config.get("request_log")
+    if not destination:
+        return
+    trace = _current.get()
+    record = {'ts': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'), 'event': event}
+    if trace is not None:
+        record['request_id'] = trace.request_id
+    record.update(fields)
+    line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+    try:
+        if destination == "stderr":
+            sys.stderr.write(line)
+            sys.stderr.flush()
+        else:
+            with open(destination, 'a', encoding='utf-8') as f:
+                f.write(line)
+    except OSError:
+        pass
+
+# 📊 COUNTERS
+def count(config, name, amount=1):
+    if config.get("metrics"):
+        aigrader_store.incr_counter(config, name, amount)
+
+def record_llm_call(config, provider, ok, usage=None):
+    """Request outcome and token counters of one provider call."""
+    trace = _current.get()
+    if trace is not None:
+        # Every call of the request (tiers, samples, failover), not only the one that answered
+        tokens = trace.fields.setdefault('llm_calls', {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0})
+        tokens['calls'] += 1
+        for key in ('prompt_tokens', 'completion_tokens'):
+            tokens[key] += (usage or {}).get(key) or 0
+    if not config.get("metrics"):
+        return
+    aigrader_store.incr_counter(config, f"llm_requests:{provider}|{'ok' if ok else 'error'}")
+    if usage:
+        aigrader_store.incr_counter(config, f"llm_prompt_tokens:{provider}", usage.get('prompt_tokens') or 0)
+        aigrader_store.incr_counter(config, f"llm_completion_tokens:{provider}", usage.get('completion_tokens') or 0)
+        # Tokens per call, for capacity planning (token buckets, not the latency ones)
+        aigrader_store.observe_many(config, [
+            ("llm_request_tokens", usage.get('prompt_tokens') or 0, f"{provider}|prompt"),
+            ("llm_request_tokens", usage.get('completion_tokens') or 0, f"{provider}|completion"),
+        ], aigrader_store.TOKEN_BUCKETS)
+
+# 📈 PROMETHEUS EXPOSITION
+def metric_name(base, suffix=''):
+    return PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', base) + suffix
+
+def label_pairs(base, value, extra):
+    names = LABELS.get(base, ('label',))
+    values = value.split('|') if value else []
+    return list(extra) + list(zip(names, values))
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def collect(config, extra_labels=()):
+    """{family: (type, [(sample, label_pairs, value), ...])} for the counters and histograms in metrics.db."""
+    families = {}
+    for name, value in aigrader_store.read_counters(config).items():
+        base, _, label = name.partition(':')
+        family = metric_name(base, '_total')
+        families.setdefault(family, ('counter', []))[1].append((family, label_pairs(base, label, extra_labels), value))
+    series = aigrader_store.metrics_db(config).execute("SELECT name, labels FROM histogram_totals ORDER BY name, labels").fetchall()
+    for name, labels in series:
+        rows, total, total_sum = aigrader_store.read_histogram(config, name, labels)
+        family = metric_name(name)
+        samples = families.setdefault(family, ('histogram', []))[1]
+        pairs = label_pairs(name, labels, extra_labels)
+        counts = dict(rows)
+        cumulative = 0
+        for bound in sorted(set(BUCKETS.get(name, aigrader_store.LATENCY_BUCKETS)) | {b for b in counts if b != math.inf}):
+            cumulative += counts.get(bound, 0)
+            samples.append((family + '_bucket', pairs + [('le', format_value(float(bound)))], cumulative))
+        samples.append((family + '_bucket', pairs + [('le', '+Inf')], total))
+        samples.append((family + '_sum', pairs, total_sum))
+        samples.append((family + '_count', pairs, total))
+    return families
+
+def render(configs):
+    """Prometheus text exposition for the metrics.db of each config (one per distinct state_dir or tenant)."""
+    databases = {}
+    for config in configs:
+        databases.setdefault(aigrader_store.state_file(config, "metrics.db"), config)
+    merged = {}
+    for path, config in databases.items():
+        if config.get("tenant"):
+            extra = [('tenant', config["tenant"])]
+        else:
+            extra = [('state_dir', os.path.dirname(path))] if len(databases) > 1 else []
+        try:
+            families = collect(config, extra)
+        except sqlite3.Error:
+            continue
+        for family, (kind, samples) in families.items():
+            merged.setdefault(family, (kind, []))[1].extend(samples)
+    lines = []
+    for family in sorted(merged):
+        kind, samples = merged[family]
+        lines.append(f"# TYPE {family} {kind}")
+        lines.extend(f"{name}{format_labels(pairs)} {format_value(value)}" for name, pairs, value in samples)
+    return "\n".join(lines) + "\n"
+
+def write_textfile(text, path):
+    """Atomic write, as the node_exporter textfile collector expects."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def main():
+    import aigrader
+
+    parser = argparse.ArgumentParser(description="Export aigrader metrics in Prometheus text format.")
+    parser.add_argument('--config', action='append', required=True, help="Grader config script (repeatable)")
+    parser.add_argument('--textfile', help="Write to this .prom file instead of stdout")
+    parser.add_argument('--interval', type=float, help="Keep rewriting the file every N seconds")
+    args = parser.parse_args()
+
+    configs = [aigrader.load_config(path) for path in args.config]
+    while True:
+        text = render(configs)
+        if args.textfile:
+            write_textfile(text, args.textfile)
+        else:
+            sys.stdout.write(text)
+        if not args.interval:
+            return
+        time.sleep(args.interval)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_outbox.py
+
+# Durable outbox for LTI grade passback. With "lti_outbox": True the grading request
+# only records the grade in a local SQLite file and answers at once with
+# 'lti_queued'; a worker drains the outbox in the background with exponential
+# backoff. There is one row per lis_result_sourcedid, so a newer grade replaces
+# an older one that was not sent yet and only the latest score reaches the LMS.
+#
+# CGI deployments run the worker as a service (the persistent server starts it
+# by itself):
+#   python3 /usr/lib/cgi-bin/aigrader_outbox.py /usr/lib/cgi-bin/evaluate-certacles-writing-c1-LTI-conf.py
+#
+# CONFIG options:
+#   "lti_outbox": True,
+#   "lti_outbox_max_attempts": 12,        # Then the row is kept with status 'failed'
+#   "lti_outbox_backoff": 30,             # First retry delay in seconds, doubled each attempt
+#   "lti_outbox_max_backoff": 3600,
+#   "lti_outbox_host_concurrency": 4,     # Parallel passbacks per LMS host
+#   "lti_outbox_interval": 5,             # Worker poll interval in seconds
+
+import argparse
+import asyncio
+import math
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+import aigrader
+import aigrader_http
+import aigrader_passback
+import aigrader_store
+
+LEASE_MARGIN = 60          # seconds of lease beyond the worst case of a batch
+BATCH_SIZE = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    sourcedid TEXT PRIMARY KEY,
+    outcome_url TEXT NOT NULL,
+    consumer_key TEXT NOT NULL,
+    score REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    leased_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+"""
+
+def outbox_db(config):
+    return aigrader_store.open_db(aigrader_store.state_file(config, "lti_outbox.db"), SCHEMA)
+
+def enqueue(outcome_url, result_sourcedid, consumer_key, score_normalized, config):
+    """Stores (or replaces) the pending grade for this sourcedid. Returns False if it could not be stored."""
+    if not outcome_url or not result_sourcedid or not consumer_key:
+        return False
+    now = time.time()
+    try:
+        outbox_db(config).execute(
+            """INSERT INTO outbox (sourcedid, outcome_url, consumer_key, score, status, attempts, next_attempt_at,
+                                   leased_until, last_error, created_at, updated_at)
+               VALUES (?, ?, ?, ?, 'pending', 0, ?, 0, NULL, ?, ?)
+               ON CONFLICT(sourcedid) DO UPDATE SET
+                   outcome_url = excluded.outcome_url, consumer_key = excluded.consumer_key, score = excluded.score,
+                   status = 'pending', attempts = 0, next_attempt_at = excluded.next_attempt_at,
+                   last_error = NULL, updated_at = excluded.updated_at""",
+            (result_sourcedid, outcome_url, consumer_key, float(score_normalized), now, now, now))
+    except sqlite3.Error:
+        return False
+    aigrader_store.incr_counter(config, "lti_outbox_enqueued")
+    return True
+
+def host_concurrency(config):
+    return config.get("lti_outbox_host_concurrency", 4)
+
+def lease_seconds(config, limit=BATCH_SIZE):
+    """How long a batch of limit rows may stay in flight: in the worst case they all go to
+    one LMS host, host_concurrency at a time, each taking the whole passback timeout
+    (twice with readResult verification)."""
+    requests = 2 if config.get("lti_verify_passback") else 1
+    return math.ceil(limit / host_concurrency(config)) * requests * aigrader.PASSBACK_TIMEOUT + LEASE_MARGIN
+
+def claim_due(config, limit=BATCH_SIZE):
+    """Leases up to limit due rows so that concurrent workers do not send the same grade twice.
+    The lease outlasts the whole batch, so no row is claimed again while it is in flight."""
+    db = outbox_db(config)
+    now = time.time()
+    lease = lease_seconds(config, limit)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        rows = db.execute(
+            """SELECT sourcedid, outcome_url, consumer_key, score, attempts, updated_at FROM outbox
+               WHERE status = 'pending' AND next_attempt_at <= ? AND leased_until < ?
+               ORDER BY next_attempt_at LIMIT ?""", (now, now, limit)).fetchall()
+        db.executemany("UPDATE outbox SET leased_until = ? WHERE sourcedid = ?",
+                       [(now + lease, row[0]) for row in rows])
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    return rows
+
+def backoff_delay(attempts, config):
+    base = config.get("lti_outbox_backoff", 30)
+    delay = min(base * (2 ** (attempts - 1)), config.get("lti_outbox_max_backoff", 3600))
+    return delay * random.uniform(0.8, 1.2)
+
+def record_result(config, row, error=None, permanent=False):
+    sourcedid, attempts, updated_at = row[0], row[4] + 1, row[5]
+    db = outbox_db(config)
+    # The updated_at guard keeps a newer grade enqueued while this one was in flight.
+    if error is None:
+        db.execute("DELETE FROM outbox WHERE sourcedid = ? AND updated_at = ?", (sourcedid, updated_at))
+        aigrader_store.incr_counter(config, "lti_outbox_sent")
+        return
+    gave_up = permanent or attempts >= config.get("lti_outbox_max_attempts", 12)
+    db.execute(
+        """UPDATE outbox SET attempts = ?, status = ?, next_attempt_at = ?, leased_until = 0, last_error = ?
+           WHERE sourcedid = ? AND updated_at = ?""",
+        (attempts, 'failed' if gave_up else 'pending', time.time() + backoff_delay(attempts, config),
+         str(error)[:500], sourcedid, updated_at))
+    aigrader_store.incr_counter(config, "lti_outbox_failed" if gave_up else "lti_outbox_retried")
+
+def record_results(config, rows, reports):
+    for row, report in zip(rows, reports):
+        record_result(config, row, None if report['ok'] else report['error'], report.get('permanent', False))
+
+async def drain_async(config, limit=BATCH_SIZE):
+    """Sends every due grade once. Returns (sent, failed)."""
+    # The outbox SQLite work runs off the shared event loop.
+    rows = await asyncio.to_thread(claim_due, config, limit)
+    engine = aigrader_passback.PassbackEngine(config, host_concurrency=host_concurrency(config))
+    reports = await engine.send_all([(row[1], row[0], row[2], row[3]) for row in rows])
+    await asyncio.to_thread(record_results, config, rows, reports)
+    sent = sum(1 for report in reports if report['ok'])
+    return sent, len(reports) - sent
+
+def drain(config, limit=BATCH_SIZE):
+    return aigrader_http.run_sync(drain_async(config, limit))
+
+def pending_count(config):
+    return outbox_db(config).execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+
+def run_worker(config, stop_event=None):
+    path = aigrader_store.state_file(config, "lti_outbox.db")
+    while not (stop_event and stop_event.is_set()):
+        # The CONFIG of the last start_background_worker() call: a reloaded script applies to the next drain.
+        config = _configs.get(path, config)
+        interval = config.get("lti_outbox_interval", 5)
+        try:
+            sent, failed = drain(config)
+        except Exception as e:
+            aigrader.log_debug(f"Outbox drain error: {e}", config)
+            sent = failed = 0
+        # A full batch means there is more backlog waiting.
+        if sent + failed < BATCH_SIZE:
+            if stop_event:
+                stop_event.wait(interval)
+            else:
+                time.sleep(interval)
+
+_workers = {}
+_configs = {}
+_workers_lock = threading.Lock()
+
+def start_background_worker(config):
+    """Starts one daemon drain thread per outbox file (used by aigrader_server.py). Called again
+    with a reloaded CONFIG, the running thread switches to it."""
+    path = aigrader_store.state_file(config, "lti_outbox.db")
+    with _workers_lock:
+        _configs[path] = config
+        if path not in _workers:
+            thread = threading.Thread(target=run_worker, args=(config,), name='aigrader-outbox', daemon=True)
+            thread.start()
+            _workers[path] = thread
+    return _workers[path]
+
+def main():
+    parser = argparse.ArgumentParser(description="Drain the LTI grade passback outbox of one or more grader configs.")
+    parser.add_argument('configs', nargs='+', help="Grader config scripts")
+    parser.add_argument('--once', action='store_true', help="Send what is due and exit")
+    args = parser.parse_args()
+
+    configs = [aigrader.load_config(path) for path in args.configs]
+    if args.once:
+        for config in configs:
+            sent, failed = drain(config)
+            sys.stderr.write(f"sent {sent}, failed {failed}, pending {pending_count(config)}\n")
+        return
+    threads = [start_background_worker(config) for config in configs]
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_passback.py
+
+# Bulk LTI 1.1 grade passback. A PassbackEngine signs and sends many replaceResult
+# requests concurrently on the shared event loop: the requests to each LMS host go
+# over its keep-alive connection pool (aigrader_http.py) with at most
+# lti_host_concurrency of them in flight, so one slow LMS does not hold back the
+# others. The signing itself reuses the keyed HMAC state per secret and the base
+# string prefix per outcome URL (see aigrader.oauth_signature).
+#
+# With verify, each grade is read back with readResult and compared with the score
+# sent. Results are reported per sourcedid. Used by the outbox drain and by
+# batch-grade.py, and on its own to push a CSV of grades:
+#   python3 aigrader_passback.py --config evaluate-certacles-writing-c1-LTI-conf.py \
+#       --input grades.csv [--verify] [--output results.jsonl]
+# (columns lis_outcome_service_url, lis_result_sourcedid, oauth_consumer_key and
+# score, normalized 0-1)
+#
+# CONFIG options:
+#   "lti_host_concurrency": 4,             # parallel passbacks per LMS host
+#   "lti_verify_passback": False,          # readResult after every replaceResult
+#
+# Counters (metrics.db, with "metrics": True): lti_passback:<outcome> and
+# lti_passback_verify:<outcome> (ok or mismatch).
+
+import argparse
+import asyncio
+import csv
+import json
+import sys
+import time
+from urllib.parse import urlsplit
+
+import aigrader
+import aigrader_http
+import aigrader_metrics
+
+DEFAULT_HOST_CONCURRENCY = 4
+SCORE_TOLERANCE = 1e-4   # the envelope carries four decimals
+
+class PassbackEngine:
+    """Concurrent passback of many grades with a per-LMS-host concurrency limit."""
+
+    def __init__(self, config, verify=None, host_concurrency=None):
+        self.config = config
+        self.verify = config.get("lti_verify_passback", False) if verify is None else verify
+        self.host_concurrency = host_concurrency or config.get("lti_host_concurrency", DEFAULT_HOST_CONCURRENCY)
+        self.host_slots = {}
+
+    def slots_for(self, outcome_url):
+        host = urlsplit(outcome_url or '').netloc.lower()
+        if host not in self.host_slots:
+            self.host_slots[host] = asyncio.Semaphore(self.host_concurrency)
+        return self.host_slots[host]
+
+    async def send(self, outcome_url, result_sourcedid, consumer_key, score_normalized):
+        """Sends one grade. Returns its report: sourcedid, ok, error, permanent, verified, read_score, seconds."""
+        report = {'sourcedid': result_sourcedid, 'ok': False}
+        started = time.monotonic()
+        async with self.slots_for(outcome_url):
+            try:
+                await aigrader.post_grade_async(outcome_url, result_sourcedid, consumer_key, score_normalized, self.config)
+                report['ok'] = True
+                if self.verify:
+                    read_score = await aigrader.read_grade_async(outcome_url, result_sourcedid, consumer_key, self.config)
+                    report['read_score'] = read_score
+                    report['verified'] = read_score is not None and abs(read_score - float(score_normalized)) <= SCORE_TOLERANCE
+                    aigrader_metrics.count(self.config, f"lti_passback_verify:{'ok' if report['verified'] else 'mismatch'}")
+                    if not report['verified']:
+                        report.update(ok=False, error=f"readResult returned {read_score}")
+            except aigrader.PassbackRejected as e:
+                report.update(error=str(e), permanent=True)
+            except Exception as e:
+                report['error'] = str(e) or e.__class__.__name__
+        report['seconds'] = round(time.monotonic() - started, 3)
+        aigrader_metrics.count(self.config, f"lti_passback:{'ok' if report['ok'] else 'failed'}")
+        if not report['ok']:
+            aigrader_metrics.log_event(self.config, "lti_passback_failed", outcome_url=outcome_url,
+                                       sourcedid=result_sourcedid, error=report['error'])
+        return report
+
+    async def send_all(self, grades):
+        """Reports for [(outcome_url, sourcedid, consumer_key, score), ...], in the same order."""
+        return await asyncio.gather(*[self.send(*grade) for grade in grades])
+
+def send_all(grades, config, verify=None):
+    return aigrader_http.run_sync(PassbackEngine(config, verify).send_all(grades))
+
+def read_grades(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return [(row['lis_outcome_service_url'], row['lis_result_sourcedid'], row['oauth_consumer_key'], float(row['score']))
+                for row in csv.DictReader(f)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a CSV of grades to the LMS (LTI 1.1 outcomes) concurrently.")
+    parser.add_argument('--config', required=True, help="Grader config script (consumer secrets, allowed domains)")
+    parser.add_argument('--input', required=True, help="CSV: lis_outcome_service_url, lis_result_sourcedid, oauth_consumer_key, score")
+    parser.add_argument('--output', help="JSONL report per sourcedid (default: stdout)")
+    parser.add_argument('--verify', action='store_true', help="Read every grade back with readResult")
+    parser.add_argument('--host-concurrency', type=int, help="Parallel requests per LMS host")
+    args = parser.parse_args()
+
+    config = aigrader.load_config(args.config)
+    grades = read_grades(args.input)
+    started = time.monotonic()
+    engine = PassbackEngine(config, args.verify or None, args.host_concurrency)
+    reports = aigrader_http.run_sync(engine.send_all(grades))
+    elapsed = time.monotonic() - started
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for report in reports:
+            out.write(json.dumps(report, ensure_ascii=False) + "\n")
+    finally:
+        if args.output:
+            out.close()
+    sent = sum(1 for report in reports if report['ok'])
+    sys.stderr.write(f"Sent {sent}, failed {len(reports) - sent}, {len(reports) / max(elapsed, 1e-9):.1f} grades/s\n")
+
+if __name__ == "__main__":
+    main()
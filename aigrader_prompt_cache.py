@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_prompt_cache.py
+
+# Provider-side caching of the large, static system_instructions.
+#
+#  - Google: the rubric is uploaded once as a cachedContents resource with a TTL.
+#    Its name is shared by every process through prompt_cache.db (per rubric, model,
+#    endpoint and API key: the resource belongs to the key's project), refreshed
+#    before it expires, and generateContent only sends the student text. Only one
+#    request creates or refreshes it: the others of the process wait for it, and
+#    other processes send the rubric inline meanwhile (claim in prompt_cache.db).
+#  - OpenAI: prefix caching is automatic for long prompts; the rubric is always the
+#    first (system) message and a stable prompt_cache_key routes requests with the
+#    same rubric to the same cache.
+#
+# CONFIG options:
+#   "prompt_caching": True,
+#   "prompt_cache_ttl": 3600,              # seconds (Google cachedContents)
+#
+# Counters (metrics.db): prompt_cache_created, prompt_cache_refreshed,
+# prompt_cache_create_failed, prompt_cache_hits, prompt_cache_prompt_tokens,
+# prompt_cache_cached_tokens.
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+
+import aigrader_http
+import aigrader_store
+
+DEFAULT_TTL = 3600
+RETRY_AFTER_FAILURE = 600
+CLAIM_SECONDS = 90         # longest a process may take to create or refresh a resource
+GOOGLE_API_URL = "https://generativelanguage.googleapis.com"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS prompt_caches (
+    key TEXT PRIMARY KEY,
+    name TEXT,
+    expires_at REAL NOT NULL DEFAULT 0,
+    failed_until REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+"""
+
+_locks = {}
+_handles = {}          # prompt_key: (name, expires_at) last seen by this process
+
+def rubric_key(config):
+    digest = hashlib.sha256()
+    for part in (config.get("provider", "openai").lower(), config.get("model_name", ""), config.get("system_instructions", "")):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def prompt_key(config):
+    """Key of the cachedContents handle in prompt_cache.db: the rubric and model, and the
+    endpoint and API key that own the resource (another key or project cannot use it)."""
+    digest = hashlib.sha256(rubric_key(config).encode('ascii'))
+    for part in (google_base_url(config), config.get("api_key") or ""):
+        digest.update(b'\0')
+        digest.update(part.encode('utf-8'))
+    return digest.hexdigest()
+
+def openai_cache_key(config):
+    return "aigrader-" + rubric_key(config)[:24]
+
+def cache_db(config):
+    return aigrader_store.open_db(aigrader_store.state_file(config, "prompt_cache.db"), SCHEMA)
+
+def google_base_url(config):
+    return (config.get("api_url") or GOOGLE_API_URL).rstrip('/') + "/v1beta"
+
+async def _create(config, ttl):
+    body = {
+        "model": f"models/{config['model_name']}",
+        "displayName": "aigrader-" + rubric_key(config)[:12],
+        "systemInstruction": {"parts": [{"text": config["system_instructions"]}]},
+        "ttl": f"{int(ttl)}s",
+    }
+    url = f"{google_base_url(config)}/cachedContents?key={config['api_key']}"
+    response = await aigrader_http.get_client().request('POST', url, json.dumps(body), {'Content-Type': 'application/json'}, timeout=60)
+    return json.loads(response.raise_for_status().text())['name']
+
+async def _refresh(config, name, ttl):
+    url = f"{google_base_url(config)}/{name}?key={config['api_key']}&updateMask=ttl"
+    response = await aigrader_http.get_client().request('PATCH', url, json.dumps({"ttl": f"{int(ttl)}s"}),
+                                                        {'Content-Type': 'application/json'}, timeout=30)
+    response.raise_for_status()
+
+def _claim(config, key, ttl):
+    """(action, name, expires_at): ('use', ...), ('inline', None, 0), or ('create' | 'refresh', ...) once this process holds
+    the claim: failed_until set for CLAIM_SECONDS, so that the other processes do not create
+    the same (billed) resource meanwhile."""
+    db = cache_db(config)
+    now = time.time()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        row = db.execute("SELECT name, expires_at, failed_until FROM prompt_caches WHERE key = ?", (key,)).fetchone()
+        name, expires_at, failed_until = row or (None, 0, 0)
+        if name and expires_at - now > ttl / 5:
+            # Fresh enough: keep using it. Refresh during the last fifth of its life.
+            state = ('use', name, expires_at)
+        elif failed_until > now:
+            # A recent failure, or another process creating or refreshing it: the current one while it lasts.
+            state = ('use', name, expires_at) if name and expires_at > now + 30 else ('inline', None, 0)
+        else:
+            db.execute("INSERT OR REPLACE INTO prompt_caches (key, name, expires_at, failed_until, updated_at) "
+                       "VALUES (?, ?, ?, ?, ?)", (key, name, expires_at, now + CLAIM_SECONDS, now))
+            state = ('refresh', name, expires_at) if name and expires_at > now + 30 else ('create', None, 0)
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    return state
+
+async def get_cached_content(config):
+    """Name of a live cachedContents resource for this rubric and model, or None to send it inline."""
+    if not config.get("prompt_caching") or config.get("provider", "openai").lower() == "openai":
+        return None
+    key = prompt_key(config)
+    ttl = config.get("prompt_cache_ttl", DEFAULT_TTL)
+    known = _handles.get(key)
+    if known and known[1] - time.time() > ttl / 5:
+        return known[0]
+    # One creation per rubric: concurrent misses of this process wait for it, the
+    # other processes see the claim (the SQLite work runs off the event loop).
+    lock = _locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        try:
+            action, name, expires_at = await asyncio.to_thread(_claim, config, key, ttl)
+        except sqlite3.Error:
+            return None
+        if action == 'use':
+            _handles[key] = (name, expires_at)
+        if action in ('use', 'inline'):
+            return name
+        now = time.time()
+        try:
+            if action == 'refresh':
+                await _refresh(config, name, ttl)
+                counter = "prompt_cache_refreshed"
+            else:
+                name = await _create(config, ttl)
+                counter = "prompt_cache_created"
+            await asyncio.to_thread(_save, config, key, name, now + ttl, 0)
+            _handles[key] = (name, now + ttl)
+            await asyncio.to_thread(aigrader_store.incr_counter, config, counter)
+            return name
+        except Exception:
+            # Too small for explicit caching, unsupported model...: send the rubric inline for a while.
+            await asyncio.to_thread(_save, config, key, None, 0, now + RETRY_AFTER_FAILURE)
+            await asyncio.to_thread(aigrader_store.incr_counter, config, "prompt_cache_create_failed")
+            return None
+
+def _save(config, key, name, expires_at, failed_until):
+    try:
+        cache_db(config).execute(
+            "INSERT OR REPLACE INTO prompt_caches (key, name, expires_at, failed_until, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (key, name, expires_at, failed_until, time.time()))
+    except sqlite3.Error:
+        pass
+
+def invalidate(config):
+    """Forgets the stored handle (e.g. the provider no longer knows it)."""
+    _handles.pop(prompt_key(config), None)
+    try:
+        cache_db(config).execute("DELETE FROM prompt_caches WHERE key = ?", (prompt_key(config),))
+    except sqlite3.Error:
+        pass
+
+def usage_tokens(res, provider):
+    """(prompt_tokens, cached_tokens) reported by the provider, or (None, None)."""
+    if provider == "openai":
+        usage = res.get('usage') or {}
+        if not usage:
+            return None, None
+        return usage.get('prompt_tokens', 0), (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
+    usage = res.get('usageMetadata') or {}
+    if not usage:
+        return None, None
+    return usage.get('promptTokenCount', 0), usage.get('cachedContentTokenCount', 0)
+
+def record_usage(res, provider, config):
+    if not config.get("prompt_caching"):
+        return
+    prompt_tokens, cached_tokens = usage_tokens(res, provider)
+    if prompt_tokens is None:
+        return
+    aigrader_store.incr_counter(config, "prompt_cache_prompt_tokens", prompt_tokens)
+    if cached_tokens:
+        aigrader_store.incr_counter(config, "prompt_cache_hits")
+        aigrader_store.incr_counter(config, "prompt_cache_cached_tokens", cached_tokens)
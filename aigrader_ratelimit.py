@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_ratelimit.py
+
+# Admission control before the LLM call. Token buckets are kept in SQLite
+# (ratelimit.db in state_dir), so the limits hold across every CGI process and
+# server worker:
+#
+#  - per LTI consumer key (oauth_consumer_key of the session, "anonymous" without one)
+#  - per session token
+#  - global provider budget in requests per minute and (estimated) tokens per minute,
+#    per provider and model actually called: taken before each LLM call, so the
+#    calls that the router ("providers"), tiers or samples send to other models
+#    count against the budget of those models.
+#
+# A request over the limit waits for its turn up to rate_limit_max_wait seconds;
+# after that it is answered with a structured 'retry_after' response (HTTP 429)
+# that aigrader.js uses to retry automatically (with "providers", a provider over
+# its budget is skipped for the next one first). Each bucket row records when it
+# will be full again (full_at); rows full for IDLE_MARGIN seconds (one per
+# session...) are deleted in small batches as requests go. A missing bucket is a
+# full one, so this does not change any limit.
+#
+# CONFIG options:
+#   "rate_limits": {
+#       "consumer": {"rate": 120, "per": 60, "burst": 30},
+#       "session": {"rate": 4, "per": 60, "burst": 2},
+#       "provider_rpm": 1000,
+#       "provider_tpm": 4000000,
+#   },
+#   "rate_limit_max_wait": 20,             # seconds a request may be queued
+
+import asyncio
+import math
+import sqlite3
+import time
+
+import aigrader_budget
+import aigrader_http
+import aigrader_store
+
+DEFAULT_MAX_WAIT = 20
+POLL_STEP = 0.5
+EXPECTED_OUTPUT_TOKENS = 1200
+PURGE_BATCH = 500
+IDLE_MARGIN = 600          # seconds after a bucket is full again before it is deleted
+
+# The buckets table of earlier versions had no full_at: buckets are transient state,
+# so it is simply dropped (its buckets start full again).
+SCHEMA = """
+DROP TABLE IF EXISTS buckets;
+CREATE TABLE IF NOT EXISTS token_buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    full_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS token_buckets_full_at ON token_buckets (full_at);
+"""
+
+class RateLimited(Exception):
+    def __init__(self, retry_after, scope):
+        super().__init__(f"Rate limit exceeded ({scope})")
+        self.retry_after = retry_after
+        self.scope = scope
+
+def estimate_tokens(student_input, config):
+    """Token cost of one grading: rubric and text (aigrader_budget estimate) plus the expected answer."""
+    prompt_tokens = aigrader_budget.count_rubric_tokens(config.get("system_instructions", "")) + aigrader_budget.count_tokens(student_input)
+    expected_output = config.get("expected_output_tokens", EXPECTED_OUTPUT_TOKENS)
+    return prompt_tokens + min(expected_output, config.get("max_output_tokens") or expected_output)
+
+def limits_for(session_token, consumer_key, config):
+    """[(bucket_key, rate_per_second, capacity, cost), ...] of the client limits that apply to this request."""
+    limits = config.get("rate_limits") or {}
+    buckets = []
+    consumer = limits.get("consumer")
+    if consumer:
+        buckets.append((f"consumer:{consumer_key or 'anonymous'}", consumer["rate"] / consumer.get("per", 60),
+                        consumer.get("burst", consumer["rate"]), 1))
+    session = limits.get("session")
+    if session and session_token:
+        buckets.append((f"session:{session_token}", session["rate"] / session.get("per", 60),
+                        session.get("burst", session["rate"]), 1))
+    return buckets
+
+def provider_limits(student_input, config):
+    """Provider budget buckets for one call with this config (a router, tier or sample config)."""
+    limits = config.get("rate_limits") or {}
+    buckets = []
+    provider = f"{config.get('provider', 'openai').lower()}:{config.get('model_name', '')}"
+    if limits.get("provider_rpm"):
+        buckets.append((f"rpm:{provider}", limits["provider_rpm"] / 60, limits["provider_rpm"], 1))
+    if limits.get("provider_tpm"):
+        buckets.append((f"tpm:{provider}", limits["provider_tpm"] / 60, limits["provider_tpm"],
+                        estimate_tokens(student_input, config)))
+    return buckets
+
+def ratelimit_db(config):
+    return aigrader_store.open_db(aigrader_store.state_file(config, "ratelimit.db"), SCHEMA)
+
+def try_acquire(config, buckets):
+    """Takes one request from every bucket atomically. Returns (0, None) or (seconds to wait, scope).
+
+    Also deletes a batch of buckets that have been full for IDLE_MARGIN seconds, whatever
+    their limit: a missing bucket is a full one, so this changes no limit."""
+    db = ratelimit_db(config)
+    now = time.time()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        levels = []
+        wait, scope = 0.0, None
+        for key, rate, capacity, cost in buckets:
+            row = db.execute("SELECT tokens, updated_at FROM token_buckets WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            cost = min(cost, capacity)
+            if tokens < cost and (cost - tokens) / rate > wait:
+                wait, scope = (cost - tokens) / rate, key.split(':', 1)[0]
+            levels.append((key, tokens - cost, now + (capacity - tokens + cost) / rate))
+        if wait == 0:
+            db.executemany("INSERT OR REPLACE INTO token_buckets (key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?)",
+                           [(key, level, now, full_at) for key, level, full_at in levels])
+            db.execute(f"DELETE FROM token_buckets WHERE key IN "
+                       f"(SELECT key FROM token_buckets WHERE full_at < ? LIMIT {PURGE_BATCH})", (now - IDLE_MARGIN,))
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    return wait, scope
+
+async def acquire(config, buckets):
+    """Waits until the request fits in every bucket, or raises RateLimited after rate_limit_max_wait.
+
+    The SQLite work runs in a worker thread, so a busy ratelimit.db never holds up the
+    other requests on the shared event loop."""
+    if not buckets:
+        return 0.0
+    max_wait = config.get("rate_limit_max_wait", DEFAULT_MAX_WAIT)
+    started = time.monotonic()
+    queued = False
+    while True:
+        try:
+            wait, scope = await asyncio.to_thread(try_acquire, config, buckets)
+        except sqlite3.Error:
+            return 0.0
+        if wait == 0:
+            if queued:
+                await asyncio.to_thread(aigrader_store.incr_counter, config, "rate_limit_queued")
+            return time.monotonic() - started
+        remaining = max_wait - (time.monotonic() - started)
+        if wait > remaining:
+            await asyncio.to_thread(aigrader_store.incr_counter, config, f"rate_limit_rejected:{scope}")
+            raise RateLimited(max(1, math.ceil(wait)), scope)
+        queued = True
+        await asyncio.sleep(min(wait, POLL_STEP))
+
+def admit(session_token, consumer_key, config):
+    """Client limits of a request (consumer, session), from a grading thread."""
+    return aigrader_http.run_sync(acquire(config, limits_for(session_token, consumer_key, config)))
+
+async def admit_call(student_input, config):
+    """Provider budget of one LLM call with this config."""
+    return await acquire(config, provider_limits(student_input, config))
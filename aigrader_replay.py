@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_replay.py
+
+# Record/replay of the LLM provider responses, for calibration runs
+# (calibrate-grader.py) that must be repeatable and able to run offline. Every
+# non-streamed provider call of aigrader.call_provider_async goes through post():
+#  - record: the call is sent and a successful response stored with its latency;
+#  - replay: the stored response is returned after its recorded latency (times
+#    replay_speed, 0 for none), without any network access; a request that was
+#    never recorded fails with ReplayMissing;
+#  - auto: replay what was recorded, record the rest.
+# A response is found by the hash of the request URL (without the API key) and body
+# (model, system instructions, student text, options), so a rubric edit, another
+# model_name or another provider is a new request. Identical requests in the same
+# process (self-consistency samples, or the same essay twice) get successive
+# recordings: occurrence n of a request replays recording n.
+#
+# CONFIG options:
+#   "replay_store": "/var/secure/calibration/replay.db",
+#   "replay_mode": "auto",                 # record, replay or auto
+#   "replay_speed": 1.0,                   # replay: recorded latency x this (0: instant)
+
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+
+import aigrader_http
+import aigrader_store
+
+API_KEY_RE = re.compile(r'([?&])key=[^&]*&?')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    body BLOB NOT NULL,
+    seconds REAL NOT NULL,
+    recorded_at REAL NOT NULL,
+    PRIMARY KEY (key, seq)
+);
+"""
+
+_occurrences = {}
+_lock = threading.Lock()
+
+class ReplayMissing(Exception):
+    pass
+
+def request_key(url, body):
+    digest = hashlib.sha256(API_KEY_RE.sub(r'\1', url).rstrip('?&').encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(json.dumps(body, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+def next_occurrence(path, key):
+    with _lock:
+        seq = _occurrences.get((path, key), 0)
+        _occurrences[(path, key)] = seq + 1
+    return seq
+
+def reset():
+    """Starts counting occurrences again (a new run in the same process)."""
+    with _lock:
+        _occurrences.clear()
+
+def lookup(path, key, seq):
+    """(status, body, seconds) of occurrence seq, cycling over the recorded ones, or None."""
+    db = aigrader_store.open_db(path, SCHEMA)
+    count = db.execute("SELECT COUNT(*) FROM responses WHERE key = ?", (key,)).fetchone()[0]
+    if not count:
+        return None
+    return db.execute("SELECT status, body, seconds FROM responses WHERE key = ? ORDER BY seq LIMIT 1 OFFSET ?",
+                      (key, seq % count)).fetchone()
+
+def record(path, key, seq, response, seconds):
+    aigrader_store.open_db(path, SCHEMA).execute(
+        "INSERT OR REPLACE INTO responses (key, seq, status, body, seconds, recorded_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (key, seq, response.status, response.body, seconds, time.time()))
+
+async def post(url, body, headers, config, timeout=120):
+    """POST of one LLM request, through the replay store when the config has one."""
+    path = config.get("replay_store")
+    if not path:
+        return await aigrader_http.get_client().request('POST', url, json.dumps(body), headers, timeout=timeout)
+    mode = config.get("replay_mode", "auto")
+    key = request_key(url, body)
+    seq = next_occurrence(path, key)
+    if mode != "record":
+        recorded = lookup(path, key, seq)
+        if recorded is not None:
+            status, content, seconds = recorded
+            await asyncio.sleep(seconds * config.get("replay_speed", 1.0))
+            return aigrader_http.Response(status, 'OK', {}, content)
+        if mode == "replay":
+            raise ReplayMissing(f"Request {key[:12]} is not in the replay store")
+    started = time.monotonic()
+    response = await aigrader_http.get_client().request('POST', url, json.dumps(body), headers, timeout=timeout)
+    if 200 <= response.status < 300:
+        record(path, key, seq, response, time.monotonic() - started)
+    return response
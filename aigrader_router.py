@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_router.py
+
+# Routing over several LLM providers/models, in order of preference:
+#
+#  - Failover: when a provider fails, the next one is tried at once.
+#  - Hedging: when the current provider is slower than its usual latency (a
+#    percentile of its own histogram), the next provider is fired as well and the
+#    first answer wins; the other call is cancelled.
+#  - Circuit breakers: after a number of consecutive failures a provider is skipped
+#    for a cooldown period, then tried again.
+#
+# Breaker state (provider_health.db) and the latency histograms (metrics.db) live
+# in state_dir, so they are shared by every CGI process and server worker.
+#
+# CONFIG options:
+#   "providers": [                         # Each entry overrides the top-level keys
+#       {"provider": "google", "model_name": "gemini-2.5-flash-lite", "api_key": os.getenv("AI_GRADER_API_KEY_GOOGLE", "")},
+#       {"provider": "openai", "model_name": "gpt-4.1-mini", "api_key": os.getenv("AI_GRADER_API_KEY_OPENAI", "")},
+#   ],
+#   "hedge_percentile": 0.9,               # None disables hedging
+#   "hedge_min_delay": 2,                  # seconds, bounds of the hedge delay
+#   "hedge_max_delay": 60,
+#   "hedge_default_delay": 20,             # used until a provider has enough latency history
+#   "circuit_failure_threshold": 5,
+#   "circuit_cooldown": 60,                # seconds
+
+import asyncio
+import sqlite3
+import time
+
+import aigrader
+import aigrader_store
+
+LATENCY_METRIC = "provider_latency_seconds"
+DEFAULT_HEDGE_DELAY = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS circuit_breakers (
+    name TEXT PRIMARY KEY,
+    failures INTEGER NOT NULL DEFAULT 0,
+    opened_until REAL NOT NULL DEFAULT 0
+);
+"""
+
+def provider_configs(config):
+    """The ordered list of per-provider configs (the config itself when no "providers" list is set)."""
+    entries = config.get("providers") or [{}]
+    return [dict(config, providers=None, **entry) for entry in entries]
+
+def provider_name(config):
+    return f"{config.get('provider', 'openai').lower()}:{config.get('model_name', '')}"
+
+def health_db(config):
+    return aigrader_store.open_db(aigrader_store.state_file(config, "provider_health.db"), SCHEMA)
+
+# 🔌 CIRCUIT BREAKERS
+def breaker_states(config, names):
+    try:
+        rows = health_db(config).execute(
+            f"SELECT name, failures, opened_until FROM circuit_breakers WHERE name IN ({','.join('?' * len(names))})", names)
+        return {name: (failures, opened_until) for name, failures, opened_until in rows.fetchall()}
+    except sqlite3.Error:
+        return {}
+
+def record_success(config, name):
+    try:
+        health_db(config).execute("DELETE FROM circuit_breakers WHERE name = ?", (name,))
+    except sqlite3.Error:
+        pass
+
+def record_outcome(config, name, seconds):
+    """A successful call: its latency (for the hedge delay) and a closed breaker."""
+    aigrader_store.observe(config, LATENCY_METRIC, seconds, name)
+    record_success(config, name)
+
+def record_failure(config, name):
+    threshold = config.get("circuit_failure_threshold", 5)
+    cooldown = config.get("circuit_cooldown", 60)
+    try:
+        db = health_db(config)
+        db.execute("INSERT INTO circuit_breakers (name, failures) VALUES (?, 1) "
+                   "ON CONFLICT(name) DO UPDATE SET failures = failures + 1", (name,))
+        db.execute("UPDATE circuit_breakers SET opened_until = ?, failures = 0 WHERE name = ? AND failures >= ?",
+                   (time.time() + cooldown, name, threshold))
+    except sqlite3.Error:
+        return
+    aigrader_store.incr_counter(config, f"provider_errors:{name}")
+
+def healthy_candidates(config):
+    """Providers whose breaker is closed, in configured order. If all are open, the one reopening first."""
+    candidates = provider_configs(config)
+    states = breaker_states(config, [provider_name(c) for c in candidates])
+    now = time.time()
+    healthy = [c for c in candidates if states.get(provider_name(c), (0, 0))[1] <= now]
+    if healthy:
+        return healthy
+    return [min(candidates, key=lambda c: states[provider_name(c)][1])]
+
+# ⏱️ HEDGING
+def hedge_delay(config, candidate):
+    percentile = config.get("hedge_percentile", 0.9)
+    if percentile is None:
+        return None
+    low = config.get("hedge_min_delay", 2)
+    high = config.get("hedge_max_delay", 60)
+    estimate = aigrader_store.histogram_percentile(config, LATENCY_METRIC, percentile, provider_name(candidate))
+    if estimate is None:
+        estimate = config.get("hedge_default_delay", DEFAULT_HEDGE_DELAY)
+    return min(max(estimate, low), high)
+
+async def _attempt(student_input, candidate, config):
+    name = provider_name(candidate)
+    started = time.monotonic()
+    result = await aigrader.call_provider_async(student_input, candidate)
+    # The breaker and latency writes are SQLite: off the shared event loop.
+    if result.get('success'):
+        await asyncio.to_thread(record_outcome, config, name, time.monotonic() - started)
+    elif not result.get('retry_after'):
+        # Over our own rate limit is not a provider failure
+        await asyncio.to_thread(record_failure, config, name)
+    result['provider'] = name
+    return result
+
+async def route_ai_api_async(student_input, config):
+    """call_ai_api over the "providers" list with failover, hedging and circuit breakers."""
+    candidates = await asyncio.to_thread(healthy_candidates, config)
+    pending = set()
+    last_error = {'success': False, 'error': 'No AI provider available'}
+    next_index = 0
+    wait_expired = False
+    delay = None
+    try:
+        while True:
+            if next_index < len(candidates) and (not pending or wait_expired):
+                candidate = candidates[next_index]
+                if pending:
+                    await asyncio.to_thread(aigrader_store.incr_counter, config, "provider_hedges")
+                pending.add(asyncio.ensure_future(_attempt(student_input, candidate, config)))
+                delay = await asyncio.to_thread(hedge_delay, config, candidate) if next_index + 1 < len(candidates) else None
+                next_index += 1
+            if not pending:
+                return last_error
+            done, pending = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            wait_expired = not done
+            for task in done:
+                result = task.result()
+                if result.get('success'):
+                    return result
+                last_error = result
+                # Failover: a failed call frees the way for the next provider immediately.
+                wait_expired = True
+    finally:
+        for task in pending:
+            task.cancel()
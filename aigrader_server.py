@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_server.py
+
+# Persistent WSGI entry point for aigrader. Grader config scripts are imported
+# once at startup and served by route, so a submission no longer pays for a new
+# interpreter, the .env parsing and the CONFIG/rubric construction.
+#
+# Development / single node:
+#   python3 aigrader_server.py --port 8081 /usr/lib/cgi-bin/evaluate-certacles-writing-c1-LTI-conf.py
+# Any WSGI server (routes taken from AIGRADER_ROUTES):
+#   AIGRADER_ROUTES="/cgi-bin/evaluate-certacles-writing-c1-LTI-conf.py=/usr/lib/cgi-bin/evaluate-certacles-writing-c1-LTI-conf.py" \
+#   gunicorn -k gthread --threads 64 -b 127.0.0.1:8081 aigrader_server:application
+#
+# Multi-tenant: every <activity_id>.py config of a directory on one endpoint
+# (POST /grade/<activity_id>, or POST /grade with the activity of the LTI launch,
+# see aigrader_tenants.py):
+#   python3 aigrader_server.py --port 8081 --tenants /etc/aigrader/activities
+#   AIGRADER_TENANTS=/etc/aigrader/activities gunicorn ... aigrader_server:application
+#
+# GET /metrics returns the Prometheus metrics of every route and tenant (see
+# aigrader_metrics.py); keep it off the public nginx location.
+
+import argparse
+import json
+import os
+import sys
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+import aigrader
+import aigrader_config
+import aigrader_jobs
+import aigrader_metrics
+import aigrader_outbox
+import aigrader_tenants
+
+DEFAULT_ROUTE_PREFIX = '/cgi-bin/'
+METRICS_ROUTE = '/metrics'
+
+def parse_route(spec):
+    """'route=path' or just 'path' (served at /cgi-bin/<file name>, the same URL the CGI script had)."""
+    if '=' in spec:
+        route, path = spec.split('=', 1)
+    else:
+        path = spec
+        route = DEFAULT_ROUTE_PREFIX + os.path.basename(path)
+    return '/' + route.strip().strip('/'), path.strip()
+
+class GraderApplication:
+    """WSGI application serving one grader config per route with the aigrader.run JSON contract.
+
+    A route maps to a CONFIG dict or to a config script path, looked up in the
+    config registry (reloaded when the script changes; on_load is called with each
+    CONFIG dict the first time a route serves it). With a TenantRegistry, the
+    tenant route and everything under it serve its activities.
+    """
+
+    def __init__(self, routes=None, registry=None, tenants=None, tenant_route=aigrader_tenants.DEFAULT_ROUTE, on_load=None):
+        self.routes = {}
+        self.registry = registry or aigrader_config.ConfigRegistry()
+        self.tenants = tenants
+        self.on_load = on_load
+        self.loaded = {}
+        self.tenant_route = '/' + tenant_route.strip('/')
+        for route, config in (routes or {}).items():
+            self.add_route(route, config)
+
+    def add_route(self, route, config):
+        self.routes['/' + route.strip('/')] = config
+
+    def config_for(self, route):
+        config = self.routes.get(route)
+        if isinstance(config, str):
+            path, config = config, self.registry.get(config)
+            if self.loaded.get(path) is not config:
+                # Loaded at startup or reloaded since: the background workers follow it.
+                self.loaded[path] = config
+                if self.on_load:
+                    self.on_load(config)
+        return config
+
+    def all_configs(self):
+        configs = [self.config_for(route) for route in self.routes]
+        if self.tenants:
+            configs += list(self.tenants.load_all().values())
+        return configs
+
+    def tenant_activity(self, path):
+        """'' for the tenant route itself, the activity ID under it, None for other paths."""
+        if self.tenants is None:
+            return None
+        if path == self.tenant_route:
+            return ''
+        if path.startswith(self.tenant_route + '/'):
+            return path[len(self.tenant_route) + 1:]
+        return None
+
+    def __call__(self, environ, start_response):
+        path = '/' + (environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')).strip('/')
+        method = environ.get('REQUEST_METHOD', 'GET')
+        config = self.config_for(path)
+        activity_id = self.tenant_activity(path) if config is None else None
+        if config is None and path == METRICS_ROUTE and method == 'GET':
+            body = aigrader_metrics.render(self.all_configs()).encode('utf-8')
+            start_response('200 OK', [("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+                                      ("Content-Length", str(len(body)))])
+            return [body]
+        if activity_id:
+            config = self.tenants.get(activity_id)
+        elif activity_id == '' and method != 'OPTIONS':
+            # The activity comes from the session of the submission: read the body first.
+            raw_data = self._read(environ)
+            try:
+                data = json.loads(raw_data or '{}')
+            except ValueError:
+                data = None
+            config = self.tenants.resolve(data=data)
+        elif activity_id == '':
+            # Preflight of the shared endpoint: the POST answer carries the activity's CORS origin.
+            config = {}
+        if config is None:
+            return self._json(start_response, '404 Not Found', [("Content-Type", "application/json; charset=utf-8")],
+                              {'success': False, 'error': 'Unknown activity' if activity_id is not None else 'Unknown grader route'})
+
+        request_id = aigrader_metrics.new_request_id(environ.get('HTTP_X_REQUEST_ID'))
+        headers = aigrader.response_headers(config, environ.get('HTTP_ORIGIN', '')) + [("X-Request-ID", request_id)]
+        if method == 'OPTIONS':
+            start_response('200 OK', headers + [("Content-Length", "0")])
+            return [b'']
+        if method != 'POST':
+            return self._json(start_response, '405 Method Not Allowed', headers, {'success': False, 'error': 'Only POST requests'})
+
+        if activity_id != '':
+            try:
+                raw_data = self._read(environ)
+            except Exception as e:
+                return self._json(start_response, '200 OK', headers, {'success': False, 'error': str(e)})
+        if aigrader.wants_stream(config, environ.get('HTTP_ACCEPT', '')):
+            start_response('200 OK', aigrader.response_headers(config, environ.get('HTTP_ORIGIN', ''), stream=True)
+                           + [("X-Request-ID", request_id)])
+            return (event.encode('utf-8') for event in aigrader.process_submission_stream(raw_data, config, request_id))
+        result = aigrader.process_submission(raw_data, config, request_id)
+        status, extra = aigrader.response_status(result)
+        return self._json(start_response, status, headers + extra, result)
+
+    def _read(self, environ):
+        content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        return environ['wsgi.input'].read(content_length).decode('utf-8')
+
+    def _json(self, start_response, status, headers, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        start_response(status, headers + [("Content-Length", str(len(body)))])
+        return [body]
+
+def start_workers(config):
+    """Background workers of a config; called again with a reloaded config, they switch to it."""
+    if config.get("lti_outbox"):
+        aigrader_outbox.start_background_worker(config)
+    if config.get("jobs"):
+        aigrader_jobs.start_background_workers(config)
+
+def build_application(specs, tenants_dir=None, tenant_route=aigrader_tenants.DEFAULT_ROUTE,
+                      session_dir=aigrader_tenants.DEFAULT_SESSION_DIR, activity_param=aigrader_tenants.DEFAULT_ACTIVITY_PARAM):
+    app = GraderApplication(tenant_route=tenant_route, on_load=start_workers)
+    for spec in specs:
+        route, path = parse_route(spec)
+        app.add_route(route, path)
+        # Loaded and validated now so that a broken config stops the server at startup.
+        app.config_for(route)
+    if tenants_dir:
+        # The same registry: a config served both by route and as a tenant is loaded once.
+        app.tenants = aigrader_tenants.TenantRegistry(tenants_dir, session_dir, activity_param, app.registry, start_workers)
+        app.tenants.load_all()
+    return app
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+# Used by external WSGI servers (gunicorn, uwsgi, mod_wsgi): comma separated route specs.
+# AIGRADER_TENANTS: directory of activity configs, served under AIGRADER_TENANT_ROUTE (default /grade).
+application = build_application([s for s in os.environ.get('AIGRADER_ROUTES', '').split(',') if s.strip()],
+                                os.environ.get('AIGRADER_TENANTS'),
+                                os.environ.get('AIGRADER_TENANT_ROUTE', aigrader_tenants.DEFAULT_ROUTE),
+                                os.environ.get('AIGRADER_SESSION_DIR', aigrader_tenants.DEFAULT_SESSION_DIR))
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve one or more grader configs from a single long-lived process.")
+    parser.add_argument('configs', nargs='*', help="Config scripts, as 'path' or 'route=path'")
+    parser.add_argument('--tenants', help="Directory of <activity_id>.py configs served on --tenant-route")
+    parser.add_argument('--tenant-route', default=aigrader_tenants.DEFAULT_ROUTE)
+    parser.add_argument('--session-dir', default=aigrader_tenants.DEFAULT_SESSION_DIR,
+                        help="Sessions of lti-receiver.py, to find the activity of a submission")
+    parser.add_argument('--activity-param', default=aigrader_tenants.DEFAULT_ACTIVITY_PARAM,
+                        help="LTI launch parameter with the activity ID")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--access-log', action='store_true')
+    args = parser.parse_args()
+    if not args.configs and not args.tenants:
+        parser.error("give config scripts and/or --tenants")
+
+    app = build_application(args.configs, args.tenants, args.tenant_route, args.session_dir, args.activity_param)
+    handler = WSGIRequestHandler if args.access_log else QuietHandler
+    httpd = make_server(args.host, args.port, app, server_class=ThreadingWSGIServer, handler_class=handler)
+    for route in sorted(app.routes):
+        sys.stderr.write(f"Serving {route} on http://{args.host}:{httpd.server_port}\n")
+    if app.tenants:
+        activities = app.tenants.activity_ids()
+        sys.stderr.write(f"Serving {len(activities)} activities of {app.tenants.config_dir} on "
+                         f"http://{args.host}:{httpd.server_port}{app.tenant_route}[/<activity_id>]\n")
+    sys.stderr.flush()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
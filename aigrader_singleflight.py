@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_singleflight.py
+
+# Coalescing of identical in-flight gradings (double click on "Evaluate", two open
+# tabs...). Requests with the same session token and normalized text share one
+# LLM call and one LTI passback: the first one (leader) grades, the others
+# (followers) wait and return the leader's result with "coalesced": true.
+#
+#  - Inside a process (aigrader_server.py threads) followers wait on an event.
+#  - Across processes (CGI, several server workers) the leader claims the key in
+#    inflight.db (state_dir) and followers poll it for the result. A leader that
+#    dies is taken over after coalesce_timeout seconds.
+#  - Only successful results are shared: after a failed, rate-limited or errored
+#    grading the followers grade by themselves.
+#
+# CONFIG options:
+#   "coalesce": True,
+#   "coalesce_timeout": 150,               # seconds a follower waits for its leader
+#   "coalesce_window": 10,                 # seconds a finished result still answers followers
+#
+# Counters (metrics.db): coalesce_leaders, coalesce_followers, coalesce_takeovers.
+
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import aigrader_cache
+import aigrader_metrics
+import aigrader_store
+
+DEFAULT_TIMEOUT = 150
+DEFAULT_WINDOW = 10
+POLL_INTERVAL = 0.25
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS inflight (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    result TEXT
+);
+"""
+
+_lock = threading.Lock()
+_flights = {}
+
+class _LocalFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+class Flight:
+    """Handle returned by flight(): result is set for followers, the leader calls publish()."""
+
+    def __init__(self, result=None):
+        self.result = result
+        self.published = None
+
+    def publish(self, result):
+        self.published = result
+
+def flight_key(student_input, session_token, config):
+    digest = hashlib.sha256(f"{session_token or ''}\0{aigrader_cache.cache_key(student_input, config)}".encode('utf-8'))
+    return digest.hexdigest()
+
+def inflight_db(config):
+    return aigrader_store.open_db(aigrader_store.state_file(config, "inflight.db"), SCHEMA)
+
+def coalesced(result):
+    return dict(result, coalesced=True)
+
+# 🗄️ SHARED (cross-process) FLIGHTS
+def claim(config, key, owner):
+    """('leader', None), ('done', result) or ('wait', None) for this key in inflight.db."""
+    db = inflight_db(config)
+    now = time.time()
+    window = config.get("coalesce_window", DEFAULT_WINDOW)
+    timeout = config.get("coalesce_timeout", DEFAULT_TIMEOUT)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        row = db.execute("SELECT started_at, finished_at, result FROM inflight WHERE key = ?", (key,)).fetchone()
+        if row and row[1] is not None and row[1] >= now - window:
+            state = ('done', json.loads(row[2]))
+        elif row and row[1] is None and row[0] >= now - timeout:
+            state = ('wait', None)
+        else:
+            if row and row[1] is None:
+                aigrader_store.incr_counter(config, "coalesce_takeovers")
+            db.execute("INSERT OR REPLACE INTO inflight (key, owner, started_at, finished_at, result) VALUES (?, ?, ?, NULL, NULL)",
+                       (key, owner, now))
+            state = ('leader', None)
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    return state
+
+def finish(config, key, owner, result):
+    """Stores the leader's result. Without a successful one the key is released and waiting
+    processes grade by themselves."""
+    db = inflight_db(config)
+    now = time.time()
+    if not result or not result.get('success'):
+        db.execute("DELETE FROM inflight WHERE key = ? AND owner = ?", (key, owner))
+    else:
+        db.execute("UPDATE inflight SET finished_at = ?, result = ? WHERE key = ? AND owner = ?",
+                   (now, json.dumps(result, ensure_ascii=False), key, owner))
+    db.execute("DELETE FROM inflight WHERE finished_at < ?", (now - config.get("coalesce_window", DEFAULT_WINDOW),))
+
+def wait_shared(config, key, owner):
+    """Claims or waits for the key. Returns a finished result, or None once this process is the leader."""
+    deadline = time.monotonic() + config.get("coalesce_timeout", DEFAULT_TIMEOUT)
+    while True:
+        state, result = claim(config, key, owner)
+        if state != 'wait':
+            return result
+        if time.monotonic() > deadline:
+            return None
+        time.sleep(POLL_INTERVAL)
+
+# ✈️ FLIGHTS
+@contextlib.contextmanager
+def flight(student_input, session_token, config):
+    """Single-flight block: yields a Flight whose result is set when another request did the work."""
+    if not config.get("coalesce"):
+        yield Flight()
+        return
+    key = flight_key(student_input, session_token, config)
+    with _lock:
+        local = _flights.get(key)
+        leader = local is None
+        if leader:
+            local = _flights[key] = _LocalFlight()
+
+    if not leader:
+        aigrader_store.incr_counter(config, "coalesce_followers")
+        with aigrader_metrics.stage('coalesce'):
+            finished = local.event.wait(config.get("coalesce_timeout", DEFAULT_TIMEOUT))
+        if finished and local.result is not None:
+            aigrader_metrics.annotate(coalesced=True)
+            yield Flight(coalesced(local.result))
+        else:
+            yield Flight()
+        return
+
+    owner = f"{os.getpid()}:{threading.get_ident()}"
+    handle = Flight()
+    shared = False
+    try:
+        try:
+            with aigrader_metrics.stage('coalesce'):
+                result = wait_shared(config, key, owner)
+            shared = result is None
+        except sqlite3.Error:
+            result = None
+        if result is not None:
+            aigrader_store.incr_counter(config, "coalesce_followers")
+            aigrader_metrics.annotate(coalesced=True)
+            local.result = result
+            handle.result = coalesced(result)
+            yield handle
+            return
+        aigrader_store.incr_counter(config, "coalesce_leaders")
+        yield handle
+        if handle.published and handle.published.get('success'):
+            # A failed, rejected or errored result is not replayed: waiting requests grade by themselves.
+            local.result = handle.published
+    finally:
+        with _lock:
+            _flights.pop(key, None)
+        local.event.set()
+        if shared:
+            try:
+                finish(config, key, owner, handle.published)
+            except sqlite3.Error:
+                pass
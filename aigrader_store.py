@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_store.py
+
+# Shared helpers for the local SQLite state files (feedback cache, counters,
+# histograms...).
+# SQLite in WAL mode with a busy timeout is safe to use from many concurrent CGI
+# processes and from the threads of the persistent server.
+
+import os
+import sqlite3
+import threading
+
+BUSY_TIMEOUT = 30
+
+_local = threading.local()
+
+# Files kept per tenant when the configs of several activities share a state_dir (aigrader_tenants.py)
+TENANT_FILES = ("jobs.db", "lti_outbox.db", "metrics.db")
+
+def state_file(config, filename):
+    """Path of a state file under config['state_dir'] (defaults to the session directory)."""
+    state_dir = config.get("state_dir") or config.get("session_dir") or "/var/secure/lti_sessions"
+    if config.get("tenant") and filename in TENANT_FILES:
+        state_dir = os.path.join(state_dir, "tenants", config["tenant"])
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir, mode=0o700, exist_ok=True)
+    return os.path.join(state_dir, filename)
+
+def open_db(path, schema=''):
+    """Returns this thread's connection to the database at path, creating the schema once."""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if schema:
+            conn.executescript(schema)
+        try:
+            os.chmod(path, 0o600)
+        except OSError:
+            pass
+        connections[path] = conn
+    return conn
+
+# 📊 COUNTERS
+COUNTERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0);
+"""
+
+def metrics_db(config):
+    return open_db(state_file(config, "metrics.db"), COUNTERS_SCHEMA + HISTOGRAMS_SCHEMA)
+
+def incr_counter(config, name, amount=1):
+    """Adds amount to a named counter shared by every process using the same state_dir."""
+    try:
+        metrics_db(config).execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount))
+    except sqlite3.Error:
+        pass
+
+def read_counters(config, prefix=''):
+    rows = metrics_db(config).execute("SELECT name, value FROM counters WHERE name LIKE ? ORDER BY name", (prefix + '%',))
+    return dict(rows.fetchall())
+
+# ⏱️ HISTOGRAMS (fixed buckets, Prometheus style: each bucket counts values <= its bound)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 1500, 2000, 3000, 5000, 8000, 12000, 20000, 50000)
+SAMPLE_BUCKETS = (1, 2, 3, 4, 5, 6, 7, 8, 10, 15, 20)
+
+HISTOGRAMS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS histograms (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL DEFAULT '',
+    bucket REAL NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, labels, bucket)
+);
+CREATE TABLE IF NOT EXISTS histogram_totals (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL DEFAULT '',
+    count INTEGER NOT NULL DEFAULT 0,
+    sum REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, labels)
+);
+"""
+
+def observe(config, name, value, labels='', buckets=LATENCY_BUCKETS):
+    """Records one value (e.g. a latency in seconds) in a shared histogram."""
+    observe_many(config, [(name, value, labels)], buckets)
+
+def observe_many(config, observations, buckets=LATENCY_BUCKETS):
+    """Records several (name, value, labels) observations in a single transaction."""
+    try:
+        db = metrics_db(config)
+    except sqlite3.Error:
+        return
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        for name, value, labels in observations:
+            bound = next((b for b in buckets if value <= b), float('inf'))
+            db.execute("INSERT INTO histograms (name, labels, bucket, count) VALUES (?, ?, ?, 1) "
+                       "ON CONFLICT(name, labels, bucket) DO UPDATE SET count = count + 1", (name, labels, bound))
+            db.execute("INSERT INTO histogram_totals (name, labels, count, sum) VALUES (?, ?, 1, ?) "
+                       "ON CONFLICT(name, labels) DO UPDATE SET count = count + 1, sum = sum + excluded.sum", (name, labels, value))
+        db.execute("COMMIT")
+    except sqlite3.Error:
+        try:
+            db.execute("ROLLBACK")
+        except sqlite3.Error:
+            pass
+
+def read_histogram(config, name, labels=''):
+    """Returns ([(bucket, count), ...] sorted by bucket, total_count, total_sum). Counts are per bucket, not cumulative."""
+    db = metrics_db(config)
+    rows = db.execute("SELECT bucket, count FROM histograms WHERE name = ? AND labels = ? ORDER BY bucket", (name, labels)).fetchall()
+    totals = db.execute("SELECT count, sum FROM histogram_totals WHERE name = ? AND labels = ?", (name, labels)).fetchone()
+    return rows, (totals or (0, 0.0))[0], (totals or (0, 0.0))[1]
+
+def histogram_percentile(config, name, q, labels='', min_samples=20):
+    """Estimated q-quantile (0..1) with linear interpolation inside the bucket, or None without enough data."""
+    rows, total, _ = read_histogram(config, name, labels)
+    if total < min_samples:
+        return None
+    target = q * total
+    seen = 0
+    lower = 0.0
+    for bucket, count in rows:
+        if seen + count >= target and count:
+            if bucket == float('inf'):
+                return lower
+            return lower + (bucket - lower) * (target - seen) / count
+        seen += count
+        lower = bucket if bucket != float('inf') else lower
+    return lower
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_structured.py
+
+# Structured-output grading: the provider is asked for a JSON object that follows
+# a schema (OpenAI response_format json_schema, Gemini responseSchema) with one
+# score, feedback and evidence per criterion, the overall band and the strengths,
+# weaknesses and suggestions. The grade comes from that object in one parse and
+# the feedback shown to the student is rendered from it in the usual layout
+# (FINAL_GRADE line, score table, detailed analysis).
+# When the answer is not valid JSON the FINAL_GRADE regex is tried on the raw text.
+#
+# CONFIG options:
+#   "structured_output": True,
+#   "grade_max": 5,                        # top of the criterion and overall scale
+#   "structured_criteria": {"TA": "Task Achievement", ...},   # default: the four C1 criteria
+#
+# Counters (metrics.db, with "metrics": True): grade_parse:<mode>|<outcome>, where
+# mode is structured or regex and outcome ok, fallback (regex after bad JSON) or failed.
+
+import json
+import math
+import re
+
+DEFAULT_CRITERIA = {
+    "TA": "Task Achievement",
+    "CC": "Coherence and Cohesion",
+    "GRA": "Grammatical Accuracy and Range",
+    "LRA": "Lexical Accuracy and Range",
+}
+DEFAULT_MAX = 5
+SCHEMA_NAME = "grading"
+INSTRUCTION = ("\n\nReturn the evaluation as a JSON object following the response schema: for each criterion "
+               "its score, the feedback explaining it and evidence quoted from the text; the overall band; "
+               "strengths, weaknesses and practical suggestions for improvement.")
+FENCE_RE = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$')
+
+def criteria(config):
+    return config.get("structured_criteria") or DEFAULT_CRITERIA
+
+def json_schema(config):
+    """JSON schema of the grading object (OpenAI strict mode: every property required, no extras)."""
+    def obj(properties):
+        return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+    criterion = obj({
+        "score": {"type": "integer"},
+        "feedback": {"type": "string"},
+        "evidence": {"type": "string"},
+    })
+    string_list = {"type": "array", "items": {"type": "string"}}
+    return obj({
+        "criteria": obj({code: criterion for code in criteria(config)}),
+        "overall_band": {"type": "integer"},
+        "strengths": string_list,
+        "weaknesses": string_list,
+        "suggestions": string_list,
+    })
+
+def gemini_schema(schema):
+    """The same schema in Gemini's OpenAPI subset (upper-case types, no additionalProperties)."""
+    converted = {"type": schema["type"].upper()}
+    if "properties" in schema:
+        converted["properties"] = {name: gemini_schema(sub) for name, sub in schema["properties"].items()}
+        converted["required"] = list(schema["required"])
+        converted["propertyOrdering"] = list(schema["properties"])
+    if "items" in schema:
+        converted["items"] = gemini_schema(schema["items"])
+    return converted
+
+def apply_to_request(body, provider, config):
+    """Adds the response schema and the JSON instruction to a request body built by aigrader.build_ai_request."""
+    schema = json_schema(config)
+    if provider == "openai":
+        body["response_format"] = {"type": "json_schema", "json_schema": {"name": SCHEMA_NAME, "strict": True, "schema": schema}}
+        body["messages"][-1]["content"] += INSTRUCTION
+    else:
+        body.setdefault("generationConfig", {}).update({"responseMimeType": "application/json", "responseSchema": gemini_schema(schema)})
+        body["contents"][-1]["parts"][-1]["text"] += INSTRUCTION
+    return body
+
+def _score(value, maximum):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or math.isnan(value):
+        raise ValueError(f"invalid score {value!r}")
+    return min(max(float(value), 0.0), float(maximum))
+
+def parse(text, config):
+    """The grading object as a normalized dict, or None if text is not a valid one."""
+    try:
+        data = json.loads(FENCE_RE.sub('', text or ''))
+        maximum = config.get("grade_max", DEFAULT_MAX)
+        parsed = {}
+        for code in criteria(config):
+            entry = data["criteria"][code]
+            parsed[code] = {
+                "score": _score(entry["score"], maximum),
+                "feedback": str(entry.get("feedback", "")),
+                "evidence": str(entry.get("evidence", "")),
+            }
+        return {
+            "criteria": parsed,
+            "overall_band": _score(data["overall_band"], maximum),
+            "max": float(maximum),
+            "strengths": [str(s) for s in data.get("strengths") or []],
+            "weaknesses": [str(s) for s in data.get("weaknesses") or []],
+            "suggestions": [str(s) for s in data.get("suggestions") or []],
+        }
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+def _number(value):
+    return f"{value:g}"
+
+def render(details, config):
+    """Student-facing feedback text in the layout of the free-text prompt."""
+    names = criteria(config)
+    lines = [f"{config['grade_identifier']}: {_number(details['overall_band'])}/{_number(details['max'])}", "",
+             "Assessment Summary", f"Criteria\tScore (0-{_number(details['max'])})"]
+    lines += [f"{names[code]}\t{_number(entry['score'])}" for code, entry in details["criteria"].items()]
+    lines += [f"Overall Band\t{_number(details['overall_band'])}", "", "Detailed Analysis"]
+    for number, (code, entry) in enumerate(details["criteria"].items(), 1):
+        lines += [f"{number}. {names[code]}", f"•\tFeedback: {entry['feedback']}", f"•\tEvidence: {entry['evidence']}"]
+    for title, key in (("Strengths", "strengths"), ("Weaknesses", "weaknesses"), ("Suggestions for Improvement", "suggestions")):
+        if details[key]:
+            lines += ["", title] + [f"•\t{item}" for item in details[key]]
+    return "\n".join(lines)
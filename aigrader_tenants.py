@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_tenants.py
+
+# Multi-tenant hosting: one aigrader_server.py process serves every activity of a
+# directory of grader config scripts, one <activity_id>.py per activity, on one
+# endpoint (/grade by default):
+#  - POST /grade/<activity_id> grades with that activity's config;
+#  - POST /grade takes the activity from the LTI launch of the session_token: the
+#    custom parameter "activity" of the LTI link (custom_activity in the launch
+#    parameters stored by lti-receiver.py). Signed session tokens are verified
+#    with the keys of AIGRADER_SESSION_KEYS (see lti_sessions.py).
+# Files whose name does not start with a letter or digit (e.g. _shared.py) are not
+# activities: the config scripts can import common settings from them
+# (CONFIG = dict(_shared.BASE, ...)).
+#
+# Configs are loaded through the config registry (reloaded when their file changes,
+# a new file is picked up on its first request); each tenant uses a copy tagged
+# with "tenant", so a script also served by a route keeps its own state files. What is
+# per process is shared by every tenant: HTTP connection pools, provider clients,
+# prompt and rubric caches. Tenants that use the same state_dir also share the
+# feedback cache, rate limits, single-flight and provider health; jobs.db,
+# lti_outbox.db and metrics.db go to state_dir/tenants/<activity_id> (see
+# aigrader_store.state_file), so each tenant has its own queue, outbox workers and
+# metrics (exported with a tenant label).
+#
+#   python3 aigrader_server.py --tenants /etc/aigrader/activities --session-dir /var/secure/lti_sessions
+#   python3 aigrader_tenants.py /etc/aigrader/activities        # validate every config and list them
+
+import argparse
+import os
+import re
+import sys
+import threading
+
+import aigrader_config
+import lti_sessions
+
+ACTIVITY_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$')
+DEFAULT_ROUTE = '/grade'
+DEFAULT_ACTIVITY_PARAM = 'custom_activity'
+DEFAULT_SESSION_DIR = '/var/secure/lti_sessions'
+
+class TenantRegistry:
+    """Grader configs by activity ID, from the <activity_id>.py scripts of a directory."""
+
+    def __init__(self, config_dir, session_dir=DEFAULT_SESSION_DIR, activity_param=DEFAULT_ACTIVITY_PARAM,
+                 registry=None, on_load=None, session_keys=None):
+        self.config_dir = os.path.abspath(config_dir)
+        self.session_dir = session_dir
+        self.session_keys = session_keys if session_keys is not None else os.environ.get('AIGRADER_SESSION_KEYS')
+        self.activity_param = activity_param
+        self.registry = registry or aigrader_config.ConfigRegistry()
+        self.on_load = on_load
+        self.loaded = {}           # activity_id: (registry CONFIG, tenant copy)
+        self.lock = threading.Lock()
+
+    def activity_ids(self):
+        return sorted(name[:-3] for name in os.listdir(self.config_dir)
+                      if name.endswith('.py') and ACTIVITY_RE.match(name[:-3]))
+
+    def path_for(self, activity_id):
+        # The ID comes from the URL or the LMS: only plain file names inside config_dir.
+        if not isinstance(activity_id, str) or not ACTIVITY_RE.match(activity_id):
+            return None
+        path = os.path.join(self.config_dir, activity_id + '.py')
+        return path if os.path.isfile(path) else None
+
+    def get(self, activity_id):
+        """CONFIG of an activity, or None when there is no such activity."""
+        path = self.path_for(activity_id)
+        if path is None:
+            return None
+        config = self.registry.get(path)
+        loaded = self.loaded.get(activity_id)
+        if loaded is None or loaded[0] is not config:
+            # First time this CONFIG dict is seen (new activity or reloaded script). The tenant
+            # gets its own copy: the registry dict may also be served by a route, untagged.
+            with self.lock:
+                loaded = self.loaded.get(activity_id)
+                if loaded is None or loaded[0] is not config:
+                    loaded = (config, dict(config, tenant=activity_id))
+                    self.loaded[activity_id] = loaded
+                    if self.on_load:
+                        self.on_load(loaded[1])
+        return loaded[1]
+
+    def activity_for_session(self, session_token):
+        session = lti_sessions.load_session(session_token, self.session_dir, keys=self.session_keys) or {}
+        return (session.get('lti_params') or {}).get(self.activity_param)
+
+    def resolve(self, activity_id=None, data=None):
+        """Config of a request: the activity named in the path, else the one of its session's LTI launch."""
+        if not activity_id and isinstance(data, dict):
+            activity_id = self.activity_for_session(data.get('session_token') or data.get('token'))
+        return self.get(activity_id)
+
+    def load_all(self):
+        """Loads and validates every activity config: {activity_id: CONFIG}."""
+        return {activity_id: self.get(activity_id) for activity_id in self.activity_ids()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate the grader configs of a tenants directory.")
+    parser.add_argument('config_dir', help="Directory with one <activity_id>.py config script per activity")
+    args = parser.parse_args()
+
+    tenants = TenantRegistry(args.config_dir)
+    failed = 0
+    for activity_id in tenants.activity_ids():
+        try:
+            config = tenants.get(activity_id)
+            sys.stdout.write(f"{activity_id}: {config.get('provider')} {config.get('model_name')}\n")
+        except Exception as e:
+            failed += 1
+            sys.stdout.write(f"{activity_id}: ERROR {e}\n")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
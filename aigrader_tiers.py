@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#aigrader_tiers.py
+
+# Model tiering: each submission is graded by the first (fast, cheap) tier and only
+# sent to the next, stronger one when the answer is not trustworthy enough:
+#  - parse: no grade could be read from it;
+#  - inconsistent: in structured_output mode, the mean of the criterion scores is
+#    further than tier_max_inconsistency from the overall band;
+#  - boundary: the grade is within tier_margin of a pass/fail boundary, where a
+#    small grading error changes the outcome for the student;
+#  - error: the tier's provider call failed.
+# The last tier's answer is kept whatever it says. If it fails, the best earlier
+# answer is used. Each tier is an override of the top-level keys, like the
+# "providers" entries, and may have its own "providers" list for failover.
+#
+# Tiering needs the whole answer before deciding, so a config with tiers does not
+# stream.
+#
+# CONFIG options:
+#   "tiers": [
+#       {"model_name": "gemini-2.5-flash-lite"},
+#       {"model_name": "gemini-2.5-pro"},
+#   ],
+#   "tier_boundaries": [0.6],              # pass marks as a fraction of the maximum (0.6 = 3/5)
+#   "tier_margin": 0.1,                    # escalate grades within this fraction of a boundary
+#   "tier_max_inconsistency": 1,           # structured: |criteria mean - overall band|, in grade points
+#
+# Counters and histograms (metrics.db, with "metrics": True): tier_calls:<tier>|<outcome>
+# (accepted, escalated or failed), tier_escalations:<tier>|<reason> and
+# tier_latency_seconds:<tier>, where tier is provider:model. The escalation rate
+# and latency percentiles of each tier:
+#   python3 aigrader_tiers.py evaluate-certacles-writing-c1-LTI-conf.py
+
+import argparse
+import sys
+import time
+
+import aigrader
+import aigrader_metrics
+import aigrader_router
+import aigrader_store
+import aigrader_structured
+
+DEFAULT_MARGIN = 0.1
+DEFAULT_MAX_INCONSISTENCY = 1
+
+def tier_configs(config):
+    """The ordered list of per-tier configs."""
+    return [dict(config, tiers=None, **tier) for tier in config.get("tiers") or [{}]]
+
+def tier_name(config):
+    return aigrader_router.provider_name(config)
+
+def escalation_reason(feedback, config):
+    """Why an answer should go to the next tier, or None when it can be kept."""
+    details = aigrader_structured.parse(feedback, config) if config.get("structured_output") else None
+    if details is not None:
+        score, maximum = details['overall_band'], details['max']
+        scores = [entry['score'] for entry in details['criteria'].values()]
+        limit = config.get("tier_max_inconsistency", DEFAULT_MAX_INCONSISTENCY)
+        if scores and abs(sum(scores) / len(scores) - score) > limit:
+            return 'inconsistent'
+    else:
+        score, maximum = aigrader.extract_flexible_grade(feedback, config['grade_identifier'])
+    if score is None or not maximum:
+        return 'parse'
+    margin = config.get("tier_margin", DEFAULT_MARGIN)
+    if any(abs(score / maximum - boundary) <= margin for boundary in config.get("tier_boundaries") or ()):
+        return 'boundary'
+    return None
+
+def record(config, name, outcome, reason, seconds):
+    if not config.get("metrics"):
+        return
+    aigrader_store.incr_counter(config, f"tier_calls:{name}|{outcome}")
+    if reason:
+        aigrader_store.incr_counter(config, f"tier_escalations:{name}|{reason}")
+    aigrader_store.observe(config, "tier_latency_seconds", seconds, name)
+
+async def call_tiered_async(student_input, config):
+    """call_ai_api over the "tiers" list: the first acceptable answer, else the last (or best) one."""
+    tiers = tier_configs(config)
+    fallback = None
+    escalations = []
+    for number, tier in enumerate(tiers):
+        name = tier_name(tier)
+        started = time.monotonic()
+        result = await aigrader.call_ai_api_async(student_input, tier)
+        reason = escalation_reason(result['feedback'], tier) if result.get('success') else 'error'
+        last = number == len(tiers) - 1
+        if result.get('success') and (reason is None or last):
+            record(config, name, 'accepted', None, time.monotonic() - started)
+            aigrader_metrics.annotate(tier=name, escalations=escalations)
+            return dict(result, tier=number)
+        record(config, name, 'failed' if reason == 'error' else 'escalated', None if last else reason,
+               time.monotonic() - started)
+        escalations.append(f"{name}:{reason}")
+        # An answer that only missed the confidence checks beats a failed stronger tier.
+        if result.get('success') and (fallback is None or reason in ('boundary', 'inconsistent')):
+            fallback = dict(result, tier=number)
+    aigrader_metrics.annotate(tier=fallback and tier_name(tiers[fallback['tier']]), escalations=escalations)
+    return fallback or result
+
+def report(config):
+    """{tier: {'calls', 'escalation_rate', 'p50', 'p95'}} from metrics.db."""
+    counters = aigrader_store.read_counters(config, "tier_calls:")
+    rows = {}
+    for tier in tier_configs(config):
+        name = tier_name(tier)
+        calls = {outcome: counters.get(f"tier_calls:{name}|{outcome}", 0) for outcome in ('accepted', 'escalated', 'failed')}
+        total = sum(calls.values())
+        rows[name] = dict(calls, calls=total, escalation_rate=(calls['escalated'] + calls['failed']) / total if total else 0.0,
+                          p50=aigrader_store.histogram_percentile(config, "tier_latency_seconds", 0.5, name, min_samples=1),
+                          p95=aigrader_store.histogram_percentile(config, "tier_latency_seconds", 0.95, name, min_samples=1))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Escalation rate and latency of each model tier of a grader config.")
+    parser.add_argument('config', help="Grader config script with a \"tiers\" list")
+    args = parser.parse_args()
+
+    config = aigrader.load_config(args.config)
+    for name, row in report(config).items():
+        latency = " ".join(f"{q} {row[q]:.2f}s" for q in ('p50', 'p95') if row[q] is not None)
+        sys.stdout.write(f"{name}: {row['calls']} calls, {row['accepted']} accepted, "
+                         f"escalation rate {row['escalation_rate']:.1%} {latency}\n")
+        escalations = aigrader_store.read_counters(config, f"tier_escalations:{name}|")
+        for counter, value in escalations.items():
+            sys.stdout.write(f"    {counter.rsplit('|', 1)[1]}: {value}\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#batch-grade.py
+
+# Offline (re)grading of a whole cohort with a grader config script.
+#
+# Input: CSV or JSONL with an "id" and a "studentInput" (or "text") column. To push the
+# grades to the LMS add "session_token", or the LTI fields "lis_outcome_service_url",
+# "lis_result_sourcedid" and "oauth_consumer_key".
+#
+# Results are appended to --output (JSONL), which is also the checkpoint: running the
+# same command again skips the submissions that already have a grade.
+#
+#   python3 batch-grade.py --config evaluate-certacles-writing-c1-LTI-conf.py \
+#       --input cohort.csv --output cohort-results.jsonl --concurrency 16 [--send-grades [--verify-grades]]
+#   python3 batch-grade.py ... --mode openai-batch    # OpenAI Batch API (24h window, lower cost)
+#   python3 batch-grade.py ... --mode gemini-batch    # Gemini batchGenerateContent
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+import time
+import uuid
+
+import aigrader
+import aigrader_cache
+import aigrader_http
+import aigrader_outbox
+import aigrader_passback
+
+POLL_INTERVAL = 30
+
+def read_submissions(path):
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.endswith('.jsonl') or path.endswith('.ndjson'):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+    submissions = []
+    for index, row in enumerate(rows):
+        row = dict(row)
+        row['id'] = str(row.get('id') or row.get('lis_result_sourcedid') or index)
+        row['studentInput'] = (row.get('studentInput') or row.get('text') or '').strip()
+        submissions.append(row)
+    return submissions
+
+def read_checkpoint(path):
+    done = set()
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if result.get('success'):
+                    done.add(result['id'])
+    return done
+
+class ResultWriter:
+    def __init__(self, path, total):
+        self.file = open(path, 'a', encoding='utf-8')
+        self.total = total
+        self.ok = self.failed = 0
+        self.started = time.time()
+
+    def write(self, result):
+        self.file.write(json.dumps(result, ensure_ascii=False) + '\n')
+        self.file.flush()
+        if result.get('success'):
+            self.ok += 1
+        else:
+            self.failed += 1
+        count = self.ok + self.failed
+        if count % 10 == 0 or count == self.total:
+            sys.stderr.write(f"\r{count}/{self.total} graded ({self.failed} failed), {self.rate():.1f} submissions/min")
+            sys.stderr.flush()
+
+    def rate(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        return (self.ok + self.failed) * 60 / elapsed
+
+    def close(self):
+        self.file.close()
+        sys.stderr.write("\n")
+
+def lti_params_for(row, config):
+    if row.get('lis_outcome_service_url') and row.get('lis_result_sourcedid'):
+        return row
+    if row.get('session_token'):
+        return (aigrader.load_session(row['session_token'], config) or {}).get('lti_params', {})
+    return {}
+
+async def finish_row(row, feedback, config, passback):
+    display_feedback, score, maximum, details = aigrader.grade_feedback(feedback, config)
+    result = {'id': row['id'], 'success': score is not None, 'feedback': display_feedback,
+              'score_info': {'score': score, 'max': maximum}, 'lti_notified': False, 'lti_queued': False}
+    if details:
+        result['criteria'] = details['criteria']
+    if score is None:
+        result['error'] = 'Grade not found in the answer'
+        return result
+    lti_params = lti_params_for(row, config) if passback else {}
+    if lti_params:
+        grade = (lti_params.get('lis_outcome_service_url'), lti_params.get('lis_result_sourcedid'),
+                 lti_params.get('oauth_consumer_key'), score / maximum if maximum > 0 else 0)
+        if config.get("lti_outbox"):
+            result['lti_queued'] = aigrader_outbox.enqueue(*grade, config)
+        if not result['lti_queued']:
+            report = await passback.send(*grade)
+            result['lti_notified'] = report['ok']
+            if report.get('error'):
+                result['lti_error'] = report['error']
+            if 'verified' in report:
+                result['lti_verified'] = report['verified']
+    return result
+
+# 🧵 LOCAL WORKER POOL
+async def grade_pool(submissions, config, writer, concurrency, passback):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def grade(row):
+        async with slots:
+            cache_key, feedback = aigrader_cache.lookup(row['studentInput'], config)
+            if feedback is None:
+                answer = await aigrader.call_ai_api_async(row['studentInput'], config)
+                if not answer.get('success'):
+                    writer.write({'id': row['id'], 'success': False, 'error': answer.get('error')})
+                    return
+                feedback = answer['feedback']
+            result = await finish_row(row, feedback, config, passback)
+            if result['success']:
+                aigrader_cache.store(cache_key, feedback, config)
+            writer.write(result)
+
+    await asyncio.gather(*[grade(row) for row in submissions])
+
+# 📦 PROVIDER BATCH APIs
+def batch_state_path(output):
+    return output + '.batch.json'
+
+def load_batch_state(output):
+    path = batch_state_path(output)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return None
+
+def save_batch_state(output, state):
+    with open(batch_state_path(output), 'w') as f:
+        json.dump(state, f)
+
+async def api_request(method, url, config, body=None, headers=None, timeout=300):
+    headers = dict(headers or {})
+    if config.get("provider", "openai").lower() == "openai":
+        headers['Authorization'] = f"Bearer {config['api_key']}"
+    if isinstance(body, dict):
+        body = json.dumps(body)
+        headers['Content-Type'] = 'application/json'
+    response = await aigrader_http.get_client().request(method, url, body, headers, timeout=timeout)
+    return response.raise_for_status()
+
+def openai_base(config):
+    url = (config.get("api_url") or "https://api.openai.com").rstrip('/')
+    return url.split('/v1/')[0] if '/v1/' in url else url
+
+async def submit_openai_batch(submissions, config):
+    lines = []
+    for row in submissions:
+        _, _, _, body = aigrader.build_ai_request(row['studentInput'], config)
+        lines.append(json.dumps({"custom_id": row['id'], "method": "POST", "url": "/v1/chat/completions", "body": body}))
+    boundary = uuid.uuid4().hex
+    multipart = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"purpose\"\r\n\r\nbatch\r\n"
+                 f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"batch.jsonl\"\r\n"
+                 f"Content-Type: application/jsonl\r\n\r\n" + '\n'.join(lines) + f"\r\n--{boundary}--\r\n")
+    base = openai_base(config)
+    uploaded = await api_request('POST', f"{base}/v1/files", config, multipart,
+                                 {'Content-Type': f"multipart/form-data; boundary={boundary}"})
+    file_id = json.loads(uploaded.text())['id']
+    created = await api_request('POST', f"{base}/v1/batches", config,
+                                {"input_file_id": file_id, "endpoint": "/v1/chat/completions", "completion_window": "24h"})
+    return json.loads(created.text())['id']
+
+async def collect_openai_batch(batch_id, config):
+    """Waits for the batch and returns {custom_id: feedback or Exception}."""
+    base = openai_base(config)
+    while True:
+        batch = json.loads((await api_request('GET', f"{base}/v1/batches/{batch_id}", config)).text())
+        if batch['status'] in ('completed', 'failed', 'expired', 'cancelled'):
+            break
+        sys.stderr.write(f"\rOpenAI batch {batch_id}: {batch['status']} {batch.get('request_counts', {})}")
+        await asyncio.sleep(POLL_INTERVAL)
+    answers = {}
+    for key in ('output_file_id', 'error_file_id'):
+        if not batch.get(key):
+            continue
+        content = await api_request('GET', f"{base}/v1/files/{batch[key]}/content", config)
+        for line in content.text().splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get('response') or {}
+            if response.get('status_code') == 200:
+                answers[item['custom_id']] = aigrader.parse_ai_response(response['body'], 'openai')
+            else:
+                answers[item['custom_id']] = RuntimeError(json.dumps(item.get('error') or response.get('body')))
+    if not answers and batch['status'] != 'completed':
+        raise RuntimeError(f"OpenAI batch {batch_id} ended with status {batch['status']}")
+    return answers
+
+async def submit_gemini_batch(submissions, config):
+    requests = []
+    for row in submissions:
+        _, _, _, body = aigrader.build_ai_request(row['studentInput'], config)
+        requests.append({"request": body, "metadata": {"key": row['id']}})
+    base = (config.get("api_url") or "https://generativelanguage.googleapis.com").rstrip('/')
+    url = f"{base}/v1beta/models/{config['model_name']}:batchGenerateContent?key={config['api_key']}"
+    body = {"batch": {"display_name": f"aigrader-{int(time.time())}", "input_config": {"requests": {"requests": requests}}}}
+    created = await api_request('POST', url, config, body)
+    return json.loads(created.text())['name']
+
+async def collect_gemini_batch(batch_name, config):
+    base = (config.get("api_url") or "https://generativelanguage.googleapis.com").rstrip('/')
+    while True:
+        batch = json.loads((await api_request('GET', f"{base}/v1beta/{batch_name}?key={config['api_key']}", config)).text())
+        state = (batch.get('metadata') or {}).get('state', '')
+        if batch.get('done') or state in ('BATCH_STATE_SUCCEEDED', 'BATCH_STATE_FAILED', 'BATCH_STATE_CANCELLED', 'BATCH_STATE_EXPIRED'):
+            break
+        sys.stderr.write(f"\rGemini batch {batch_name}: {state}")
+        await asyncio.sleep(POLL_INTERVAL)
+    output = (batch.get('response') or batch.get('metadata', {}).get('output') or {})
+    inlined = (output.get('inlinedResponses') or {}).get('inlinedResponses', [])
+    answers = {}
+    for item in inlined:
+        key = (item.get('metadata') or {}).get('key')
+        try:
+            answers[key] = aigrader.parse_ai_response(item['response'], 'google')
+        except (KeyError, IndexError, TypeError):
+            answers[key] = RuntimeError(json.dumps(item.get('error') or item))
+    if not answers:
+        raise RuntimeError(f"Gemini batch {batch_name} ended without results ({state})")
+    return answers
+
+async def grade_batch(submissions, config, writer, passback, output, provider):
+    submit, collect = ((submit_openai_batch, collect_openai_batch) if provider == 'openai'
+                       else (submit_gemini_batch, collect_gemini_batch))
+    state = load_batch_state(output)
+    if not state:
+        # Recorded before waiting, so an interrupted run resumes polling the same batch.
+        state = {'batch': await submit(submissions, config), 'ids': [row['id'] for row in submissions]}
+        save_batch_state(output, state)
+    answers = await collect(state['batch'], config)
+    sys.stderr.write("\n")
+    by_id = {row['id']: row for row in submissions}
+    for row_id in state['ids']:
+        row = by_id.get(row_id)
+        if row is None:
+            continue
+        answer = answers.get(row_id, RuntimeError('Missing from batch output'))
+        if isinstance(answer, Exception):
+            writer.write({'id': row_id, 'success': False, 'error': str(answer)})
+        else:
+            writer.write(await finish_row(row, answer, config, passback))
+    os.remove(batch_state_path(output))
+
+def main():
+    parser = argparse.ArgumentParser(description="Grade a cohort of submissions with a grader config.")
+    parser.add_argument('--config', required=True, help="Grader config script (e.g. evaluate-certacles-writing-c1-LTI-conf.py)")
+    parser.add_argument('--input', required=True, help="CSV or JSONL with id and studentInput columns")
+    parser.add_argument('--output', required=True, help="Results JSONL, also used as checkpoint")
+    parser.add_argument('--mode', choices=['pool', 'openai-batch', 'gemini-batch'], default='pool')
+    parser.add_argument('--concurrency', type=int, default=8, help="Parallel LLM calls in pool mode")
+    parser.add_argument('--send-grades', action='store_true', help="Send the grades to the LMS (LTI 1.1 outcomes)")
+    parser.add_argument('--verify-grades', action='store_true', help="Read every grade sent back with readResult")
+    args = parser.parse_args()
+
+    config = aigrader.load_config(args.config)
+    done = read_checkpoint(args.output)
+    submissions = [row for row in read_submissions(args.input) if row['id'] not in done and row['studentInput']]
+    sys.stderr.write(f"{len(submissions)} submissions to grade ({len(done)} already done)\n")
+    if not submissions:
+        return
+
+    # One engine for the whole run: grades to each LMS host share its connections and concurrency limit.
+    passback = aigrader_passback.PassbackEngine(config, args.verify_grades or None) if args.send_grades else None
+    writer = ResultWriter(args.output, len(submissions))
+    try:
+        if args.mode == 'pool':
+            aigrader_http.run_sync(grade_pool(submissions, config, writer, args.concurrency, passback))
+        else:
+            provider = 'openai' if args.mode == 'openai-batch' else 'google'
+            if config.get("provider", "openai").lower() != provider:
+                parser.error(f"--mode {args.mode} needs a config with provider '{provider}'")
+            aigrader_http.run_sync(grade_batch(submissions, config, writer, passback, args.output, provider))
+    finally:
+        writer.close()
+    print(f"Graded {writer.ok}, failed {writer.failed}, {writer.rate():.1f} submissions/min")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#bench_consistency.py
+
+# Self-consistency grading (aigrader_consistency.py) against a local stub model
+# whose grade is noisy, like a sampled LLM: the true grade of the essay most of
+# the time, otherwise one band off, with a variable answer time. Every essay is
+# graded --resubmissions times in each mode, as a student resubmitting the same
+# text, and the report shows:
+#  - stable: essays that got the same grade every time; exact: grades equal to
+#    the true one;
+#  - LLM calls per grading: answers used (the samples metric) and calls sent to
+#    the provider, including the ones cancelled once a quorum agreed;
+#  - mean and p95 latency per grading.
+#
+#   python3 benchmarks/bench_consistency.py --essays 100 --resubmissions 5 --accuracy 0.7
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from bench_server import REPO_DIR, percentile
+from stub_llm import start_stub
+
+sys.path.insert(0, REPO_DIR)
+
+import aigrader
+import aigrader_consistency
+import aigrader_http
+
+TRUE_GRADE_RE = re.compile(r'\[true grade (\d)\]')
+
+def essay(number, grade):
+    return f"####TASK\n\nWrite an article.\n\n####ANSWER\n\n[true grade {grade}] Essay {number}. " + "Some text. " * 50
+
+def noisy_model(accuracy, latency, seed):
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def answer(request):
+        grade = int(TRUE_GRADE_RE.search(json.dumps(request)).group(1))
+        with lock:
+            roll, step, extra = rng.random(), rng.choice((-1, 1)), rng.lognormvariate(0, 0.5) * latency
+        time.sleep(extra)
+        if roll > accuracy:
+            grade = min(max(grade + step, 1), 5)
+        return f"FINAL_GRADE: {grade}/5\n\nCriteria\tScore (0-5)\nTask Achievement\t{grade}\n"
+    return answer
+
+async def grade_all(essays, config, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(text):
+        async with slots:
+            started = time.monotonic()
+            result = await aigrader.call_ai_api_async(text, config)
+            score = aigrader_consistency.sample_score(result.get('feedback') or '', config)
+            return score, result.get('samples', 1), time.monotonic() - started
+    return await asyncio.gather(*[one(text) for text in essays])
+
+def main():
+    parser = argparse.ArgumentParser(description="Grade stability and cost of self-consistency sampling, against a noisy stub LLM.")
+    parser.add_argument('--essays', type=int, default=100)
+    parser.add_argument('--resubmissions', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.2, help="Median answer time of the stub, in seconds")
+    parser.add_argument('--accuracy', type=float, default=0.7, help="Fraction of answers with the true grade")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    grades = [rng.choice((1, 2, 3, 3, 4, 4, 5)) for _ in range(args.essays)]
+    essays = [essay(number, grade) for number, grade in enumerate(grades)]
+    stub, url = start_stub(0, answer=noisy_model(args.accuracy, args.latency, args.seed))
+    base = {'provider': 'openai', 'api_key': 'stub', 'api_url': url, 'model_name': 'noisy',
+            'system_instructions': 'Grade the essay.', 'grade_identifier': 'FINAL_GRADE', 'session_dir': tempfile.mkdtemp()}
+    modes = [
+        ('single call', base),
+        ('3 samples, quorum 2', dict(base, samples=3, sample_quorum=2)),
+        ('5 samples, quorum 3', dict(base, samples=5, sample_quorum=3)),
+        ('5 samples, all', dict(base, samples=5, sample_quorum=6)),   # no early stop
+    ]
+
+    print(f"{args.essays} essays x {args.resubmissions} submissions, stub {args.accuracy:.0%} exact, "
+          f"median {args.latency * 1000:.0f} ms")
+    print(f"  {'':<22}{'stable':>8}{'exact':>8}{'used':>7}{'sent':>7}{'mean':>8}{'p95':>8}")
+    for label, config in modes:
+        sent = stub.stats['requests']
+        rounds = [aigrader_http.run_sync(grade_all(essays, config, args.concurrency), timeout=3600)
+                  for _ in range(args.resubmissions)]
+        sent = (stub.stats['requests'] - sent) / (args.essays * args.resubmissions)
+        per_essay = list(zip(*rounds))
+        stable = sum(1 for results in per_essay if len({score for score, _, _ in results}) == 1) / args.essays
+        flat = [result for results in per_essay for result in results]
+        exact = sum(1 for results, grade in zip(per_essay, grades) for score, _, _ in results if score == grade) / len(flat)
+        used = statistics.mean(samples for _, samples, _ in flat)
+        latencies = [seconds for _, _, seconds in flat]
+        print(f"  {label:<22}{stable:>8.1%}{exact:>8.1%}{used:>7.2f}{sent:>7.2f}"
+              f"{statistics.mean(latencies):>7.2f}s{percentile(latencies, 0.95):>7.2f}s")
+
+if __name__ == "__main__":
+    main()
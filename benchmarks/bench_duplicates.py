@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#bench_duplicates.py
+
+# Near-duplicate index (aigrader_duplicates.py) at cohort scale, with synthetic
+# essays: words drawn from a Zipf-like vocabulary, each starting with the same
+# template sentence (as students copy the task's opening), no LLM involved.
+#  - indexing: submissions per second and the size of near_duplicates.db;
+#  - lookups: p50 / p99 latency (signature + indexed query + candidate check) of
+#    unrelated essays and of near copies (a few words changed) against the full index;
+#  - quality: near copies at several edit rates, with their true Jaccard similarity
+#    (from the shingle sets) and the fraction found above the threshold (recall),
+#    and unrelated essays wrongly flagged (false positives).
+#
+#   python3 benchmarks/bench_duplicates.py --essays 100000 --queries 2000 --threshold 0.8
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from bench_server import REPO_DIR, percentile
+
+sys.path.insert(0, REPO_DIR)
+
+import aigrader_duplicates
+
+TEMPLATE = "Dear editor I am writing to share my opinion about the article published last week in your magazine"
+EDIT_RATES = (0.0, 0.02, 0.05, 0.1, 0.2, 0.4)
+
+class Essays:
+    def __init__(self, seed, vocabulary=8000, words=250):
+        self.rng = random.Random(seed)
+        self.vocabulary = [f"word{i}" for i in range(vocabulary)]
+        self.weights = [1 / (rank + 1) ** 0.8 for rank in range(vocabulary)]
+        self.words = words
+
+    def new(self):
+        return TEMPLATE + ' ' + ' '.join(self.rng.choices(self.vocabulary, self.weights, k=self.words))
+
+    def edit(self, text, rate):
+        """A near copy: a fraction of the words replaced, inserted or removed."""
+        words = text.split()
+        for _ in range(int(len(words) * rate)):
+            position = self.rng.randrange(len(words))
+            action = self.rng.random()
+            if action < 0.6:
+                words[position] = self.rng.choice(self.vocabulary)
+            elif action < 0.8:
+                words.insert(position, self.rng.choice(self.vocabulary))
+            elif len(words) > 1:
+                del words[position]
+        return ' '.join(words)
+
+def jaccard(a, b):
+    a, b = aigrader_duplicates.shingles(a), aigrader_duplicates.shingles(b)
+    return len(a & b) / len(a | b)
+
+def main():
+    parser = argparse.ArgumentParser(description="Near-duplicate index: indexing rate, size, lookup latency and recall.")
+    parser.add_argument('--essays', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--threshold', type=float, default=aigrader_duplicates.DEFAULT_THRESHOLD)
+    parser.add_argument('--bands', type=int, default=aigrader_duplicates.DEFAULT_BANDS)
+    parser.add_argument('--perm', type=int, default=aigrader_duplicates.DEFAULT_PERM)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    state_dir = tempfile.mkdtemp()
+    config = {'near_duplicates': True, 'state_dir': state_dir, 'near_duplicate_threshold': args.threshold,
+              'near_duplicate_bands': args.bands, 'near_duplicate_perm': args.perm,
+              'near_duplicate_max_entries': args.essays * 2, 'system_instructions': 'Grade the essay.', 'model_name': 'bench'}
+    essays = Essays(args.seed)
+    try:
+        indexed = []
+        started = time.perf_counter()
+        for number in range(args.essays):
+            text = essays.new()
+            aigrader_duplicates.add(aigrader_duplicates.lookup(text, config), None, config)
+            if number < args.queries:
+                indexed.append(text)
+            if (number + 1) % 20000 == 0:
+                print(f"  indexed {number + 1} ({(number + 1) / (time.perf_counter() - started):.0f}/s)", flush=True)
+        elapsed = time.perf_counter() - started
+        index = aigrader_duplicates.get_index(config)
+        index.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        size = os.path.getsize(index.path)
+        print(f"{args.essays} essays indexed in {elapsed:.0f} s ({args.essays / elapsed:.0f}/s, lookup + add), "
+              f"{size / 1e6:.1f} MB ({size / args.essays:.0f} bytes per essay); "
+              f"{args.perm} values, {args.bands} bands, threshold {args.threshold}")
+
+        # recall: found among the near copies whose true similarity reaches the threshold
+        print(f"  {'':<14}{'jaccard':>9}{'found':>8}{'recall':>8}{'estimate':>10}{'p50 ms':>9}{'p99 ms':>9}")
+        rows = [('unrelated', None)] + [(f"{rate:.0%} edited", rate) for rate in EDIT_RATES]
+        for label, rate in rows:
+            latencies, found, similarities, estimates, above = [], 0, [], [], []
+            for original in indexed:
+                text = essays.new() if rate is None else essays.edit(original, rate)
+                started = time.perf_counter()
+                match = aigrader_duplicates.lookup(text, config)
+                latencies.append((time.perf_counter() - started) * 1000)
+                found += bool(match.doc_id)
+                estimates.append(match.similarity)
+                if rate is not None:
+                    similarities.append(jaccard(original, text))
+                    if similarities[-1] >= args.threshold:
+                        above.append(bool(match.doc_id))
+            mean_jaccard = f"{sum(similarities) / len(similarities):.3f}" if similarities else '-'
+            recall = f"{sum(above) / len(above):.1%}" if above else '-'
+            print(f"  {label:<14}{mean_jaccard:>9}{found / len(indexed):>8.1%}{recall:>8}{sum(estimates) / len(estimates):>10.3f}"
+                  f"{percentile(latencies, 0.5):>9.2f}{percentile(latencies, 0.99):>9.2f}")
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
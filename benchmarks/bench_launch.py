@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#bench_launch.py
+
+# Time to interactive of an LTI launch, from the LMS form POST to the activity
+# page with its script loaded, before and after the fast launch path:
+#  - before: lti-receiver.py status page, its 1.5 s setTimeout redirect, the
+#    original page and aigrader.js (the template is injected by the script);
+#  - after: lti-receiver.py 303 redirect, the page pre-rendered by build-pages.py
+#    (form visible on arrival) and aigrader.<hash>.min.js, which a returning
+#    student has in cache (immutable, no request) instead of revalidating it.
+# lti-receiver.py runs as a CGI process, as deployed, and the pages come from a
+# local static server; the network is modelled with --rtt per request and
+# --bandwidth on the gzip sizes. The browser's own parsing and script execution
+# are not included.
+#
+#   python3 benchmarks/bench_launch.py --launches 20 --rtt 0.05 --bandwidth 10
+
+import argparse
+import gzip
+import http.client
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from bench_server import REPO_DIR, percentile
+from load_test import ORIGIN, TOKEN_RE, run_cgi
+
+PAGE = 'C1-writing-correction-LTI.html'
+DELAY_RE = re.compile(r'\}, (\d+)\);')
+SCRIPT_RE = re.compile(r'<script src="([^"]+)"')
+
+RECEIVER_TEMPLATE = '''import sys, importlib.util
+sys.path.insert(0, {repo!r})
+spec = importlib.util.spec_from_file_location("lti_receiver", {receiver!r})
+receiver = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(receiver)
+receiver.SESSION_DIR = {session_dir!r}
+receiver.ALLOWED_ORIGINS = [{origin!r}]
+receiver.FAST_REDIRECT = {fast!r}
+receiver.main()
+'''
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def start_static(docroot):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=docroot))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class Network:
+    """Modelled cost of each request: one round trip plus the gzip-compressed body at the given bandwidth."""
+
+    def __init__(self, rtt, bandwidth_mbit):
+        self.rtt = rtt
+        self.bytes_per_second = bandwidth_mbit * 1e6 / 8
+
+    def cost(self, body):
+        return self.rtt + len(gzip.compress(body)) / self.bytes_per_second if body else self.rtt
+
+def get(port, path, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', path, headers=headers or {})
+    resp = conn.getresponse()
+    body = resp.read()
+    conn.close()
+    return resp.status, resp.getheader('Last-Modified'), body
+
+def launch_form(user):
+    return urllib.parse.urlencode({'lis_outcome_service_url': 'https://lms.example/outcomes',
+                                   'lis_result_sourcedid': f"user-{user}", 'oauth_consumer_key': 'bench',
+                                   'user_id': str(user)}).encode('utf-8')
+
+def one_launch(receiver, port, user, network, cached, validators):
+    """Seconds until the form is visible and until the script is loaded (measured + modelled network).
+
+    validators keeps the Last-Modified of each script seen on a first visit, as the browser cache does.
+    """
+    form = launch_form(user)
+    env = {'REQUEST_METHOD': 'POST', 'QUERY_STRING': f'file=/{PAGE}', 'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+           'CONTENT_LENGTH': str(len(form)), 'HTTP_ORIGIN': ORIGIN, 'HTTP_HOST': 'yourserver.com'}
+    started = time.perf_counter()
+    out, _ = run_cgi(receiver, form, env)
+    headers, _, body = out.partition('\n\n')
+    network_time = network.cost(body.encode('utf-8'))
+    delay = DELAY_RE.search(body)
+    if delay and 'Status: 303' not in headers:
+        network_time += int(delay.group(1)) / 1000   # the status page waits before redirecting
+    token = TOKEN_RE.search(out).group(1)
+    _, _, page = get(port, f"/{PAGE}?token={token}&mode=lti")
+    network_time += network.cost(page)
+    prerendered = b'data-prerendered' in page
+    visible = time.perf_counter() - started + network_time
+
+    script = SCRIPT_RE.search(page.decode('utf-8')).group(1)
+    if cached and '.min.js' in script:
+        pass   # content-hashed and immutable: no request at all
+    elif cached:
+        # Revalidation of the cached aigrader.js (304)
+        get(port, script, {'If-Modified-Since': validators[script]})
+        network_time += network.cost(b'')
+    else:
+        _, validators[script], js = get(port, script)
+        network_time += network.cost(js)
+    interactive = time.perf_counter() - started + network_time
+    return (visible if prerendered else interactive), interactive
+
+def prepare(workdir, fast):
+    docroot = os.path.join(workdir, 'after' if fast else 'before')
+    os.makedirs(docroot)
+    if fast:
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, 'build-pages.py'), '--output', docroot,
+                        os.path.join(REPO_DIR, PAGE)], check=True, stdout=subprocess.DEVNULL)
+    else:
+        shutil.copy(os.path.join(REPO_DIR, PAGE), docroot)
+        shutil.copy(os.path.join(REPO_DIR, 'aigrader.js'), docroot)
+    session_dir = os.path.join(workdir, 'sessions')
+    os.makedirs(session_dir, exist_ok=True)
+    receiver = os.path.join(workdir, f"lti-receiver-{'fast' if fast else 'page'}.py")
+    with open(receiver, 'w') as f:
+        f.write(RECEIVER_TEMPLATE.format(repo=REPO_DIR, receiver=os.path.join(REPO_DIR, 'lti-receiver.py'),
+                                         session_dir=session_dir, origin=ORIGIN, fast=fast))
+    return docroot, receiver
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to interactive of an LTI launch, status page vs 303 + pre-rendered page.")
+    parser.add_argument('--launches', type=int, default=20)
+    parser.add_argument('--rtt', type=float, default=0.05, help="Modelled round trip per request, in seconds")
+    parser.add_argument('--bandwidth', type=float, default=10, help="Modelled bandwidth, in Mbit/s")
+    args = parser.parse_args()
+
+    network = Network(args.rtt, args.bandwidth)
+    workdir = tempfile.mkdtemp()
+    print(f"{args.launches} launches, rtt {args.rtt * 1000:.0f} ms, {args.bandwidth:g} Mbit/s (median / p95 seconds)")
+    print(f"  {'':<34}{'form visible':>16}{'interactive':>16}")
+    try:
+        for fast in (False, True):
+            docroot, receiver = prepare(workdir, fast)
+            static = start_static(docroot)
+            validators = {}
+            for cached in (False, True):
+                runs = [one_launch(receiver, static.server_port, user, network, cached, validators) for user in range(args.launches)]
+                visible = [run[0] for run in runs]
+                interactive = [run[1] for run in runs]
+                label = ("303 + pre-rendered" if fast else "status page + delay") + (", returning" if cached else ", first visit")
+                print(f"  {label:<34}{percentile(visible, 0.5):>8.3f} / {percentile(visible, 0.95):.3f}"
+                      f"{percentile(interactive, 0.5):>8.3f} / {percentile(interactive, 0.95):.3f}")
+            static.shutdown()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
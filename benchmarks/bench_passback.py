@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#bench_passback.py
+
+# LTI 1.1 grade passback throughput:
+#  - signing: replaceResult requests built and signed per second, rebuilding
+#    everything for each grade (URL parsing, HMAC keying, escaping every parameter)
+#    versus aigrader.build_lti_request with its cached key state and base string;
+#  - sending: grades per second to the stub LMS (benchmarks/stub_lms.py, which
+#    verifies every signature) one after the other versus the PassbackEngine, with
+#    and without readResult verification.
+#
+#   python3 benchmarks/bench_passback.py --grades 500 --host-concurrency 8 --lms-latency 0.05
+
+import argparse
+import base64
+import hashlib
+import hmac
+import os
+import sys
+import tempfile
+import time
+import urllib.parse
+import uuid
+
+from stub_lms import start_lms
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import aigrader
+import aigrader_http
+import aigrader_passback
+
+CONSUMER_KEY = 'bench'
+CONSUMER_SECRET = 'bench-secret/with+reserved=chars'
+
+def sign_from_scratch(outcome_url, sourcedid, consumer_key, score, secret):
+    """Reference: every step redone for each grade."""
+    xml_body = f"""<?xml version="1.0" encoding="UTF-8"?>
+<imsx_POXEnvelopeRequest xmlns="http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0">
+  <imsx_POXHeader><imsx_POXRequestHeaderInfo><imsx_version>V1.0</imsx_version>
+  <imsx_messageIdentifier>{uuid.uuid4()}</imsx_messageIdentifier></imsx_POXRequestHeaderInfo></imsx_POXHeader>
+  <imsx_POXBody><replaceResultRequest><resultRecord>
+  <sourcedGUID><sourcedId>{sourcedid}</sourcedId></sourcedGUID>
+  <result><resultScore><language>en</language><textString>{float(score):.4f}</textString></resultScore></result>
+  </resultRecord></replaceResultRequest></imsx_POXBody></imsx_POXEnvelopeRequest>"""
+    oauth_params = {
+        'oauth_body_hash': base64.b64encode(hashlib.sha1(xml_body.encode('utf-8')).digest()).decode('utf-8'),
+        'oauth_consumer_key': consumer_key,
+        'oauth_nonce': uuid.uuid4().hex,
+        'oauth_signature_method': 'HMAC-SHA1',
+        'oauth_timestamp': str(int(time.time())),
+        'oauth_version': '1.0',
+    }
+    quote = lambda value: urllib.parse.quote(str(value), safe='~')
+    parsed = urllib.parse.urlparse(outcome_url)
+    params = list(oauth_params.items()) + urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+    normalized = '&'.join(f"{k}={v}" for k, v in sorted((quote(k), quote(v)) for k, v in params))
+    base_url = f"{parsed.scheme.lower()}://{parsed.netloc.lower()}{parsed.path or '/'}"
+    base_string = '&'.join(('POST', quote(base_url), quote(normalized)))
+    key = f"{quote(secret)}&".encode('utf-8')
+    oauth_params['oauth_signature'] = base64.b64encode(hmac.new(key, base_string.encode('utf-8'), hashlib.sha1).digest()).decode()
+    return xml_body, 'OAuth ' + ', '.join(f'{k}="{quote(v)}"' for k, v in oauth_params.items())
+
+def signing_rate(func, seconds=1.0):
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        for _ in range(200):
+            func()
+        count += 200
+    return count / (time.perf_counter() - started)
+
+async def send_sequential(grades, config):
+    for grade in grades:
+        await aigrader.post_grade_async(*grade, config)
+
+def timed(coro_factory):
+    started = time.perf_counter()
+    result = aigrader_http.run_sync(coro_factory(), timeout=600)
+    return time.perf_counter() - started, result
+
+def main():
+    parser = argparse.ArgumentParser(description="LTI outcome signing and bulk passback throughput.")
+    parser.add_argument('--grades', type=int, default=300)
+    parser.add_argument('--host-concurrency', type=int, default=8)
+    parser.add_argument('--lms-latency', type=float, default=0.02, help="Stub LMS latency in seconds")
+    args = parser.parse_args()
+
+    lms, outcome_url = start_lms({CONSUMER_KEY: CONSUMER_SECRET}, args.lms_latency)
+    config = {'LTI_ALLOWED_DOMAINS': '127.0.0.1', 'LTI_ALLOW_HTTP': True,
+              'lti_consumer_secrets': {CONSUMER_KEY: CONSUMER_SECRET}, 'session_dir': tempfile.mkdtemp()}
+
+    print("Signing (replaceResult envelope + body hash + HMAC-SHA1 signature):")
+    before = signing_rate(lambda: sign_from_scratch(outcome_url, 'course-v1:X+Y+Z:user-1', CONSUMER_KEY, 0.8, CONSUMER_SECRET))
+    after = signing_rate(lambda: aigrader.build_lti_request(outcome_url, 'course-v1:X+Y+Z:user-1', CONSUMER_KEY, 0.8, config))
+    print(f"  from scratch             {before:>10.0f} /s")
+    print(f"  build_lti_request        {after:>10.0f} /s   ({after / before:.2f}x)")
+
+    grades = [(outcome_url, f"user-{i}", CONSUMER_KEY, (i % 11) / 10) for i in range(args.grades)]
+    print(f"Sending {args.grades} grades to the stub LMS (latency {args.lms_latency * 1000:.0f} ms):")
+    elapsed, _ = timed(lambda: send_sequential(grades, config))
+    print(f"  one by one               {args.grades / elapsed:>10.1f} grades/s")
+    for verify in (False, True):
+        engine = aigrader_passback.PassbackEngine(config, verify, args.host_concurrency)
+        elapsed, reports = timed(lambda: engine.send_all(grades))
+        failed = [r for r in reports if not r['ok']]
+        label = f"engine x{args.host_concurrency}" + (" + readResult" if verify else "")
+        print(f"  {label:<24} {args.grades / elapsed:>10.1f} grades/s   failed {len(failed)}")
+    print(f"  LMS stats: {lms.stats}")
+    lms.shutdown()
+
+if __name__ == "__main__":
+    main()
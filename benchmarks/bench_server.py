@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#bench_server.py
+
+# Compares the CGI path (one interpreter per submission, as fcgiwrap does) with the
+# persistent aigrader_server.py process, both grading against the local stub LLM.
+# The real C1 config is loaded in both cases so the startup cost is realistic.
+#
+#   python3 benchmarks/bench_server.py --requests 200 --concurrency 20 --latency 0.2
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from stub_llm import start_stub
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REAL_CONF = os.path.join(REPO_DIR, 'evaluate-certacles-writing-c1-LTI-conf.py')
+ROUTE = '/cgi-bin/bench-conf.py'
+
+CONF_TEMPLATE = '''import sys, runpy
+sys.path.insert(0, {repo!r})
+CONFIG = runpy.run_path({real_conf!r})["CONFIG"]
+CONFIG.update({overrides!r})
+import aigrader
+if __name__ == "__main__":
+    aigrader.run(CONFIG)
+'''
+
+SUBMISSION = json.dumps({
+    'studentInput': "####TASK\n\nWrite an article.\n\n####ANSWER\n\n" + "Studying abroad changes the way we see the world. " * 40,
+    'defaultValue': "####TASK####ANSWER",
+    'session_token': '',
+})
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def cgi_request(conf_path):
+    env = dict(os.environ, REQUEST_METHOD='POST', CONTENT_LENGTH=str(len(SUBMISSION)), HTTP_ORIGIN='https://yourserver.com')
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, conf_path], input=SUBMISSION.encode('utf-8'), env=env, capture_output=True)
+    elapsed = time.perf_counter() - start
+    body = out.stdout.decode('utf-8').split('\n\n', 1)[-1]
+    return elapsed, json.loads(body).get('success', False)
+
+def server_request(port):
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=180)
+    conn.request('POST', ROUTE, body=SUBMISSION.encode('utf-8'), headers={'Content-Type': 'application/json'})
+    payload = json.loads(conn.getresponse().read().decode('utf-8'))
+    conn.close()
+    return time.perf_counter() - start, payload.get('success', False)
+
+def measure(name, func, total, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        results = list(pool.map(lambda _: func(), range(total)))
+        wall = time.perf_counter() - start
+    latencies = [r[0] for r in results]
+    failures = sum(1 for r in results if not r[1])
+    print(f"{name:<8} {total / wall:>9.1f} req/s  p50 {percentile(latencies, 0.5) * 1000:>8.1f} ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:>8.1f} ms  failures {failures}")
+
+def wait_for_server(port, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("aigrader_server.py exited during startup")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('OPTIONS', ROUTE)
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("aigrader_server.py did not start")
+
+def main():
+    parser = argparse.ArgumentParser(description="CGI vs persistent server throughput with a stub LLM.")
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.2, help="Stub LLM latency in seconds")
+    args = parser.parse_args()
+
+    stub, stub_url = start_stub(args.latency)
+    with tempfile.TemporaryDirectory() as workdir:
+        overrides = {
+            'provider': 'openai', 'api_url': stub_url, 'api_key': 'stub', 'model_name': 'stub',
+            'CORS_ALLOWED_ORIGINS': '*', 'session_dir': workdir, 'send_grade_to_lms': False,
+        }
+        conf_path = os.path.join(workdir, 'bench-conf.py')
+        with open(conf_path, 'w') as f:
+            f.write(CONF_TEMPLATE.format(repo=REPO_DIR, real_conf=REAL_CONF, overrides=overrides))
+
+        print(f"{args.requests} requests, concurrency {args.concurrency}, stub latency {args.latency * 1000:.0f} ms")
+        measure('cgi', lambda: cgi_request(conf_path), args.requests, args.concurrency)
+
+        port = free_port()
+        proc = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'aigrader_server.py'), '--port', str(port),
+                                 f"{ROUTE}={conf_path}"], stderr=subprocess.DEVNULL)
+        try:
+            wait_for_server(port, proc)
+            measure('server', lambda: server_request(port), args.requests, args.concurrency)
+        finally:
+            proc.terminate()
+            proc.wait()
+    stub.shutdown()
+
+if __name__ == "__main__":
+    main()
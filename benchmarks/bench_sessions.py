@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#bench_sessions.py
+
+# Cost of recovering the LTI fields of a submission from its session token, as
+# aigrader.load_session does on every graded submission:
+#  - file:   one <token>.json file per launch, opened and parsed;
+#  - sqlite: a primary key read from sessions.db (a new connection per process);
+#  - signed: HMAC-SHA256 check of a stateless token, in memory;
+#  - encrypted: AES-GCM opening of a sealed token (only with the cryptography package).
+# Plus the cost of issuing one (lti-receiver.py) and the token length. The
+# session directory is on the local disk and in the page cache, the best case for
+# the file and sqlite stores; a shared network directory adds its round trips.
+#
+#   python3 benchmarks/bench_sessions.py --sessions 2000 --lookups 20000
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from bench_server import REPO_DIR, percentile
+
+sys.path.insert(0, REPO_DIR)
+
+import lti_sessions
+
+KEYS = {'2026b': 'bench-secret-new', '2026a': 'bench-secret-old'}
+
+def launch_params(user):
+    return {'lis_outcome_service_url': 'https://lms.example.edu/courses/course-v1:UPV+C1W+2026/xblock/block-v1:lti/handler_noauth/grade_handler',
+            'lis_result_sourcedid': f"course-v1%3AUPV%2BC1W%2B2026:lms.example.edu-{user:032x}:{user}",
+            'oauth_consumer_key': 'openedx_key', 'custom_activity': 'c1-writing', 'user_id': str(user),
+            'context_title': 'C1 Writing', 'launch_presentation_return_url': 'https://lms.example.edu/courses/'}
+
+def timed(function, tokens, lookups, rng):
+    """Microseconds per call, one random token each time."""
+    samples = []
+    for _ in range(lookups):
+        token = rng.choice(tokens)
+        started = time.perf_counter()
+        session = function(token)
+        samples.append((time.perf_counter() - started) * 1e6)
+        assert session and session['lti_params']['lis_result_sourcedid'], token
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description="Session lookup cost: token.json files and sessions.db vs signed tokens.")
+    parser.add_argument('--sessions', type=int, default=2000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp()
+    file_dir = os.path.join(workdir, 'file')
+    sqlite_dir = os.path.join(workdir, 'sqlite')
+    launches = [launch_params(user) for user in range(args.sessions)]
+    modes = []
+    try:
+        for backend, session_dir in (('file', file_dir), ('sqlite', sqlite_dir)):
+            store = lti_sessions.get_session_store(backend, session_dir)
+            tokens = [f"{user:032x}" for user in range(args.sessions)]
+            started = time.perf_counter()
+            for token, params in zip(tokens, launches):
+                store.save(token, params)
+            issue = (time.perf_counter() - started) * 1e6 / args.sessions
+            modes.append((backend, tokens, issue, lambda token, d=session_dir, b=backend: lti_sessions.load_session(token, d, b)))
+        for encrypt in (False, True):
+            if encrypt and lti_sessions.AESGCM is None:
+                print("  (encrypted tokens skipped: the cryptography package is not installed)")
+                continue
+            store = lti_sessions.signed_store(KEYS, encrypt=encrypt)
+            started = time.perf_counter()
+            tokens = [store.issue(params) for params in launches]
+            issue = (time.perf_counter() - started) * 1e6 / args.sessions
+            # Tokens signed with the old key still verify after a rotation
+            old = lti_sessions.SignedSessionStore(dict(reversed(list(KEYS.items()))), encrypt=encrypt)
+            tokens[::10] = [old.issue(params) for params in launches[::10]]
+            modes.append(('encrypted' if encrypt else 'signed', tokens, issue,
+                          lambda token: lti_sessions.load_session(token, workdir, 'signed', KEYS)))
+
+        print(f"{args.sessions} sessions, {args.lookups} lookups (microseconds per call)")
+        print(f"  {'':<11}{'issue':>8}{'lookup p50':>12}{'p99':>9}{'lookups/s':>12}{'token':>8}")
+        for label, tokens, issue, lookup in modes:
+            samples = timed(lookup, tokens, args.lookups, rng)
+            print(f"  {label:<11}{issue:>8.1f}{percentile(samples, 0.5):>12.1f}{percentile(samples, 0.99):>9.1f}"
+                  f"{1e6 / (sum(samples) / len(samples)):>12.0f}{max(len(t) for t in tokens):>8}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#bench_startup.py
+
+# Import and config cost paid by every submission:
+#  - CGI: a new interpreter imports aigrader and executes the config script
+#    (.env parsing, CONFIG and rubric construction) for each request.
+#  - Server: the config registry returns the loaded config (a stat() of the files
+#    every few seconds).
+# Plus the per-call helpers that used to rebuild their regex / lists each time.
+#
+#   python3 benchmarks/bench_startup.py --runs 20
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+import timeit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REAL_CONF = os.path.join(REPO_DIR, 'evaluate-certacles-writing-c1-LTI-conf.py')
+sys.path.insert(0, REPO_DIR)
+# The sample config reads its keys from the environment; any value passes validation.
+os.environ.setdefault("AI_GRADER_API_KEY_GOOGLE", "bench")
+
+import aigrader
+import aigrader_config
+
+SAMPLE_FEEDBACK = "FINAL_GRADE: 4/5\n\n" + "Criteria\tScore\nTask Achievement\t4\n" * 20
+
+def subprocess_ms(code, runs):
+    """Best wall time of a fresh interpreter running code, in ms (the minimum is the least noisy)."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, check=True, capture_output=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times)
+
+def per_call_us(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+# Reference versions, as they were before the caches.
+def extract_uncached(text, grade_identifier):
+    pattern = rf"{re.escape(grade_identifier)}[:\s]*([\d.]+)\s*/\s*([\d.]+)"
+    match = re.search(pattern, text, re.IGNORECASE)
+    return (float(match.group(1)), float(match.group(2))) if match else (None, None)
+
+def domains_uncached(domain, allowed_domains_str):
+    allowed_list = [d.strip().lower() for d in allowed_domains_str.split(",")]
+    return any(domain == d or domain.endswith('.' + d) for d in allowed_list)
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-request import and config cost, CGI vs config registry.")
+    parser.add_argument('--conf', default=REAL_CONF)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    bare = subprocess_ms("pass", args.runs)
+    imported = subprocess_ms("import aigrader", args.runs)
+    start = time.perf_counter()
+    aigrader.load_config(args.conf)
+    config_ms = (time.perf_counter() - start) * 1000
+
+    print("Per request, fresh interpreter (CGI):")
+    print(f"  interpreter startup          {bare:8.1f} ms")
+    print(f"  + import aigrader            {imported - bare:8.1f} ms")
+    print(f"  + config script              {config_ms:8.1f} ms")
+    print(f"  total before grading         {imported + config_ms:8.1f} ms")
+
+    print("Per request, long-lived process (config registry):")
+    registry = aigrader_config.ConfigRegistry()
+    registry.get(args.conf)
+    print(f"  registry lookup              {per_call_us(lambda: registry.get(args.conf), 20000):8.2f} us")
+    stat_registry = aigrader_config.ConfigRegistry(check_interval=0)
+    stat_registry.get(args.conf)
+    print(f"  registry lookup + stat()     {per_call_us(lambda: stat_registry.get(args.conf), 20000):8.2f} us")
+
+    print("Hot-path helpers (before -> after):")
+    before = per_call_us(lambda: extract_uncached(SAMPLE_FEEDBACK, "FINAL_GRADE"), 20000)
+    after = per_call_us(lambda: aigrader.extract_flexible_grade(SAMPLE_FEEDBACK, "FINAL_GRADE"), 20000)
+    print(f"  extract_flexible_grade       {before:8.2f} -> {after:.2f} us")
+    domains = "yourlms.com, canvas.instructure.com, moodle.example.org, courses.example.edu"
+    before = per_call_us(lambda: domains_uncached("moodle.example.org", domains), 50000)
+    after = per_call_us(lambda: any(d == "moodle.example.org" or "moodle.example.org".endswith('.' + d)
+                                    for d in aigrader.allowed_domains(domains)), 50000)
+    print(f"  allowed-domain check         {before:8.2f} -> {after:.2f} us")
+
+if __name__ == "__main__":
+    main()
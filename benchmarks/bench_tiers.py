@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#bench_tiers.py
+
+# Model tiering (aigrader_tiers.py) against two local stub models: a fast one that
+# gets the grade right most of the time (otherwise one band off, sometimes without a
+# grade line) and a slow one that always gives the true grade of the essay. Each
+# essay carries its true grade, so the quality of every mode can be checked:
+#  - fast only, strong only, and tiered (fast first, escalating borderline grades,
+#    unparseable answers and errors to the strong model);
+#  - reported: essays per second, mean and p95 latency, agreement with the true
+#    grade (exact and pass/fail) and, for the tiered mode, the escalation rate and
+#    latency per tier from metrics.db (as aigrader_tiers.py prints them).
+#
+#   python3 benchmarks/bench_tiers.py --essays 300 --concurrency 20 --fast-latency 0.2 --strong-latency 1.0
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from bench_server import REPO_DIR, percentile
+from stub_llm import start_stub
+
+sys.path.insert(0, REPO_DIR)
+
+import aigrader
+import aigrader_http
+import aigrader_tiers
+
+TRUE_GRADE_RE = re.compile(r'\[true grade (\d)\]')
+PASS_MARK = 3
+
+def essay(number, grade):
+    return f"####TASK\n\nWrite an article.\n\n####ANSWER\n\n[true grade {grade}] Essay {number}. " + "Some text. " * 50
+
+def answer_for(grade):
+    return f"FINAL_GRADE: {grade}/5\n\nCriteria\tScore (0-5)\nTask Achievement\t{grade}\n"
+
+def true_grade(request):
+    return int(TRUE_GRADE_RE.search(json.dumps(request)).group(1))
+
+def fast_model(accuracy, parse_failures, seed):
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def answer(request):
+        grade = true_grade(request)
+        with lock:
+            roll = rng.random()
+            step = rng.choice((-1, 1))
+        if roll < parse_failures:
+            return "The essay is adequate overall."
+        if roll > accuracy:
+            grade = min(max(grade + step, 1), 5)
+        return answer_for(grade)
+    return answer
+
+async def grade_all(essays, config, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(text):
+        async with slots:
+            started = time.monotonic()
+            result = await aigrader.call_ai_api_async(text, config)
+            score = aigrader.extract_flexible_grade(result.get('feedback') or '', 'FINAL_GRADE')[0]
+            return score, time.monotonic() - started
+    return await asyncio.gather(*[one(text) for text in essays])
+
+def main():
+    parser = argparse.ArgumentParser(description="Fast-first model tiering vs single models, against stub LLMs.")
+    parser.add_argument('--essays', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--fast-latency', type=float, default=0.2)
+    parser.add_argument('--strong-latency', type=float, default=1.0)
+    parser.add_argument('--fast-accuracy', type=float, default=0.8, help="Fraction of exact grades of the fast model")
+    parser.add_argument('--parse-failures', type=float, default=0.03, help="Fraction of fast answers without a grade")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    grades = [rng.choice((1, 2, 3, 3, 4, 4, 5)) for _ in range(args.essays)]
+    essays = [essay(number, grade) for number, grade in enumerate(grades)]
+    _, fast_url = start_stub(args.fast_latency, answer=fast_model(args.fast_accuracy, args.parse_failures, args.seed))
+    _, strong_url = start_stub(args.strong_latency, answer=lambda request: answer_for(true_grade(request)))
+    fast = {'model_name': 'fast', 'api_url': fast_url}
+    strong = {'model_name': 'strong', 'api_url': strong_url}
+    base = {'provider': 'openai', 'api_key': 'stub', 'system_instructions': 'Grade the essay.',
+            'grade_identifier': 'FINAL_GRADE', 'session_dir': tempfile.mkdtemp(), 'metrics': True}
+    modes = [
+        ('fast only', dict(base, **fast)),
+        ('strong only', dict(base, **strong)),
+        ('tiered', dict(base, **fast, tiers=[fast, strong], tier_boundaries=[PASS_MARK / 5], tier_margin=0.1)),
+    ]
+
+    print(f"{args.essays} essays, concurrency {args.concurrency}, fast model {args.fast_latency * 1000:.0f} ms "
+          f"({args.fast_accuracy:.0%} exact), strong model {args.strong_latency * 1000:.0f} ms")
+    print(f"  {'':<12}{'essays/s':>10}{'mean':>9}{'p95':>9}{'exact':>9}{'pass/fail':>11}")
+    for label, config in modes:
+        started = time.monotonic()
+        results = aigrader_http.run_sync(grade_all(essays, config, args.concurrency), timeout=3600)
+        elapsed = time.monotonic() - started
+        latencies = [seconds for _, seconds in results]
+        exact = sum(1 for (score, _), grade in zip(results, grades) if score == grade) / len(grades)
+        agree = sum(1 for (score, _), grade in zip(results, grades)
+                    if score is not None and (score >= PASS_MARK) == (grade >= PASS_MARK)) / len(grades)
+        print(f"  {label:<12}{len(essays) / elapsed:>10.1f}{sum(latencies) / len(latencies):>8.2f}s"
+              f"{percentile(latencies, 0.95):>8.2f}s{exact:>9.1%}{agree:>11.1%}")
+    for name, row in aigrader_tiers.report(modes[-1][1]).items():
+        print(f"  tier {name}: {row['calls']} calls, escalation rate {row['escalation_rate']:.1%}, "
+              f"p50 {row['p50']:.2f}s p95 {row['p95']:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#load_test.py
+
+# End-to-end load test against local stubs, without API quota or a real LMS:
+# stub_llm.py answers the grading calls and stub_lms.py receives the grade passback
+# and verifies its OAuth signature. Each simulated student
+#  1. launches the activity through lti-receiver.py (a CGI process, as deployed),
+#     with the LTI parameters pointing at the stub LMS,
+#  2. submits a text with the session token, through aigrader.run (one CGI process
+#     per submission) or through aigrader_server.py (--mode server, --workers
+#     processes, students spread round-robin).
+#
+# Reported: throughput and p50/p95/p99 latency of launches, submissions and whole
+# sessions, failures, grades verified by the LMS, LLM errors injected, and the peak
+# memory (max RSS) of each worker: per CGI process, or per server process.
+#
+#   python3 benchmarks/load_test.py --users 200 --concurrency 20 --latency 0.5 --token-rate 80
+#   python3 benchmarks/load_test.py --mode server --workers 2 --users 500 --concurrency 50 --error-rate 0.05
+
+import argparse
+import http.client
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_server import CONF_TEMPLATE, REAL_CONF, REPO_DIR, ROUTE, free_port, percentile, wait_for_server
+from stub_llm import start_stub
+from stub_lms import start_lms
+
+ORIGIN = 'https://youropenedx.com'
+CONSUMER_KEY = 'bench'
+CONSUMER_SECRET = 'secret'
+TOKEN_RE = re.compile(r'token(?:: "|=)([A-Za-z0-9._-]+)')   # 303 Location or the status page
+
+RECEIVER_TEMPLATE = '''import sys, importlib.util
+sys.path.insert(0, {repo!r})
+spec = importlib.util.spec_from_file_location("lti_receiver", {receiver!r})
+receiver = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(receiver)
+receiver.SESSION_DIR = {session_dir!r}
+receiver.ALLOWED_ORIGINS = [{origin!r}]
+receiver.main()
+'''
+
+def submission(user):
+    # A different text per student, so the answer cache does not hide the LLM call.
+    return ("####TASK\n\nWrite an article.\n\n####ANSWER\n\n"
+            + f"Student {user} writes that studying abroad changes the way we see the world. " * 40)
+
+def run_cgi(script, body, env):
+    """(stdout, max RSS in KiB) of one CGI process."""
+    proc = subprocess.Popen([sys.executable, script], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, env=dict(os.environ, **env))
+    proc.stdin.write(body)
+    proc.stdin.close()
+    out = proc.stdout.read()
+    proc.stdout.close()
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return out.decode('utf-8', 'replace'), usage.ru_maxrss
+
+def cgi_body(out):
+    return out.split('\n\n', 1)[-1]
+
+class LoadTest:
+    def __init__(self, args, workdir, llm_url, lms_url):
+        self.args = args
+        self.lms_url = lms_url
+        self.session_dir = os.path.join(workdir, 'sessions')
+        os.makedirs(self.session_dir)
+        self.receiver = os.path.join(workdir, 'lti-receiver-bench.py')
+        with open(self.receiver, 'w') as f:
+            f.write(RECEIVER_TEMPLATE.format(repo=REPO_DIR, receiver=os.path.join(REPO_DIR, 'lti-receiver.py'),
+                                             session_dir=self.session_dir, origin=ORIGIN))
+        overrides = {
+            'provider': 'openai', 'api_url': llm_url, 'api_key': 'stub', 'model_name': 'stub',
+            'CORS_ALLOWED_ORIGINS': '*', 'session_dir': self.session_dir,
+            'send_grade_to_lms': True, 'lti_consumer_secrets': {CONSUMER_KEY: CONSUMER_SECRET},
+            'LTI_ALLOWED_DOMAINS': '127.0.0.1', 'LTI_ALLOW_HTTP': True,
+        }
+        self.conf = os.path.join(workdir, 'bench-conf.py')
+        with open(self.conf, 'w') as f:
+            f.write(CONF_TEMPLATE.format(repo=REPO_DIR, real_conf=REAL_CONF, overrides=overrides))
+        self.ports = []
+        self.memory = {'launch': [], 'submit': []}
+
+    def launch(self, user):
+        form = urllib.parse.urlencode({
+            'lis_outcome_service_url': self.lms_url,
+            'lis_result_sourcedid': f"user-{user}",
+            'oauth_consumer_key': CONSUMER_KEY,
+            'user_id': str(user),
+        }).encode('utf-8')
+        env = {'REQUEST_METHOD': 'POST', 'QUERY_STRING': 'file=/C1-writing-correction-LTI.html',
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded', 'CONTENT_LENGTH': str(len(form)),
+               'HTTP_ORIGIN': ORIGIN, 'HTTP_HOST': 'yourserver.com'}
+        out, rss = run_cgi(self.receiver, form, env)
+        self.memory['launch'].append(rss)
+        match = TOKEN_RE.search(out)
+        return match.group(1) if match else None
+
+    def submit(self, user, token):
+        body = json.dumps({'studentInput': submission(user), 'defaultValue': "####TASK####ANSWER",
+                           'session_token': token}).encode('utf-8')
+        if self.args.mode == 'cgi':
+            env = {'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(body)), 'HTTP_ORIGIN': 'https://yourserver.com'}
+            out, rss = run_cgi(self.conf, body, env)
+            self.memory['submit'].append(rss)
+            payload = cgi_body(out)
+        else:
+            conn = http.client.HTTPConnection('127.0.0.1', self.ports[user % len(self.ports)], timeout=300)
+            conn.request('POST', ROUTE, body=body, headers={'Content-Type': 'application/json'})
+            payload = conn.getresponse().read().decode('utf-8')
+            conn.close()
+        try:
+            return json.loads(payload)
+        except ValueError:
+            return {'success': False}
+
+    def student(self, user):
+        """Timings and outcome of one launch + submission."""
+        start = time.perf_counter()
+        token = self.launch(user)
+        launched = time.perf_counter()
+        result = self.submit(user, token) if token else {'success': False}
+        done = time.perf_counter()
+        return {'launch': launched - start, 'submit': done - launched, 'session': done - start,
+                'launch_ok': token is not None, 'submit_ok': bool(result.get('success')),
+                'score': (result.get('score_info') or {}).get('score')}
+
+def report_phase(name, latencies, failures):
+    print(f"  {name:<8} p50 {percentile(latencies, 0.5) * 1000:>8.1f} ms"
+          f"   p95 {percentile(latencies, 0.95) * 1000:>8.1f} ms   p99 {percentile(latencies, 0.99) * 1000:>8.1f} ms"
+          f"   failures {failures}")
+
+def report_memory(name, values_kib):
+    if values_kib:
+        print(f"  {name:<22} max RSS p50 {percentile(values_kib, 0.5) / 1024:>6.1f} MiB   max {max(values_kib) / 1024:>6.1f} MiB")
+
+def server_peak_rss(pid):
+    """VmHWM (peak resident set) of a running process, in KiB."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end LTI launch + grading load test against stub LLM and LMS.")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--mode', choices=('cgi', 'server'), default='cgi', help="How submissions are served")
+    parser.add_argument('--workers', type=int, default=1, help="aigrader_server.py processes in server mode")
+    parser.add_argument('--latency', type=float, default=0.5, help="Stub LLM latency before answering, in seconds")
+    parser.add_argument('--token-rate', type=float, help="Stub LLM output tokens per second")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of LLM calls answered with 503")
+    parser.add_argument('--lms-latency', type=float, default=0.05, help="Stub LMS latency, in seconds")
+    args = parser.parse_args()
+
+    llm, llm_url = start_stub(args.latency, token_rate=args.token_rate, error_rate=args.error_rate)
+    lms, lms_url = start_lms({CONSUMER_KEY: CONSUMER_SECRET}, args.lms_latency)
+    servers = []
+    with tempfile.TemporaryDirectory() as workdir:
+        test = LoadTest(args, workdir, llm_url, lms_url)
+        try:
+            if args.mode == 'server':
+                for _ in range(args.workers):
+                    port = free_port()
+                    proc = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'aigrader_server.py'),
+                                             '--port', str(port), f"{ROUTE}={test.conf}"], stderr=subprocess.DEVNULL)
+                    servers.append(proc)
+                    wait_for_server(port, proc)
+                    test.ports.append(port)
+
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                start = time.perf_counter()
+                results = list(pool.map(test.student, range(args.users)))
+                wall = time.perf_counter() - start
+            worker_rss = [server_peak_rss(proc.pid) for proc in servers]
+        finally:
+            for proc in servers:
+                proc.terminate()
+                proc.wait()
+
+    scored = {f"user-{i}": r['score'] / 5 for i, r in enumerate(results) if r['submit_ok'] and r['score'] is not None}
+    verified = sum(1 for sourced_id, grade in scored.items() if abs(lms.grades.get(sourced_id, -1) - grade) < 1e-3)
+    token_rate = f"{args.token_rate:g} tok/s" if args.token_rate else "instant"
+    print(f"{args.users} students, concurrency {args.concurrency}, submissions via {args.mode}"
+          f"{f' ({args.workers} workers)' if args.mode == 'server' else ''}, LLM latency {args.latency * 1000:.0f} ms"
+          f" + {token_rate}, LLM error rate {args.error_rate:g}")
+    print(f"Throughput {args.users / wall:.1f} students/s ({wall:.1f} s)")
+    report_phase('launch', [r['launch'] for r in results], sum(not r['launch_ok'] for r in results))
+    report_phase('submit', [r['submit'] for r in results], sum(not r['submit_ok'] for r in results))
+    report_phase('session', [r['session'] for r in results], sum(not (r['launch_ok'] and r['submit_ok']) for r in results))
+    print(f"LMS: {verified}/{len(scored)} graded submissions verified and recorded   {lms.stats}")
+    print(f"LLM stub: {llm.stats}")
+    print("Memory per worker:")
+    report_memory('lti-receiver (CGI)', test.memory['launch'])
+    report_memory('aigrader.run (CGI)', test.memory['submit'])
+    for number, rss in enumerate(worker_rss, 1):
+        if rss:
+            print(f"  aigrader_server #{number:<6} max RSS {rss / 1024:>6.1f} MiB")
+    llm.shutdown()
+    lms.shutdown()
+
+if __name__ == "__main__":
+    main()
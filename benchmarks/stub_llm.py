@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#stub_llm.py
+
+# Local stand-in for the LLM providers used by the benchmarks. It answers both the
+# OpenAI chat-completions format and the Gemini generateContent format (plain or
+# streamed as server-sent events) after a fixed delay, so the grader can be
+# measured without burning API quota.
+#  - --token-rate adds the generation time of the answer (tokens per second; the
+#    stream is paced at that rate).
+#  - --error-rate answers that fraction of the requests with --error-status and the
+#    provider's error body, to exercise retries, fallbacks and breakers.
+#  - start_stub(answer=...) replaces the fixed answer with a function of the request
+#    (e.g. a grade that depends on the text, for bench_tiers.py).
+#
+#   python3 benchmarks/stub_llm.py --port 8090 --latency 0.5 --token-rate 80 --error-rate 0.05
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_FEEDBACK = "FINAL_GRADE: 3/5\n\nCriteria\tScore (0-5)\nTask Achievement\t3\nCoherence and Cohesion\t3\n"
+# Answer to requests with a response schema (structured_output mode)
+STUB_STRUCTURED = json.dumps({
+    "criteria": {code: {"score": 3, "feedback": "Adequate.", "evidence": "\"Studying abroad changes...\""}
+                 for code in ("TA", "CC", "GRA", "LRA")},
+    "overall_band": 3,
+    "strengths": ["Clear structure"],
+    "weaknesses": ["Limited range of linkers"],
+    "suggestions": ["Add a topic sentence to each paragraph"],
+})
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+def answer_text(request):
+    if request.get('response_format') or (request.get('generationConfig') or {}).get('responseSchema'):
+        return STUB_STRUCTURED
+    return STUB_FEEDBACK
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    token_rate = None
+    error_rate = 0.0
+    error_status = 503
+    answer = None
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length) or b'{}')
+        time.sleep(self.latency)
+        if '/cachedContents' in self.path:
+            return self.send_json({"name": "cachedContents/stub", "ttl": request.get("ttl", "3600s")})
+        self.server.count('requests')
+        if self.error_rate and random.random() < self.error_rate:
+            self.server.count('errors')
+            return self.send_error_body()
+        if ':streamGenerateContent' in self.path or request.get('stream'):
+            return self.stream_answer(gemini=':streamGenerateContent' in self.path)
+        text = self.answer(request) if self.answer else answer_text(request)
+        tokens = estimate_tokens(text)
+        if self.token_rate:
+            time.sleep(tokens / self.token_rate)
+        if ':generateContent' in self.path:
+            cached = 2000 if request.get('cachedContent') else 0
+            payload = {"candidates": [{"content": {"parts": [{"text": text}]}}],
+                       "usageMetadata": {"promptTokenCount": 2300, "cachedContentTokenCount": cached, "candidatesTokenCount": tokens}}
+        else:
+            payload = {"choices": [{"message": {"role": "assistant", "content": text}}],
+                       "usage": {"prompt_tokens": 2300, "completion_tokens": tokens, "prompt_tokens_details": {"cached_tokens": 2048}}}
+        self.send_json(payload)
+
+    def do_PATCH(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.send_json({"name": "cachedContents/stub"})
+
+    def send_error_body(self):
+        # Same shape for both providers: {"error": {"code", "message", "status"}}
+        self.send_json({"error": {"code": self.error_status, "message": "Injected stub error", "status": "UNAVAILABLE"}},
+                       self.error_status)
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_answer(self, gemini):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for piece in STUB_FEEDBACK.split(' '):
+            text = piece + ' '
+            if self.token_rate:
+                time.sleep(estimate_tokens(text) / self.token_rate)
+            if gemini:
+                event = {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+            else:
+                event = {"choices": [{"delta": {"content": text}}]}
+            self.write_chunk(f"data: {json.dumps(event)}\n\n")
+        if not gemini:
+            self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 512
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = {'requests': 0, 'errors': 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def handle_error(self, request, client_address):
+        # Hedged and sampled calls are cancelled by the client once an answer is chosen.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def start_stub(latency=0.0, host='127.0.0.1', port=0, token_rate=None, error_rate=0.0, error_status=503, answer=None):
+    """Starts the stub in a daemon thread and returns (server, base_url). server.stats counts
+    the completion requests and the injected errors. answer(request) -> text, when given,
+    is used for the non-streamed answers."""
+    handler = type('Handler', (StubLLMHandler,), {'latency': latency, 'token_rate': token_rate,
+                                                  'error_rate': error_rate, 'error_status': error_status,
+                                                  'answer': staticmethod(answer) if answer else None})
+    server = StubServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub OpenAI/Gemini endpoint for benchmarks.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.5, help="Seconds before answering")
+    parser.add_argument('--token-rate', type=float, help="Output tokens per second (default: instant answer)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered with an error")
+    parser.add_argument('--error-status', type=int, default=503)
+    args = parser.parse_args()
+    server, url = start_stub(args.latency, args.host, args.port, args.token_rate, args.error_rate, args.error_status)
+    print(f"Stub LLM listening on {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
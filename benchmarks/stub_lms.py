@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#stub_lms.py
+
+# Local stand-in for the LTI 1.1 Basic Outcomes service of Moodle / Open edX. Each
+# replaceResult / readResult POST is checked the way an LMS does it, with its own
+# RFC 5849 code (not aigrader's), so a signing bug shows up as a rejected passback:
+#  - oauth_body_hash is the base64 SHA-1 of the raw body,
+#  - the consumer key is known and the HMAC-SHA1 signature matches its secret,
+#  - the timestamp is within five minutes and the nonce was not used before.
+# Accepted grades are kept by sourcedId (server.grades) and returned by readResult;
+# rejections are counted by reason (server.stats) and answered with 401, like an LMS
+# refusing the signature.
+#
+#   python3 benchmarks/stub_lms.py --port 8091 --secret bench=secret
+# and in the grader config: "lti_consumer_secrets": {"bench": "secret"},
+# "LTI_ALLOWED_DOMAINS": "127.0.0.1", "LTI_ALLOW_HTTP": True
+
+import argparse
+import base64
+import hashlib
+import hmac
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TIMESTAMP_WINDOW = 300
+NS = {'ims': 'http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0'}
+AUTH_PARAM_RE = re.compile(r'(\w+)="([^"]*)"')
+
+RESPONSE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<imsx_POXEnvelopeResponse xmlns="http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0">
+  <imsx_POXHeader><imsx_POXResponseHeaderInfo><imsx_version>V1.0</imsx_version>
+  <imsx_messageIdentifier>{message_id}</imsx_messageIdentifier>
+  <imsx_statusInfo><imsx_codeMajor>{code}</imsx_codeMajor><imsx_severity>status</imsx_severity>
+  <imsx_description>{description}</imsx_description></imsx_statusInfo></imsx_POXResponseHeaderInfo></imsx_POXHeader>
+  <imsx_POXBody>{body}</imsx_POXBody>
+</imsx_POXEnvelopeResponse>"""
+READ_RESULT_BODY = ("<readResultResponse><result><resultScore><language>en</language>"
+                    "<textString>{score}</textString></resultScore></result></readResultResponse>")
+
+def percent_encode(value):
+    return urllib.parse.quote(value, safe='~')
+
+def parse_authorization(header):
+    if not header or not header.startswith('OAuth '):
+        return None
+    return {k: urllib.parse.unquote(v) for k, v in AUTH_PARAM_RE.findall(header[len('OAuth '):])}
+
+def signature_base_string(method, url, params):
+    """RFC 5849 section 3.4.1: method, base string URI and normalized parameters."""
+    parsed = urllib.parse.urlsplit(url)
+    pairs = [(k, v) for k, v in params.items() if k != 'oauth_signature']
+    pairs += urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+    normalized = '&'.join(f"{k}={v}" for k, v in sorted((percent_encode(k), percent_encode(v)) for k, v in pairs))
+    base_uri = f"{parsed.scheme.lower()}://{parsed.netloc.lower()}{parsed.path or '/'}"
+    return '&'.join((method.upper(), percent_encode(base_uri), percent_encode(normalized)))
+
+def sign(base_string, consumer_secret):
+    key = f"{percent_encode(consumer_secret)}&".encode('utf-8')
+    return base64.b64encode(hmac.new(key, base_string.encode('utf-8'), hashlib.sha1).digest()).decode('ascii')
+
+class StubLMSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    error_rate = 0.0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(self.latency)
+        self.server.count('requests')
+        if self.error_rate and random.random() < self.error_rate:
+            return self.reject('injected_error', 503)
+        params = parse_authorization(self.headers.get('Authorization'))
+        if params is None:
+            return self.reject('missing_oauth')
+        secret = self.server.secrets.get(params.get('oauth_consumer_key'))
+        if secret is None:
+            return self.reject('unknown_consumer')
+        if params.get('oauth_signature_method') != 'HMAC-SHA1':
+            return self.reject('signature_method')
+        if params.get('oauth_body_hash') != base64.b64encode(hashlib.sha1(body).digest()).decode('ascii'):
+            return self.reject('body_hash')
+        try:
+            timestamp = int(params.get('oauth_timestamp', ''))
+        except ValueError:
+            return self.reject('timestamp')
+        if abs(time.time() - timestamp) > TIMESTAMP_WINDOW:
+            return self.reject('timestamp')
+        url = f"http://{self.headers.get('Host')}{self.path}"
+        expected = sign(signature_base_string('POST', url, params), secret)
+        if not hmac.compare_digest(expected, params.get('oauth_signature', '')):
+            return self.reject('signature')
+        if not self.server.use_nonce(params.get('oauth_nonce'), timestamp):
+            return self.reject('nonce_reused')
+        try:
+            root = ET.fromstring(body)
+            sourced_id = root.find('.//ims:sourcedId', NS).text
+            if root.find('.//ims:readResultRequest', NS) is not None:
+                self.server.count('read')
+                score = self.server.grades.get(sourced_id)
+                return self.send_xml(200, 'success', f"Result read for {sourced_id}",
+                                     READ_RESULT_BODY.format(score='' if score is None else score))
+            score = float(root.find('.//ims:resultScore/ims:textString', NS).text)
+        except (ET.ParseError, AttributeError, TypeError, ValueError):
+            return self.reject('bad_request', 400)
+        if not 0.0 <= score <= 1.0:
+            # Moodle answers HTTP 200 with a failure status for a score out of range
+            self.server.count('rejected:score_out_of_range')
+            return self.send_xml(200, 'failure', 'Score out of range')
+        self.server.record(sourced_id, score)
+        self.send_xml(200, 'success', f"Score for {sourced_id} is now {score}", "<replaceResultResponse/>")
+
+    def reject(self, reason, status=401):
+        self.server.count(f"rejected:{reason}")
+        self.send_xml(status, 'failure', reason)
+
+    def send_xml(self, status, code, description, body=''):
+        body = RESPONSE_TEMPLATE.format(message_id=uuid.uuid4(), code=code, description=description, body=body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubLMSServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 512
+
+    def __init__(self, address, handler, secrets):
+        super().__init__(address, handler)
+        self.secrets = dict(secrets)
+        self.grades = {}
+        self.stats = {'requests': 0, 'accepted': 0}
+        self.nonces = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def use_nonce(self, nonce, timestamp):
+        """False if the nonce was already seen inside the timestamp window."""
+        if not nonce:
+            return False
+        with self.lock:
+            now = time.time()
+            if len(self.nonces) > 10000:
+                self.nonces = {n: t for n, t in self.nonces.items() if t > now - 2 * TIMESTAMP_WINDOW}
+            if nonce in self.nonces:
+                return False
+            self.nonces[nonce] = timestamp
+            return True
+
+    def record(self, sourced_id, score):
+        with self.lock:
+            self.grades[sourced_id] = score
+            self.stats['accepted'] += 1
+
+def start_lms(secrets=None, latency=0.0, host='127.0.0.1', port=0, error_rate=0.0):
+    """Starts the stub in a daemon thread and returns (server, outcome_service_url)."""
+    handler = type('Handler', (StubLMSHandler,), {'latency': latency, 'error_rate': error_rate})
+    server = StubLMSServer((host, port), handler, secrets or {'bench': 'secret'})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}/grade_handler"
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub LTI 1.1 outcomes endpoint that verifies OAuth body signing.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8091)
+    parser.add_argument('--secret', action='append', default=[], help="consumer_key=secret (repeatable)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds before answering")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of passbacks answered with 503")
+    args = parser.parse_args()
+    secrets = dict(item.split('=', 1) for item in args.secret) or None
+    server, url = start_lms(secrets, args.latency, args.host, args.port, args.error_rate)
+    print(f"Stub LMS outcomes service on {url}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"  {server.stats}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
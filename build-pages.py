@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#build-pages.py
+
+# Build step for the static activity pages. For each page (like
+# C1-writing-correction-LTI.html) and UI language it writes to --output:
+#  - the page with the aigrader.js template already rendered in #app-root (title,
+#    task, labels and initial text), so the form is visible and usable before any
+#    script runs; aigrader.js only binds the events (data-prerendered);
+#  - aigrader.<hash>.min.js: aigrader.js without comments and indentation, named
+#    after its content so it can be cached for a year ("immutable") and a new
+#    version is a new URL;
+#  - a .gz next to every file, for nginx gzip_static.
+# The page's own language keeps its file name (the URL in the LMS and in
+# lti-receiver.py does not change); the others are <page>.<lang>.html.
+#
+#   python3 build-pages.py --output /var/www/html C1-writing-correction-LTI.html [--langs en,es,va]
+#
+# Run it again after editing a page or aigrader.js.
+
+import argparse
+import gzip
+import hashlib
+import html
+import json
+import os
+import re
+import sys
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TEMPLATE_RE = re.compile(r'getTemplate\(\)\s*\{\s*return\s*`(.*?)`;', re.S)
+I18N_LANG_RE = re.compile(r'^\s+(\w+): \{$')
+I18N_ENTRY_RE = re.compile(r'^\s+(\w+): ("(?:\\.|[^"\\])*"),?$')
+SCRIPT_SRC_RE = re.compile(r'(<script src="[^"]*?)aigrader\.js(")')
+APP_ROOT_RE = re.compile(r'<div id="app-root">.*?</div>', re.S)
+CONFIG_END_RE = re.compile(r'(const CONFIG = \{.*?\n\s*\};)', re.S)
+HTML_LANG_RE = re.compile(r'<html lang="[^"]*">')
+TITLE_RE = re.compile(r'<title>.*?</title>', re.S)
+
+# 🗜️ MINIFICATION
+# Characters after which a '/' starts a regular expression, not a division.
+REGEX_PREFIX = set('(,=:[!&|?{};+-*%<>~^')
+
+def minify_js(source):
+    """Removes comments, indentation and blank lines. Strings, template literals and
+    regular expressions are copied as they are; line breaks are kept (automatic
+    semicolon insertion)."""
+    out = []
+    i = 0
+    n = len(source)
+    templates = []   # brace depth of each open ${ ... } of a template literal
+    depth = 0
+    last = ''        # last significant character written
+    line_start = True
+    while i < n:
+        c = source[i]
+        if templates and depth == templates[-1] and c == '}':
+            # End of a ${...}: back into the template literal
+            templates.pop()
+            out.append(c)
+            i = copy_template(source, i + 1, out, templates)
+            if templates and templates[-1] == -1:
+                templates[-1] = depth
+            last = '`'
+            continue
+        if c in '\'"':
+            j = i + 1
+            while source[j] != c:
+                j += 2 if source[j] == '\\' else 1
+            out.append(source[i:j + 1])
+            i, last, line_start = j + 1, c, False
+            continue
+        if c == '`':
+            out.append(c)
+            i = copy_template(source, i + 1, out, templates)
+            if templates and templates[-1] == -1:
+                templates[-1] = depth
+            last, line_start = '`', False
+            continue
+        if c == '/' and source.startswith('//', i):
+            while i < n and source[i] != '\n':
+                i += 1
+            continue
+        if c == '/' and source.startswith('/*', i):
+            i = source.index('*/', i) + 2
+            continue
+        if c == '/' and (last in REGEX_PREFIX or last == '' or source[max(0, i - 7):i].rstrip().endswith('return')):
+            j = i + 1
+            in_class = False
+            while in_class or source[j] != '/':
+                if source[j] == '\\':
+                    j += 1
+                elif source[j] == '[':
+                    in_class = True
+                elif source[j] == ']':
+                    in_class = False
+                j += 1
+            j += 1
+            while j < n and source[j].isalpha():
+                j += 1
+            out.append(source[i:j])
+            i, last, line_start = j, '/', False
+            continue
+        if c == '\n':
+            if not line_start:
+                out.append('\n')
+            line_start = True
+            i += 1
+            continue
+        if c in ' \t\r':
+            j = i
+            while j < n and source[j] in ' \t\r':
+                j += 1
+            # Indentation goes; a single space stays where two words would join
+            if not line_start and j < n and source[j] != '\n' and is_word(last) and is_word(source[j]):
+                out.append(' ')
+            i = j
+            continue
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+        out.append(c)
+        i, last, line_start = i + 1, c, False
+    return ''.join(out).strip() + '\n'
+
+def is_word(c):
+    return c.isalnum() or c in '_$'
+
+def copy_template(source, i, out, templates):
+    """Copies a template literal from i up to its closing backtick (or the next ${)."""
+    start = i
+    while True:
+        c = source[i]
+        if c == '\\':
+            i += 2
+        elif c == '`':
+            out.append(source[start:i + 1])
+            return i + 1
+        elif source.startswith('${', i):
+            out.append(source[start:i + 2])
+            templates.append(-1)   # depth set by the caller
+            return i + 2
+        else:
+            i += 1
+
+# 🖼️ PRE-RENDERING
+def read_i18n(js_source):
+    """{lang: {key: text}} from the i18n dictionary of aigrader.js."""
+    block = js_source[js_source.index('i18n: {'):js_source.index('getTemplate()')]
+    languages = {}
+    current = None
+    for line in block.splitlines():
+        lang = I18N_LANG_RE.match(line)
+        entry = I18N_ENTRY_RE.match(line)
+        if lang:
+            current = languages.setdefault(lang.group(1), {})
+        elif entry and current is not None:
+            current[entry.group(1)] = json.loads(entry.group(2))
+    return languages
+
+def config_field(page, name):
+    """A string value of the page's CONFIG (quoted with ', " or `), or None."""
+    match = re.search(rf'\b{name}:\s*(["\'`])((?:\\.|(?!\1).)*)\1', page, re.S)
+    if not match:
+        return None
+    return re.sub(r'\\(.)', lambda m: {'n': '\n', 't': '\t'}.get(m.group(1), m.group(1)), match.group(2), flags=re.S)
+
+def fill(template, element_id, content):
+    """Puts content inside the (empty) element with this id."""
+    pattern = re.compile(rf'(<(\w+)[^>]*\bid="{element_id}"[^>]*>)(</\2>)')
+    return pattern.sub(lambda m: m.group(1) + content + m.group(3), template, count=1)
+
+def prerender(template, page, txt):
+    text = lambda value: html.escape(value or '')
+    initial = config_field(page, 'initialValue') or ''
+    privacy = config_field(page, 'privacyUrl')
+    # A leading newline in a textarea is dropped by the HTML parser
+    body = fill(template, 'ui-title', text(config_field(page, 'title')))
+    body = fill(body, 'task-html', config_field(page, 'taskHTML') or '')
+    body = fill(body, 'ui-label-input', text(txt['labelInput']))
+    body = fill(body, 'student-input', ('\n' if initial.startswith('\n') else '') + text(initial))
+    body = fill(body, 'evaluate-btn', text(txt['evaluateBtn']))
+    body = fill(body, 'loading', text(txt['loading']))
+    body = fill(body, 'new-eval-btn', text(txt['newBtn']))
+    if privacy:
+        body = fill(body, 'privacy-footer', f'<a href="{privacy}" target="_blank">{text(txt["privacyLabel"])}</a>')
+    return body
+
+def build_page(page, template, i18n, lang, bundle_name, forced_lang):
+    rendered = prerender(template, page, i18n[lang])
+    out = APP_ROOT_RE.sub(lambda m: f'<div id="app-root" data-prerendered="{lang}">{rendered}\n    </div>', page, count=1)
+    out = SCRIPT_SRC_RE.sub(lambda m: m.group(1) + bundle_name + m.group(2), out, count=1)
+    out = HTML_LANG_RE.sub(f'<html lang="{lang}">', out, count=1)
+    out = TITLE_RE.sub(lambda m: f"<title>{html.escape(config_field(page, 'title') or '')}</title>", out, count=1)
+    if forced_lang:
+        out = CONFIG_END_RE.sub(lambda m: m.group(1) + f"\n        CONFIG.lang = '{lang}';", out, count=1)
+    return out
+
+def write(path, data):
+    """Writes a file and its .gz (only when the content changed, to keep the mtimes)."""
+    data = data.encode('utf-8')
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return len(data), os.path.getsize(path + '.gz')
+    except OSError:
+        pass
+    with open(path, 'wb') as f:
+        f.write(data)
+    compressed = gzip.compress(data, 9, mtime=0)
+    with open(path + '.gz', 'wb') as f:
+        f.write(compressed)
+    return len(data), len(compressed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-render activity pages per language and bundle aigrader.js with a content hash.")
+    parser.add_argument('pages', nargs='+', help="Activity HTML pages (with a CONFIG and <div id=\"app-root\">)")
+    parser.add_argument('--output', required=True, help="Web root to write the pages and the bundle to")
+    parser.add_argument('--js', default=os.path.join(REPO_DIR, 'aigrader.js'))
+    parser.add_argument('--langs', help="Comma separated UI languages (default: every language of aigrader.js)")
+    args = parser.parse_args()
+
+    with open(args.js, encoding='utf-8') as f:
+        js_source = f.read()
+    template = TEMPLATE_RE.search(js_source).group(1)
+    i18n = read_i18n(js_source)
+    langs = [lang.strip() for lang in args.langs.split(',')] if args.langs else list(i18n)
+    unknown = [lang for lang in langs if lang not in i18n]
+    if unknown:
+        parser.error(f"languages not in {args.js}: {', '.join(unknown)}")
+
+    os.makedirs(args.output, exist_ok=True)
+    minified = minify_js(js_source)
+    bundle_name = f"aigrader.{hashlib.sha256(minified.encode('utf-8')).hexdigest()[:10]}.min.js"
+    size, compressed = write(os.path.join(args.output, bundle_name), minified)
+    sys.stdout.write(f"{bundle_name}: {len(js_source.encode('utf-8'))} -> {size} bytes ({compressed} gzip)\n")
+
+    for page_path in args.pages:
+        with open(page_path, encoding='utf-8') as f:
+            page = f.read()
+        name, ext = os.path.splitext(os.path.basename(page_path))
+        default_lang = config_field(page, 'lang') or 'en'
+        for lang in dict.fromkeys([default_lang] + langs):
+            if lang not in i18n:
+                continue
+            filename = f"{name}{ext}" if lang == default_lang else f"{name}.{lang}{ext}"
+            size, compressed = write(os.path.join(args.output, filename),
+                                     build_page(page, template, i18n, lang, bundle_name, lang != default_lang))
+            sys.stdout.write(f"{filename}: {size} bytes ({compressed} gzip)\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#calibrate-grader.py
+
+# Calibration of a grader config against labelled anchor productions (like the
+# "Productions 1-8" the C1 rubric is written from). The anchors are graded through
+# the real code path (aigrader.call_ai_api_async: providers, tiers, samples,
+# structured output, grade parsing) with bounded parallelism, and the run reports:
+#  - exact and adjacent (within --adjacent points) agreement with the expected
+#    grades, mean absolute error and bias (mean of grade - expected);
+#  - parse failures (answers without a readable grade) and errors;
+#  - p50 / p95 latency and LLM calls and tokens per essay.
+# The provider responses go to a replay store (aigrader_replay.py): a rerun of the
+# same config replays them (deterministic, offline, at the recorded latency), and
+# only what changed (rubric, model, provider) is sent to the provider. Explicit
+# prompt caching is turned off so recorded and replayed requests are identical.
+#
+# Anchors: CSV or JSONL with "id", "studentInput" (or "text") and the expected
+# "grade", on the grader's scale.
+#
+#   python3 calibrate-grader.py run --config evaluate-certacles-writing-c1-LTI-conf.py \
+#       --anchors anchors-c1.jsonl --replay calibration/replay.db --output calibration/flash-lite.json
+#   python3 calibrate-grader.py run ... --set model_name=gemini-2.5-pro --output calibration/pro.json
+#   python3 calibrate-grader.py run ... --rubric rubric-v2.txt --output calibration/rubric-v2.json
+#   python3 calibrate-grader.py run ... --replay-mode replay        # offline: fails on unrecorded requests
+#   python3 calibrate-grader.py diff calibration/flash-lite.json calibration/pro.json
+
+import argparse
+import asyncio
+import csv
+import datetime
+import hashlib
+import json
+import sys
+import time
+
+import aigrader
+import aigrader_http
+import aigrader_metrics
+import aigrader_replay
+
+def read_anchors(path):
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.endswith('.jsonl') or path.endswith('.ndjson'):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+    anchors = []
+    for index, row in enumerate(rows):
+        text = (row.get('studentInput') or row.get('text') or '').strip()
+        if not text or row.get('grade') in (None, ''):
+            continue
+        anchors.append({'id': str(row.get('id') or index), 'text': text, 'expected': float(row['grade'])})
+    return anchors
+
+def parse_setting(item):
+    """KEY=VALUE, the value as JSON when it parses (numbers, true, lists...), else as a string."""
+    key, _, value = item.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+# 🏃 RUN
+async def grade_anchor(anchor, config, slots):
+    async with slots:
+        with aigrader_metrics.request(config, 'calibration') as trace:
+            started = time.monotonic()
+            result = await aigrader.call_ai_api_async(anchor['text'], config)
+            seconds = time.monotonic() - started
+        calls = trace.fields.get('llm_calls') or {}
+    row = {'id': anchor['id'], 'expected': anchor['expected'], 'score': None, 'max': None,
+           'seconds': round(seconds, 3), 'calls': calls.get('calls', 0),
+           'prompt_tokens': calls.get('prompt_tokens', 0), 'completion_tokens': calls.get('completion_tokens', 0)}
+    if not result.get('success'):
+        row['error'] = result.get('error')
+        return row
+    _, score, maximum, _ = aigrader.grade_feedback(result['feedback'], config)
+    row['score'], row['max'] = score, maximum
+    if score is None:
+        row['error'] = 'parse'
+    return row
+
+async def grade_all(anchors, config, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[grade_anchor(anchor, config, slots) for anchor in anchors])
+
+def summarize(rows, adjacent=1):
+    n = len(rows)
+    graded = [row for row in rows if row['score'] is not None]
+    differences = [row['score'] - row['expected'] for row in graded]
+    latencies = [row['seconds'] for row in rows if not row.get('error') or row['error'] == 'parse']
+    share = lambda count: round(count / n, 4) if n else None
+    mean = lambda values: round(sum(values) / len(values), 3) if values else None
+    return {
+        'anchors': n,
+        'exact': share(sum(1 for d in differences if d == 0)),
+        'adjacent': share(sum(1 for d in differences if abs(d) <= adjacent)),
+        'mean_abs_error': mean([abs(d) for d in differences]),
+        'bias': mean(differences),
+        'parse_failures': share(sum(1 for row in rows if row.get('error') == 'parse')),
+        'errors': share(sum(1 for row in rows if row.get('error') and row['error'] != 'parse')),
+        'p50_seconds': percentile(latencies, 0.5),
+        'p95_seconds': percentile(latencies, 0.95),
+        'calls_per_essay': mean([row['calls'] for row in rows]),
+        'prompt_tokens_per_essay': mean([row['prompt_tokens'] for row in rows]),
+        'completion_tokens_per_essay': mean([row['completion_tokens'] for row in rows]),
+    }
+
+def describe(config, path):
+    return {'path': path, 'provider': config.get('provider'), 'model_name': config.get('model_name'),
+            'tiers': [tier.get('model_name') for tier in config.get('tiers') or []] or None,
+            'samples': config.get('samples'), 'structured_output': bool(config.get('structured_output')),
+            'rubric_sha256': hashlib.sha256(config.get('system_instructions', '').encode('utf-8')).hexdigest()[:12]}
+
+def run(args):
+    config = aigrader.load_config(args.config)
+    for item in args.set or []:
+        key, value = parse_setting(item)
+        config[key] = value
+    if args.rubric:
+        with open(args.rubric, encoding='utf-8') as f:
+            config['system_instructions'] = f.read()
+    config = dict(config, replay_store=args.replay, replay_mode=args.replay_mode, replay_speed=args.replay_speed,
+                  prompt_caching=False, feedback_cache=False, metrics=False, request_log=None)
+    anchors = read_anchors(args.anchors)
+    if not anchors:
+        sys.exit(f"No anchors with a text and a grade in {args.anchors}")
+    sys.stderr.write(f"Grading {len(anchors)} anchors with {config.get('provider')} {config.get('model_name')} "
+                     f"(replay {args.replay_mode}, concurrency {args.concurrency})\n")
+    aigrader_replay.reset()
+    started = time.monotonic()
+    rows = aigrader_http.run_sync(grade_all(anchors, config, args.concurrency), timeout=None)
+    report = {'label': args.label or args.output, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'config': describe(config, args.config), 'replay_mode': args.replay_mode,
+              'wall_seconds': round(time.monotonic() - started, 1),
+              'summary': summarize(rows, args.adjacent), 'essays': rows}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1, ensure_ascii=False)
+    print_report(report)
+
+# 📋 REPORTS
+FORMATS = [
+    ('exact', '{:.1%}'), ('adjacent', '{:.1%}'), ('mean_abs_error', '{:.3f}'), ('bias', '{:+.3f}'),
+    ('parse_failures', '{:.1%}'), ('errors', '{:.1%}'), ('p50_seconds', '{:.2f}'), ('p95_seconds', '{:.2f}'),
+    ('calls_per_essay', '{:.2f}'), ('prompt_tokens_per_essay', '{:.0f}'), ('completion_tokens_per_essay', '{:.0f}'),
+]
+
+def fmt(value, pattern):
+    return '-' if value is None else pattern.format(value)
+
+def print_report(report):
+    config = report['config']
+    print(f"{report['label']}: {config['provider']} {config['model_name']}, rubric {config['rubric_sha256']}, "
+          f"{report['summary']['anchors']} anchors")
+    for name, pattern in FORMATS:
+        print(f"  {name:<30}{fmt(report['summary'][name], pattern):>10}")
+
+def diff(args):
+    runs = []
+    for path in (args.before, args.after):
+        with open(path, encoding='utf-8') as f:
+            runs.append(json.load(f))
+    before, after = runs
+    for label, run_ in (('A', before), ('B', after)):
+        config = run_['config']
+        print(f"{label}: {run_['label']} ({config['provider']} {config['model_name']}, rubric {config['rubric_sha256']}, "
+              f"samples {config.get('samples') or 1})")
+    print(f"  {'':<30}{'A':>10}{'B':>10}{'B - A':>10}")
+    for name, pattern in FORMATS:
+        a, b = before['summary'][name], after['summary'][name]
+        delta = fmt(b - a, '{:+.3f}') if a is not None and b is not None else '-'
+        print(f"  {name:<30}{fmt(a, pattern):>10}{fmt(b, pattern):>10}{delta:>10}")
+
+    grades_before = {row['id']: row for row in before['essays']}
+    changed = [(grades_before[row['id']], row) for row in after['essays']
+               if row['id'] in grades_before and grades_before[row['id']]['score'] != row['score']]
+    if not changed:
+        print("Every anchor got the same grade in both runs")
+        return
+    distance = lambda row: abs(row['score'] - row['expected']) if row['score'] is not None else float('inf')
+    better = sum(1 for a, b in changed if distance(b) < distance(a))
+    worse = sum(1 for a, b in changed if distance(b) > distance(a))
+    print(f"{len(changed)} anchors changed grade: {better} closer to the expected grade, {worse} further")
+    for a, b in changed:
+        print(f"  {a['id']:<20} expected {a['expected']:g}: {fmt(a['score'], '{:g}')} -> {fmt(b['score'], '{:g}')}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Grade labelled anchors with a grader config (record/replay) and compare runs.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="Grade the anchors and write a run report")
+    run_parser.add_argument('--config', required=True, help="Grader config script")
+    run_parser.add_argument('--anchors', required=True, help="CSV or JSONL with id, studentInput and grade")
+    run_parser.add_argument('--output', required=True, help="Run report (JSON)")
+    run_parser.add_argument('--replay', required=True, help="Replay store (SQLite), shared by the runs")
+    run_parser.add_argument('--replay-mode', choices=['auto', 'record', 'replay'], default='auto')
+    run_parser.add_argument('--replay-speed', type=float, default=1.0, help="Replayed latency factor (0: instant)")
+    run_parser.add_argument('--set', action='append', metavar='KEY=VALUE', help="Override a CONFIG key (JSON value or string)")
+    run_parser.add_argument('--rubric', help="File with the system_instructions to try")
+    run_parser.add_argument('--concurrency', type=int, default=4)
+    run_parser.add_argument('--adjacent', type=float, default=1, help="Points of difference counted as adjacent agreement")
+    run_parser.add_argument('--label')
+    diff_parser = commands.add_parser('diff', help="Compare two run reports")
+    diff_parser.add_argument('before')
+    diff_parser.add_argument('after')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args)
+    else:
+        diff(args)
+
+if __name__ == "__main__":
+    main()
@@ -33,7 +33,7 @@ CONFIG = {
     "api_key": os.getenv("AI_GRADER_API_KEY_GOOGLE",""),
 	#"api_key": os.getenv("AI_GRADER_API_KEY_OPENAI",""),
     "provider": "google",               # Options: "google" o "openai"
-    "api_url": None,                    # Optional for OpenAI compatible APIs (ej. Azure o Proxies). If None, uses the openai url.
+    "api_url": None,                    # Optional for OpenAI compatible APIs (ej. Azure o Proxies) or a Gemini proxy. If None, uses the provider url.
 	  "model_name": "gemini-2.5-flash-lite",
     "grade_identifier": "FINAL_GRADE", # What parser is going to look for from the llm to get the grade (ej: FINAL_GRADE: 12/15), include its generation in prompt 
     # ✅ LTI secrets (to be included in Moodle or  Open EdX configuration -LTI Passport-)  
@@ -44,6 +44,7 @@ CONFIG = {
     
     "session_dir": '/var/secure/lti_sessions',
     "send_grade_to_lms": True,
+    "watch_files": ["/var/secure/aigrader.env"], # aigrader_server.py reloads this config when these files change
      
     "system_instructions": """
 EVALUATION INSTRUCTIONS:
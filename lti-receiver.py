@@ -5,19 +5,28 @@
 
 import cgi
 import cgitb
+import html
 import json
 import os
 import sys
-import time
 import random
 import string
-from urllib.parse import parse_qs
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+
+import aigrader_metrics
+import lti_sessions
 
 # ⚙️ GLOBAL CONFIGURATION
 DEBUG = False
 REDIRECT_URL = '/C1-writing-correction-LTI.html' # Default destination
 SESSION_DIR = '/var/secure/lti_sessions'
 SESSION_TIMEOUT = 3600
+SESSION_BACKEND = 'sqlite' # 'sqlite' (indexed sessions.db), 'file' (one token.json per launch) or 'signed' (no server state)
+SESSION_KEYS = os.getenv('AIGRADER_SESSION_KEYS', '') # 'signed': "id:secret,id:secret", the first signs (same as the grader's "session_keys")
+SESSION_ENCRYPT = False # 'signed': seal the LTI fields with AES-GCM (needs the cryptography package)
+METRICS = False # Stage timings of each launch in SESSION_DIR/metrics.db (see aigrader_metrics.py)
+REQUEST_LOG = None # 'stderr' or a file path: one JSON log line per launch
+FAST_REDIRECT = True # 303 redirect straight to the activity; False (or DEBUG) shows the status page and redirects after 1.5-2 s
 
 # LTI Allowed origins
 ALLOWED_ORIGINS = [
@@ -29,22 +38,8 @@ if DEBUG:
     cgitb.enable()
 
 def ensure_session_dir():
-    """Create directory and clean old files."""
-    if not os.path.exists(SESSION_DIR):
-        try:
-            os.makedirs(SESSION_DIR, mode=0o700)
-        except:
-            pass
-    
-    # Garbage Collector (clean expired sessions)
-    try:
-        now = time.time()
-        for f in os.listdir(SESSION_DIR):
-            f_path = os.path.join(SESSION_DIR, f)
-            if os.stat(f_path).st_mtime < (now - SESSION_TIMEOUT):
-                os.remove(f_path)
-    except:
-        pass
+    """Create directory (expired sessions are cleaned by the session store)."""
+    lti_sessions.ensure_dir(SESSION_DIR)
 
 def get_safe_redirect_url(params):
     """
@@ -62,25 +57,29 @@ def get_safe_redirect_url(params):
     # Clean URL: https://host/filename.html
     return f"https://{host}/{safe_filename}"
 
+def redirect_location(target, token, mode):
+    """The activity URL with the session token and mode, as aigrader.js reads them."""
+    parts = urlsplit(target)
+    query = [(k, v[0]) for k, v in parse_qs(parts.query).items() if k not in ('token', 'mode')]
+    if token:
+        query.append(('token', token))
+    query.append(('mode', mode))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
 def generate_token():
     chars = string.ascii_letters + string.digits
     return ''.join(random.SystemRandom().choice(chars) for _ in range(32))
 
 def save_session(token, lti_params):
+    """Stores the launch and returns the session token for the activity URL."""
+    if SESSION_BACKEND == 'signed':
+        # The token is the session: nothing is written to SESSION_DIR
+        return lti_sessions.signed_store(SESSION_KEYS, SESSION_TIMEOUT, SESSION_ENCRYPT).issue(lti_params)
     ensure_session_dir()
-    session_data = {
-        'lti_params': lti_params,
-        'created_at': int(time.time()),
-        'expires_at': int(time.time()) + SESSION_TIMEOUT
-    }
-    try:
-        session_file = os.path.join(SESSION_DIR, token + ".json")
-        with open(session_file, 'w') as f:
-            json.dump(session_data, f)
-        os.chmod(session_file, 0o600)
-        return True
-    except:
-        return False
+    # Both stores expire old sessions themselves (indexed delete / throttled directory scan)
+    store = lti_sessions.get_session_store(SESSION_BACKEND, SESSION_DIR, SESSION_TIMEOUT)
+    store.save(token, lti_params)
+    return token
 
 def get_all_params():
     params = {}
@@ -114,24 +113,41 @@ def validate_lti(params):
     found = [p for p in required if p in params and params[p]]
     return {'is_valid': len(found) >= 2, 'found': found, 'total': len(params)}
 
-def main():
-    params = get_all_params()
-    redirect_target = get_safe_redirect_url(params)
-
+def print_headers(trace, status=None, extra=()):
     origin_header = os.environ.get('HTTP_ORIGIN', '')
     allowed_origin = origin_header if origin_header in ALLOWED_ORIGINS else '*'
 
+    if status:
+        print(f"Status: {status}")
     print("Content-Type: text/html; charset=utf-8")
     print(f"Access-Control-Allow-Origin: {allowed_origin}")
     print("Access-Control-Allow-Methods: GET, POST, OPTIONS")
     print("Access-Control-Allow-Headers: Content-Type")
     print("Access-Control-Allow-Credentials: true")
+    print(f"X-Request-ID: {trace.request_id}")
+    for name, value in extra:
+        print(f"{name}: {value}")
     print()
 
+def main():
+    request_id = aigrader_metrics.new_request_id(os.environ.get('HTTP_X_REQUEST_ID'))
+    config = {'session_dir': SESSION_DIR, 'metrics': METRICS, 'request_log': REQUEST_LOG}
+    with aigrader_metrics.request(config, 'launch', request_id) as trace:
+        launch(trace)
+
+def launch(trace):
+    with trace.stage('parse'):
+        params = get_all_params()
+    redirect_target = get_safe_redirect_url(params)
+
     method = os.environ.get('REQUEST_METHOD', 'GET')
-    if method == 'OPTIONS': return
+    if method == 'OPTIONS':
+        print_headers(trace)
+        return
 
     if method == 'POST' and not validate_origin():
+        trace.outcome = 'forbidden'
+        print_headers(trace)
         print("<html><body><h1>403 Forbidden</h1></body></html>")
         return
 
@@ -141,6 +157,7 @@ def main():
 
     # Info page if no parameters
     if method == 'GET' and not os.environ.get('QUERY_STRING'):
+        print_headers(trace)
         print(f"<!DOCTYPE html><html><head><title>Activo</title></head><body><h1>✅ Receptor LTI Activo</h1><p>Destino: {redirect_target}</p></body></html>")
         return
 
@@ -148,17 +165,29 @@ def main():
     token = generate_token()
     
     if validation['is_valid']:
-        save_session(token, params)
+        with trace.stage('session'):
+            token = save_session(token, params)
         status_class, msg, delay, mode = 'success', '✅ LTI Session created', 1500, 'lti'
     elif validation['total'] > 0:
-        save_session(token, params)
+        with trace.stage('session'):
+            token = save_session(token, params)
         status_class, msg, delay, mode = 'warning', '⚠️ Partial session created', 2000, 'partial'
     else:
         status_class, msg, delay, mode = 'error', '❌ Standalone mode', 2000, 'standalone'
         token = None
 
-    debug_css = "" if DEBUG else ".origin-debug { display: none; }"
+    aigrader_metrics.annotate(mode=mode)
 
+    if FAST_REDIRECT and not DEBUG:
+        # No intermediate page: the browser goes straight to the (static) activity page,
+        # where aigrader.js stores the token and mode taken from the URL.
+        location = redirect_location(redirect_target, token, mode)
+        print_headers(trace, "303 See Other", [("Location", location), ("Cache-Control", "no-store")])
+        print(f'<html><body><a href="{html.escape(location)}">{html.escape(msg)}</a></body></html>')
+        return
+
+    debug_css = "" if DEBUG else ".origin-debug { display: none; }"
+    print_headers(trace)
     print(f"""<!DOCTYPE html>
 <html>
 <head>
@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#lti_sessions.py
+
+# LTI session stores shared by lti-receiver.py (writes) and aigrader.py (reads).
+#
+#  - "sqlite": one indexed file (sessions.db in the session directory). A lookup is
+#    a single primary key read and expiry is an indexed, bounded delete on each
+#    launch instead of a scan of the whole directory.
+#  - "file":   the original layout, one <token>.json file per launch.
+#  - "signed": no server-side state. The token itself carries the LTI fields needed
+#    to grade and send the grade back (SIGNED_FIELDS) and its expiry, signed with
+#    HMAC-SHA256, so a lookup is an in-memory check and grader workers on other
+#    nodes need no shared session directory. With encrypt (needs the optional
+#    "cryptography" package) the fields are sealed with AES-GCM instead, so the
+#    student cannot read the outcome URL and sourcedid in the activity URL.
+#    Keys are {key_id: secret}; the first one signs and every one verifies, so a
+#    key is rotated by putting a new one first and removing the old one after
+#    SESSION_TIMEOUT. In the environment: AIGRADER_SESSION_KEYS="2026b:secret,2026a:older".
+#
+# Existing token.json sessions can be moved to the SQLite store with:
+#   python3 lti_sessions.py migrate /var/secure/lti_sessions
+# and expired sessions can also be purged from cron:
+#   python3 lti_sessions.py purge /var/secure/lti_sessions
+# A new key for signed sessions:
+#   python3 lti_sessions.py keygen
+
+import argparse
+import base64
+import functools
+import hashlib
+import hmac
+import json
+import os
+import re
+import sqlite3
+import time
+
+import aigrader_store
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+DB_FILENAME = "sessions.db"
+PURGE_BATCH = 500
+FILE_GC_INTERVAL = 300
+TOKEN_RE = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+# s1.<key_id>.<payload>.<mac> (signed) or e1.<key_id>.<nonce + sealed payload> (encrypted)
+SIGNED_TOKEN_RE = re.compile(r'^(?:s1\.([A-Za-z0-9_-]{1,32})\.([A-Za-z0-9_-]{1,2048})\.([A-Za-z0-9_-]{22})'
+                             r'|e1\.([A-Za-z0-9_-]{1,32})\.([A-Za-z0-9_-]{1,2048}))$')
+# Launch parameters kept in a signed token, in this order (custom_activity: aigrader_tenants.py)
+SIGNED_FIELDS = ('lis_outcome_service_url', 'lis_result_sourcedid', 'oauth_consumer_key', 'custom_activity')
+KEY_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+MAC_BYTES = 16
+NONCE_BYTES = 12
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    token TEXT PRIMARY KEY,
+    lti_params TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    expires_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires_at);
+"""
+
+def ensure_dir(session_dir):
+    if not os.path.exists(session_dir):
+        try:
+            os.makedirs(session_dir, mode=0o700)
+        except OSError:
+            pass
+
+class SQLiteSessionStore:
+    def __init__(self, session_dir, timeout=3600):
+        self.session_dir = session_dir
+        self.path = os.path.join(session_dir, DB_FILENAME)
+        self.timeout = timeout
+
+    @property
+    def db(self):
+        return aigrader_store.open_db(self.path, SCHEMA)
+
+    def save(self, token, lti_params, created_at=None, expires_at=None):
+        now = int(time.time())
+        created_at = created_at or now
+        try:
+            self.db.execute("INSERT OR REPLACE INTO sessions (token, lti_params, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                            (token, json.dumps(lti_params), created_at, expires_at or created_at + self.timeout))
+            # Amortized expiry: a bounded, indexed delete per launch.
+            self.purge_expired(PURGE_BATCH)
+            return True
+        except sqlite3.Error:
+            return False
+
+    def get(self, token):
+        row = self.db.execute("SELECT lti_params, created_at, expires_at FROM sessions WHERE token = ? AND expires_at >= ?",
+                              (token, int(time.time()))).fetchone()
+        if row is None:
+            return None
+        return {'lti_params': json.loads(row[0]), 'created_at': row[1], 'expires_at': row[2]}
+
+    def purge_expired(self, limit=None):
+        query = "DELETE FROM sessions WHERE token IN (SELECT token FROM sessions WHERE expires_at < ?"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        return self.db.execute(query + ")", (int(time.time()),)).rowcount
+
+class FileSessionStore:
+    def __init__(self, session_dir, timeout=3600):
+        self.session_dir = session_dir
+        self.timeout = timeout
+
+    def _path(self, token):
+        if not TOKEN_RE.match(token or ''):
+            return None
+        return os.path.join(self.session_dir, token + ".json")
+
+    def save(self, token, lti_params):
+        now = int(time.time())
+        session_data = {'lti_params': lti_params, 'created_at': now, 'expires_at': now + self.timeout}
+        try:
+            session_file = self._path(token)
+            with open(session_file, 'w') as f:
+                json.dump(session_data, f)
+            os.chmod(session_file, 0o600)
+        except Exception:
+            return False
+        self.maybe_purge()
+        return True
+
+    def get(self, token):
+        session_path = self._path(token)
+        if not session_path or not os.path.exists(session_path):
+            return None
+        with open(session_path, 'r') as f:
+            return json.load(f)
+
+    def maybe_purge(self):
+        """Runs the directory scan at most once every FILE_GC_INTERVAL seconds."""
+        marker = os.path.join(self.session_dir, ".last_gc")
+        try:
+            if time.time() - os.stat(marker).st_mtime < FILE_GC_INTERVAL:
+                return 0
+        except OSError:
+            pass
+        try:
+            with open(marker, 'w'):
+                pass
+        except OSError:
+            return 0
+        return self.purge_expired()
+
+    def purge_expired(self):
+        removed = 0
+        cutoff = time.time() - self.timeout
+        try:
+            with os.scandir(self.session_dir) as entries:
+                for entry in entries:
+                    # Only session files: the SQLite state files may share the directory.
+                    if entry.name.endswith('.json') and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+        except OSError:
+            pass
+        return removed
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def parse_keys(value):
+    """{key_id: secret} from "id:secret,id:secret" (AIGRADER_SESSION_KEYS), in order."""
+    keys = {}
+    for item in (value or '').split(','):
+        key_id, _, secret = item.strip().partition(':')
+        if key_id and secret:
+            keys[key_id] = secret
+    return keys
+
+@functools.lru_cache(maxsize=64)
+def derived_keys(secret):
+    """Separate MAC and encryption keys from one secret; the keyed HMAC is copied per token, not rekeyed."""
+    secret = secret.encode('utf-8')
+    mac = hmac.new(hmac.new(secret, b'aigrader-session-mac', hashlib.sha256).digest(), digestmod=hashlib.sha256)
+    aead = AESGCM(hmac.new(secret, b'aigrader-session-enc', hashlib.sha256).digest()) if AESGCM else None
+    return mac, aead
+
+class SignedSessionStore:
+    def __init__(self, keys, timeout=3600, encrypt=False):
+        if not keys:
+            raise ValueError("signed sessions need at least one key")
+        if encrypt and AESGCM is None:
+            raise ValueError("encrypted session tokens need the cryptography package")
+        bad = [key_id for key_id in keys if not KEY_ID_RE.match(key_id)]
+        if bad:
+            raise ValueError(f"invalid session key IDs: {', '.join(bad)}")
+        self.keys = dict(keys)
+        self.key_id = next(iter(self.keys))
+        self.timeout = timeout
+        self.encrypt = encrypt
+
+    def _mac(self, secret, signed):
+        mac = derived_keys(secret)[0].copy()
+        mac.update(signed.encode('ascii'))
+        return mac.digest()[:MAC_BYTES]
+
+    def issue(self, lti_params, expires_at=None):
+        """A new token for these launch parameters."""
+        expires_at = expires_at or int(time.time()) + self.timeout
+        fields = [expires_at] + [lti_params.get(name) for name in SIGNED_FIELDS]
+        while fields[-1] is None:
+            fields.pop()
+        payload = json.dumps(fields, separators=(',', ':')).encode('utf-8')
+        secret = self.keys[self.key_id]
+        if self.encrypt:
+            nonce = os.urandom(NONCE_BYTES)
+            header = f"e1.{self.key_id}"
+            sealed = derived_keys(secret)[1].encrypt(nonce, payload, header.encode('ascii'))
+            return f"{header}.{b64encode(nonce + sealed)}"
+        signed = f"s1.{self.key_id}.{b64encode(payload)}"
+        return f"{signed}.{b64encode(self._mac(secret, signed))}"
+
+    def get(self, token):
+        match = SIGNED_TOKEN_RE.match(token or '')
+        if not match:
+            return None
+        key_id, body, mac, sealed_key_id, sealed = match.groups()
+        secret = self.keys.get(key_id or sealed_key_id)
+        if secret is None:
+            return None
+        try:
+            if sealed:
+                if AESGCM is None:
+                    return None
+                data = b64decode(sealed)
+                payload = derived_keys(secret)[1].decrypt(data[:NONCE_BYTES], data[NONCE_BYTES:],
+                                                                  f"e1.{sealed_key_id}".encode('ascii'))
+            else:
+                if not hmac.compare_digest(b64encode(self._mac(secret, f"s1.{key_id}.{body}")), mac):
+                    return None
+                payload = b64decode(body)
+            fields = json.loads(payload)
+        except Exception:
+            return None
+        if not isinstance(fields, list) or not fields or not isinstance(fields[0], int) or fields[0] < time.time():
+            return None
+        lti_params = {name: value for name, value in zip(SIGNED_FIELDS, fields[1:]) if value is not None}
+        return {'lti_params': lti_params, 'expires_at': fields[0]}
+
+def signed_store(keys, timeout=3600, encrypt=False):
+    """Cached SignedSessionStore; keys is a {key_id: secret} dict or an "id:secret,..." string."""
+    keys = parse_keys(keys) if isinstance(keys, str) else keys or {}
+    return _signed_store(tuple(keys.items()), timeout, encrypt)
+
+@functools.lru_cache(maxsize=64)
+def _signed_store(keys, timeout, encrypt):
+    return SignedSessionStore(dict(keys), timeout, encrypt)
+
+def get_session_store(backend, session_dir, timeout=3600):
+    ensure_dir(session_dir)
+    if backend == "file":
+        return FileSessionStore(session_dir, timeout)
+    return SQLiteSessionStore(session_dir, timeout)
+
+def load_session(token, session_dir, backend="auto", keys=None):
+    """Looks a token up. "auto" reads sessions.db when present and falls back to token.json files.
+
+    A signed token (with keys) is verified in memory, without touching session_dir.
+    """
+    if keys and backend in ("signed", "auto") and (token or '').startswith(('s1.', 'e1.')):
+        return signed_store(keys).get(token)
+    if backend == "signed" or not token or not TOKEN_RE.match(token):
+        return None
+    if backend in ("sqlite", "auto") and os.path.exists(os.path.join(session_dir, DB_FILENAME)):
+        session = SQLiteSessionStore(session_dir).get(token)
+        if session is not None:
+            return session
+    if backend in ("file", "auto"):
+        return FileSessionStore(session_dir).get(token)
+    return None
+
+def migrate_file_sessions(session_dir, remove=True):
+    """Copies every unexpired token.json session into sessions.db. Returns (migrated, skipped)."""
+    store = SQLiteSessionStore(session_dir)
+    migrated = skipped = 0
+    now = int(time.time())
+    for name in sorted(os.listdir(session_dir)):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(session_dir, name)
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            expires_at = int(data.get('expires_at') or os.stat(path).st_mtime + store.timeout)
+            if expires_at >= now:
+                store.db.execute("INSERT OR IGNORE INTO sessions (token, lti_params, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                                 (name[:-5], json.dumps(data.get('lti_params', {})), int(data.get('created_at') or now), expires_at))
+                migrated += 1
+            else:
+                skipped += 1
+        except (OSError, ValueError, sqlite3.Error):
+            skipped += 1
+            continue
+        if remove:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return migrated, skipped
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance of the LTI session store.")
+    parser.add_argument('command', choices=['migrate', 'purge', 'keygen'])
+    parser.add_argument('session_dir', nargs='?', default='/var/secure/lti_sessions')
+    parser.add_argument('--keep-files', action='store_true', help="migrate: do not delete the migrated token.json files")
+    args = parser.parse_args()
+
+    if args.command == 'keygen':
+        # A new signing key: prepend it to AIGRADER_SESSION_KEYS
+        print(f"{time.strftime('%Y%m%d')}:{b64encode(os.urandom(32))}")
+    elif args.command == 'migrate':
+        migrated, skipped = migrate_file_sessions(args.session_dir, remove=not args.keep_files)
+        print(f"Migrated {migrated} sessions, skipped {skipped} expired or unreadable files")
+    else:
+        removed = SQLiteSessionStore(args.session_dir).purge_expired()
+        removed += FileSessionStore(args.session_dir).purge_expired()
+        print(f"Removed {removed} expired sessions")
+
+if __name__ == "__main__":
+    main()
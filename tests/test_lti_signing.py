@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#test_lti_signing.py
+
+# LTI 1.1 outcome signing (aigrader.build_lti_request): the OAuth body hash and
+# HMAC-SHA1 signature match a from-scratch RFC 5849 computation, also with the keyed
+# HMAC state cached per secret (signing_hmac) and the base string prefix per URL.
+#
+#   python3 -m unittest discover tests
+
+import base64
+import hashlib
+import hmac
+import os
+import re
+import sys
+import unittest
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aigrader
+
+OUTCOME_URL = "https://lms.example.com/grade_handler?course=c1&b=x%2Fy&empty="
+CONSUMER_KEY = "course-key"
+SECRET = "s3cret/with+reserved=chars&more"
+CONFIG = {'LTI_ALLOWED_DOMAINS': 'example.com', 'lti_consumer_secrets': {CONSUMER_KEY: SECRET, 'other': 'another secret'}}
+
+def quote(value):
+    return urllib.parse.quote(str(value), safe='~')
+
+def reference_signature(method, url, oauth_params, secret):
+    """RFC 5849 signature with every step redone (urllib quoting, fresh HMAC)."""
+    parsed = urllib.parse.urlparse(url)
+    params = list(oauth_params.items()) + urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+    normalized = '&'.join(f"{k}={v}" for k, v in sorted((quote(k), quote(v)) for k, v in params))
+    base_url = f"{parsed.scheme.lower()}://{parsed.netloc.lower()}{parsed.path or '/'}"
+    base_string = '&'.join((method.upper(), quote(base_url), quote(normalized)))
+    key = f"{quote(secret)}&".encode('utf-8')
+    return base64.b64encode(hmac.new(key, base_string.encode('utf-8'), hashlib.sha1).digest()).decode('ascii')
+
+def parse_authorization(header):
+    assert header.startswith('OAuth ')
+    return {k: urllib.parse.unquote(v) for k, v in re.findall(r'(\w+)="([^"]*)"', header)}
+
+class OAuthQuoteTest(unittest.TestCase):
+    def test_matches_urllib(self):
+        for value in ('plain-value_1.2~', 'a b', 'x/y+z=', 'Zm9v+YmFy/YQ==', 'ñandú', '', '%41', 1700000000):
+            self.assertEqual(aigrader.oauth_quote(value), quote(value), value)
+
+class BuildLtiRequestTest(unittest.TestCase):
+    def test_signature_matches_reference(self):
+        final_url, xml_body, headers = aigrader.build_lti_request(OUTCOME_URL, 'src-1', CONSUMER_KEY, 0.8, CONFIG)
+        params = parse_authorization(headers['Authorization'])
+        signature = params.pop('oauth_signature')
+        self.assertEqual(signature, reference_signature('POST', final_url, params, SECRET))
+        self.assertEqual(params['oauth_consumer_key'], CONSUMER_KEY)
+        self.assertEqual(params['oauth_signature_method'], 'HMAC-SHA1')
+
+    def test_body_hash_covers_the_envelope(self):
+        _, xml_body, headers = aigrader.build_lti_request(OUTCOME_URL, 'src-1', CONSUMER_KEY, 0.8, CONFIG)
+        expected = base64.b64encode(hashlib.sha1(xml_body.encode('utf-8')).digest()).decode('ascii')
+        self.assertEqual(parse_authorization(headers['Authorization'])['oauth_body_hash'], expected)
+        self.assertIn('<textString>0.8000</textString>', xml_body)
+
+    def test_sourcedid_is_escaped(self):
+        _, xml_body, _ = aigrader.build_lti_request(OUTCOME_URL, 'a<b>&"c"', CONSUMER_KEY, 1, CONFIG)
+        self.assertIn('<sourcedId>a&lt;b&gt;&amp;"c"</sourcedId>', xml_body)
+
+    def test_read_result(self):
+        _, xml_body, headers = aigrader.build_lti_request(OUTCOME_URL, 'src-1', CONSUMER_KEY, 0, CONFIG, 'readResult')
+        self.assertIn('<readResultRequest>', xml_body)
+        params = parse_authorization(headers['Authorization'])
+        self.assertEqual(params.pop('oauth_signature'), reference_signature('POST', OUTCOME_URL, params, SECRET))
+
+    def test_not_allowed(self):
+        self.assertIsNone(aigrader.build_lti_request("https://evil.example.org/grade", 's', CONSUMER_KEY, 1, CONFIG))
+        self.assertIsNone(aigrader.build_lti_request("http://lms.example.com/grade", 's', CONSUMER_KEY, 1, CONFIG))
+        self.assertIsNone(aigrader.build_lti_request(OUTCOME_URL, 's', 'unknown-key', 1, CONFIG))
+
+class SigningCacheTest(unittest.TestCase):
+    PARAMS = {'oauth_consumer_key': CONSUMER_KEY, 'oauth_nonce': 'abc', 'oauth_timestamp': '1700000000',
+              'oauth_body_hash': 'Zm9v+YmFy/YQ=', 'oauth_signature_method': 'HMAC-SHA1', 'oauth_version': '1.0'}
+
+    def test_cached_state_is_not_consumed(self):
+        # The keyed HMAC of signing_hmac is copied for each signature: signing again, or with
+        # other parameters in between, gives the same result.
+        first = aigrader.oauth_signature('POST', OUTCOME_URL, self.PARAMS, SECRET)
+        aigrader.oauth_signature('POST', OUTCOME_URL, dict(self.PARAMS, oauth_nonce='xyz'), SECRET)
+        self.assertEqual(aigrader.oauth_signature('POST', OUTCOME_URL, self.PARAMS, SECRET), first)
+        self.assertEqual(first, reference_signature('POST', OUTCOME_URL, self.PARAMS, SECRET))
+        self.assertIs(aigrader.signing_hmac(SECRET), aigrader.signing_hmac(SECRET))
+
+    def test_secrets_are_kept_apart(self):
+        for secret in (SECRET, 'another secret', SECRET):
+            self.assertEqual(aigrader.oauth_signature('POST', OUTCOME_URL, self.PARAMS, secret),
+                             reference_signature('POST', OUTCOME_URL, self.PARAMS, secret))
+
+    def test_query_parameters_are_signed(self):
+        # signature_base is cached per URL: another query string must still change the signature.
+        other = OUTCOME_URL.replace('course=c1', 'course=c2')
+        self.assertNotEqual(aigrader.oauth_signature('POST', OUTCOME_URL, self.PARAMS, SECRET),
+                            aigrader.oauth_signature('POST', other, self.PARAMS, SECRET))
+        self.assertEqual(aigrader.oauth_signature('POST', other, self.PARAMS, SECRET),
+                         reference_signature('POST', other, self.PARAMS, SECRET))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#test_outbox.py
+
+# LTI grade outbox (aigrader_outbox): one row per sourcedid, leases that outlast a
+# batch, and the guard that keeps a newer grade enqueued while an older one was in
+# flight (its result must neither delete nor reschedule the newer row).
+#
+#   python3 -m unittest discover tests
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aigrader
+import aigrader_outbox
+
+OUTCOME_URL = "https://lms.example.com/grade_handler"
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.config = {'state_dir': tempfile.mkdtemp(), 'lti_outbox_max_attempts': 3}
+
+    def enqueue(self, score, sourcedid='src-1'):
+        self.assertTrue(aigrader_outbox.enqueue(OUTCOME_URL, sourcedid, 'course-key', score, self.config))
+        time.sleep(0.002)     # distinct updated_at for the next write
+
+    def row(self, sourcedid='src-1'):
+        return aigrader_outbox.outbox_db(self.config).execute(
+            "SELECT score, status, attempts, leased_until FROM outbox WHERE sourcedid = ?", (sourcedid,)).fetchone()
+
+    def test_enqueue_replaces_pending_grade(self):
+        self.enqueue(0.4)
+        self.enqueue(0.9)
+        self.assertEqual(aigrader_outbox.pending_count(self.config), 1)
+        self.assertEqual(self.row()[0], 0.9)
+        self.assertFalse(aigrader_outbox.enqueue(OUTCOME_URL, '', 'course-key', 1, self.config))
+
+    def test_claimed_rows_are_leased(self):
+        self.enqueue(0.5)
+        self.enqueue(0.6, 'src-2')
+        rows = aigrader_outbox.claim_due(self.config, limit=10)
+        self.assertEqual(sorted(row[0] for row in rows), ['src-1', 'src-2'])
+        self.assertEqual(aigrader_outbox.claim_due(self.config, limit=10), [])
+        self.assertGreater(self.row()[3], time.time() + aigrader_outbox.lease_seconds(self.config, 10) - 5)
+
+    def test_lease_outlasts_a_batch(self):
+        # All rows on one host, host_concurrency at a time, each taking the whole timeout.
+        worst_case = 200 / 4 * aigrader.PASSBACK_TIMEOUT
+        self.assertGreater(aigrader_outbox.lease_seconds({}, 200), worst_case)
+        verified = {'lti_verify_passback': True, 'lti_outbox_host_concurrency': 8}
+        self.assertGreater(aigrader_outbox.lease_seconds(verified, 200), 200 / 8 * 2 * aigrader.PASSBACK_TIMEOUT)
+
+    def test_sent_row_is_deleted(self):
+        self.enqueue(0.5)
+        row, = aigrader_outbox.claim_due(self.config)
+        aigrader_outbox.record_result(self.config, row)
+        self.assertIsNone(self.row())
+
+    def test_failed_row_is_retried_then_kept(self):
+        self.enqueue(0.5)
+        for attempt in range(1, 4):
+            aigrader_outbox.outbox_db(self.config).execute("UPDATE outbox SET next_attempt_at = 0")
+            row, = aigrader_outbox.claim_due(self.config)
+            aigrader_outbox.record_result(self.config, row, error="HTTP 503")
+            self.assertEqual(self.row()[1:3], ('pending' if attempt < 3 else 'failed', attempt))
+        self.assertEqual(aigrader_outbox.claim_due(self.config), [])
+
+    def test_permanent_failure(self):
+        self.enqueue(0.5)
+        row, = aigrader_outbox.claim_due(self.config)
+        aigrader_outbox.record_result(self.config, row, error="unknown consumer key", permanent=True)
+        self.assertEqual(self.row()[1:3], ('failed', 1))
+
+    def test_newer_grade_survives_success_of_older(self):
+        self.enqueue(0.4)
+        row, = aigrader_outbox.claim_due(self.config)
+        self.enqueue(0.9)     # replaced while the 0.4 was being sent
+        aigrader_outbox.record_result(self.config, row)
+        self.assertEqual(self.row()[:3], (0.9, 'pending', 0))
+
+    def test_newer_grade_survives_failure_of_older(self):
+        self.enqueue(0.4)
+        row, = aigrader_outbox.claim_due(self.config)
+        self.enqueue(0.9)
+        aigrader_outbox.record_result(self.config, row, error="HTTP 503", permanent=True)
+        score, status, attempts, _ = self.row()
+        self.assertEqual((score, status, attempts), (0.9, 'pending', 0))
+
+    def test_newer_grade_reopens_failed_row(self):
+        self.enqueue(0.4)
+        row, = aigrader_outbox.claim_due(self.config)
+        aigrader_outbox.record_result(self.config, row, error="unknown consumer key", permanent=True)
+        self.enqueue(0.9)
+        self.assertEqual(self.row()[:3], (0.9, 'pending', 0))
+
+if __name__ == "__main__":
+    unittest.main()
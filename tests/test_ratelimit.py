@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#test_ratelimit.py
+
+# Token buckets of the admission control (aigrader_ratelimit): burst and refill
+# math, all-or-nothing acquisition over several buckets, full_at and the purge of
+# idle buckets, and the queue / RateLimited behaviour of acquire().
+#
+#   python3 -m unittest discover tests
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aigrader_ratelimit
+
+NOW = 1_800_000_000.0
+
+class BucketMathTest(unittest.TestCase):
+    def setUp(self):
+        self.config = {'state_dir': tempfile.mkdtemp()}
+
+    def acquire_at(self, when, buckets):
+        with mock.patch('time.time', return_value=when):
+            return aigrader_ratelimit.try_acquire(self.config, buckets)
+
+    def bucket(self, key):
+        return aigrader_ratelimit.ratelimit_db(self.config).execute(
+            "SELECT tokens, updated_at, full_at FROM token_buckets WHERE key = ?", (key,)).fetchone()
+
+    def test_burst_then_wait(self):
+        session = [('session:abc', 4 / 60, 2, 1)]       # 4 per minute, burst 2
+        self.assertEqual(self.acquire_at(NOW, session), (0, None))
+        self.assertEqual(self.acquire_at(NOW, session), (0, None))
+        wait, scope = self.acquire_at(NOW, session)
+        self.assertAlmostEqual(wait, 15)
+        self.assertEqual(scope, 'session')
+        # A refused request takes nothing: the wait only shrinks with time.
+        wait, _ = self.acquire_at(NOW + 10, session)
+        self.assertAlmostEqual(wait, 5)
+        self.assertEqual(self.acquire_at(NOW + 15, session), (0, None))
+
+    def test_refill_is_capped_at_capacity(self):
+        bucket = [('consumer:key', 1, 3, 1)]
+        self.acquire_at(NOW, bucket)
+        self.acquire_at(NOW + 3600, bucket)
+        self.assertAlmostEqual(self.bucket('consumer:key')[0], 2)
+
+    def test_all_or_nothing(self):
+        consumer = ('consumer:key', 1, 5, 1)
+        session = ('session:abc', 0.1, 1, 1)
+        self.assertEqual(self.acquire_at(NOW, [consumer, session]), (0, None))
+        wait, scope = self.acquire_at(NOW, [consumer, session])
+        self.assertEqual(scope, 'session')
+        self.assertAlmostEqual(wait, 10)
+        self.assertAlmostEqual(self.bucket('consumer:key')[0], 4)
+
+    def test_longest_wait_wins(self):
+        rpm = ('rpm:google:m', 1, 1, 1)
+        tpm = ('tpm:google:m', 100, 1000, 800)
+        self.acquire_at(NOW, [rpm, tpm])
+        wait, scope = self.acquire_at(NOW, [rpm, tpm])
+        self.assertEqual(scope, 'tpm')
+        self.assertAlmostEqual(wait, 6)
+
+    def test_cost_over_capacity_is_capped(self):
+        tpm = [('tpm:openai:m', 10, 100, 500)]
+        self.assertEqual(self.acquire_at(NOW, tpm), (0, None))
+        self.assertAlmostEqual(self.acquire_at(NOW, tpm)[0], 10)
+
+    def test_full_at(self):
+        self.acquire_at(NOW, [('session:abc', 0.5, 4, 1)])
+        self.acquire_at(NOW + 1, [('session:abc', 0.5, 4, 1)])
+        tokens, updated_at, full_at = self.bucket('session:abc')
+        self.assertAlmostEqual(tokens, 2.5)
+        self.assertEqual(updated_at, NOW + 1)
+        self.assertAlmostEqual(full_at, NOW + 1 + 1.5 / 0.5)
+
+    def test_purge_uses_each_buckets_own_refill(self):
+        # A slow session bucket (1 per hour) is still refilling long after a fast provider
+        # bucket is full: only the idle provider bucket goes.
+        self.acquire_at(NOW, [('session:slow', 1 / 3600, 1, 1), ('rpm:google:m', 1, 60, 1)])
+        later = NOW + 2 + aigrader_ratelimit.IDLE_MARGIN
+        self.acquire_at(later, [('consumer:other', 1, 60, 1)])
+        self.assertIsNone(self.bucket('rpm:google:m'))
+        self.assertIsNotNone(self.bucket('session:slow'))
+        # Gone once it has been full for IDLE_MARGIN too, which changes nothing: a missing bucket is full.
+        self.acquire_at(NOW + 3600 + aigrader_ratelimit.IDLE_MARGIN + 1, [('consumer:other', 1, 60, 1)])
+        self.assertIsNone(self.bucket('session:slow'))
+
+    def test_refused_request_writes_nothing(self):
+        bucket = [('session:abc', 1 / 3600, 1, 1)]
+        self.acquire_at(NOW, bucket)
+        self.acquire_at(NOW + 1, bucket)
+        self.assertEqual(self.bucket('session:abc')[1], NOW)
+
+class LimitsTest(unittest.TestCase):
+    CONFIG = {'provider': 'google', 'model_name': 'gemini-x', 'system_instructions': 'Rubric ' * 50,
+              'rate_limits': {'consumer': {'rate': 120, 'per': 60, 'burst': 30}, 'session': {'rate': 4},
+                              'provider_rpm': 600, 'provider_tpm': 60000}}
+
+    def test_client_limits(self):
+        buckets = aigrader_ratelimit.limits_for('tok', None, self.CONFIG)
+        self.assertEqual(buckets, [('consumer:anonymous', 2, 30, 1), ('session:tok', 4 / 60, 4, 1)])
+        self.assertEqual(len(aigrader_ratelimit.limits_for(None, 'key', self.CONFIG)), 1)
+
+    def test_provider_limits_per_model(self):
+        rpm, tpm = aigrader_ratelimit.provider_limits("Student text", self.CONFIG)
+        self.assertEqual(rpm, ('rpm:google:gemini-x', 10, 600, 1))
+        self.assertEqual(tpm[:3], ('tpm:google:gemini-x', 1000, 60000))
+        self.assertEqual(tpm[3], aigrader_ratelimit.estimate_tokens("Student text", self.CONFIG))
+        other = dict(self.CONFIG, provider='openai', model_name='gpt-x')
+        self.assertEqual(aigrader_ratelimit.provider_limits("Student text", other)[0][0], 'rpm:openai:gpt-x')
+
+class AcquireTest(unittest.TestCase):
+    def setUp(self):
+        self.config = {'state_dir': tempfile.mkdtemp(), 'rate_limit_max_wait': 2}
+
+    def test_queued_then_admitted(self):
+        bucket = [('session:abc', 10, 1, 1)]
+        self.assertLess(asyncio.run(aigrader_ratelimit.acquire(self.config, bucket)), 0.05)
+        started = time.monotonic()
+        waited = asyncio.run(aigrader_ratelimit.acquire(self.config, bucket))
+        self.assertGreater(waited, 0.05)
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    def test_rejected_with_retry_after(self):
+        bucket = [('session:abc', 1 / 60, 1, 1)]
+        asyncio.run(aigrader_ratelimit.acquire(self.config, bucket))
+        with self.assertRaises(aigrader_ratelimit.RateLimited) as raised:
+            asyncio.run(aigrader_ratelimit.acquire(self.config, bucket))
+        self.assertEqual(raised.exception.scope, 'session')
+        self.assertIn(raised.exception.retry_after, (59, 60))
+
+    def test_no_buckets(self):
+        self.assertEqual(asyncio.run(aigrader_ratelimit.acquire(self.config, [])), 0)
+
+if __name__ == "__main__":
+    unittest.main()
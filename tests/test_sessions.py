@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#test_sessions.py
+
+# Stateless signed session tokens (lti_sessions.SignedSessionStore): the launch
+# fields round-trip, tampered, expired or unknown-key tokens are refused, and key
+# rotation (the first key signs, every key verifies) keeps older tokens valid.
+#
+#   python3 -m unittest discover tests
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lti_sessions
+
+LAUNCH = {
+    'lis_outcome_service_url': 'https://lms.example.com/grade_handler',
+    'lis_result_sourcedid': 'course-v1:X+Y+Z:user-1',
+    'oauth_consumer_key': 'course-key',
+    'custom_activity': 'essay-1',
+    'user_id': 'not signed',
+}
+SIGNED_LAUNCH = {name: LAUNCH[name] for name in lti_sessions.SIGNED_FIELDS}
+
+def tamper(token):
+    """token with one character of its payload changed."""
+    prefix, key_id, payload, mac = token.split('.')
+    payload = ('B' if payload[5] == 'A' else 'A').join((payload[:5], payload[6:]))
+    return '.'.join((prefix, key_id, payload, mac))
+
+class SignedTokenTest(unittest.TestCase):
+    def setUp(self):
+        self.store = lti_sessions.SignedSessionStore({'k1': 'first secret'}, timeout=600)
+
+    def test_round_trip(self):
+        token = self.store.issue(LAUNCH)
+        self.assertTrue(token.startswith('s1.k1.'))
+        session = self.store.get(token)
+        self.assertEqual(session['lti_params'], SIGNED_LAUNCH)
+        self.assertAlmostEqual(session['expires_at'], time.time() + 600, delta=5)
+
+    def test_missing_fields_are_left_out(self):
+        session = self.store.get(self.store.issue({'lis_result_sourcedid': 'src-1'}))
+        self.assertEqual(session['lti_params'], {'lis_result_sourcedid': 'src-1'})
+
+    def test_tampered_tokens_are_refused(self):
+        token = self.store.issue(LAUNCH)
+        self.assertIsNone(self.store.get(tamper(token)))
+        self.assertIsNone(self.store.get(token[:-2] + ('AA' if not token.endswith('AA') else 'BB')))
+        self.assertIsNone(self.store.get(token.replace('s1.k1.', 's1.k2.')))
+        for bad in (None, '', 'not-a-token', token + '.extra'):
+            self.assertIsNone(self.store.get(bad))
+
+    def test_other_secret_is_refused(self):
+        other = lti_sessions.SignedSessionStore({'k1': 'another secret'})
+        self.assertIsNone(other.get(self.store.issue(LAUNCH)))
+
+    def test_expiry(self):
+        self.assertIsNone(self.store.get(self.store.issue(LAUNCH, expires_at=int(time.time()) - 1)))
+        self.assertIsNotNone(self.store.get(self.store.issue(LAUNCH, expires_at=int(time.time()) + 60)))
+
+    def test_invalid_keys(self):
+        with self.assertRaises(ValueError):
+            lti_sessions.SignedSessionStore({})
+        with self.assertRaises(ValueError):
+            lti_sessions.SignedSessionStore({'bad id': 'secret'})
+
+class KeyRotationTest(unittest.TestCase):
+    def test_new_key_signs_old_key_verifies(self):
+        old = lti_sessions.SignedSessionStore({'2025': 'old secret'})
+        rotated = lti_sessions.SignedSessionStore({'2026': 'new secret', '2025': 'old secret'})
+        old_token = old.issue(LAUNCH)
+        self.assertEqual(rotated.get(old_token)['lti_params'], SIGNED_LAUNCH)
+        new_token = rotated.issue(LAUNCH)
+        self.assertTrue(new_token.startswith('s1.2026.'))
+        self.assertIsNone(old.get(new_token))
+
+    def test_retired_key_is_refused(self):
+        old_token = lti_sessions.SignedSessionStore({'2025': 'old secret'}).issue(LAUNCH)
+        retired = lti_sessions.SignedSessionStore({'2026': 'new secret'})
+        self.assertIsNone(retired.get(old_token))
+
+    def test_parse_keys_keeps_order(self):
+        keys = lti_sessions.parse_keys(" 2026:new:secret, 2025:old secret,broken,:no-id ")
+        self.assertEqual(list(keys.items()), [('2026', 'new:secret'), ('2025', 'old secret')])
+
+    def test_load_session_with_key_string(self):
+        # Verified in memory: the session directory is never read.
+        token = lti_sessions.SignedSessionStore({'2026': 'new secret', '2025': 'old secret'}).issue(LAUNCH)
+        keys = "2026:new secret,2025:old secret"
+        session = lti_sessions.load_session(token, '/nonexistent/session/dir', keys=keys)
+        self.assertEqual(session['lti_params'], SIGNED_LAUNCH)
+        self.assertIs(lti_sessions.signed_store(keys), lti_sessions.signed_store(keys))
+        self.assertIsNone(lti_sessions.load_session(token, '/nonexistent/session/dir', keys="2027:newer secret"))
+        self.assertIsNone(lti_sessions.load_session(token, '/nonexistent/session/dir', backend="file", keys=keys))
+
+@unittest.skipIf(lti_sessions.AESGCM is None, "needs the cryptography package")
+class EncryptedTokenTest(unittest.TestCase):
+    def test_round_trip_and_rotation(self):
+        old = lti_sessions.SignedSessionStore({'2025': 'old secret'}, encrypt=True)
+        rotated = lti_sessions.SignedSessionStore({'2026': 'new secret', '2025': 'old secret'}, encrypt=True)
+        token = old.issue(LAUNCH)
+        self.assertTrue(token.startswith('e1.2025.'))
+        self.assertNotIn(LAUNCH['lis_result_sourcedid'], token)
+        self.assertEqual(rotated.get(token)['lti_params'], SIGNED_LAUNCH)
+        self.assertIsNone(rotated.get(token.replace('e1.2025.', 'e1.2026.')))
+
+    def test_expiry(self):
+        store = lti_sessions.SignedSessionStore({'k1': 'secret'}, encrypt=True)
+        self.assertIsNone(store.get(store.issue(LAUNCH, expires_at=int(time.time()) - 1)))
+
+@unittest.skipIf(lti_sessions.AESGCM is not None, "the cryptography package is installed")
+class EncryptionUnavailableTest(unittest.TestCase):
+    def test_refused(self):
+        with self.assertRaises(ValueError):
+            lti_sessions.SignedSessionStore({'k1': 'secret'}, encrypt=True)
+
+if __name__ == "__main__":
+    unittest.main()
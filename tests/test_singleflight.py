@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#test_singleflight.py
+
+# In-process coalescing (aigrader_singleflight.flight): a follower gets the leader's
+# successful result, and never a failed one.
+#
+#   python3 -m unittest discover tests
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aigrader_singleflight
+
+def follow_leader(config, published):
+    """Result seen by a follower that joins while the leader grades and publishes `published`."""
+    seen = {}
+    leading = threading.Event()
+
+    def follower():
+        with aigrader_singleflight.flight("Same essay", "token", config) as flight:
+            seen['result'] = flight.result
+
+    with aigrader_singleflight.flight("Same essay", "token", config) as flight:
+        assert flight.result is None
+        thread = threading.Thread(target=follower)
+        thread.start()
+        time.sleep(0.2)       # the follower is now waiting on the leader
+        flight.publish(published)
+    thread.join(5)
+    return seen['result']
+
+class InProcessFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.config = {'coalesce': True, 'coalesce_timeout': 5, 'state_dir': tempfile.mkdtemp()}
+
+    def test_follower_gets_successful_result(self):
+        result = follow_leader(self.config, {'success': True, 'feedback': 'FINAL_GRADE: 4/5'})
+        self.assertEqual(result, {'success': True, 'feedback': 'FINAL_GRADE: 4/5', 'coalesced': True})
+
+    def test_follower_does_not_get_failed_result(self):
+        result = follow_leader(self.config, {'success': False, 'error': 'Too many requests', 'rate_limited': True})
+        self.assertIsNone(result)
+
+    def test_follower_does_not_get_missing_result(self):
+        self.assertIsNone(follow_leader(self.config, None))
+
+if __name__ == "__main__":
+    unittest.main()